@@ -0,0 +1,421 @@
+#!/usr/bin/python3
+#-------------------------------------------------------------------------------
+#- AntiFlashPlayer caching proxy
+#- Copyright (C) 2013  Orochimarufan
+#-                 Authors: Orochimarufan <orochimarufan.x3@gmail.com>
+#-
+#- This program is free software: you can redistribute it and/or modify
+#- it under the terms of the GNU General Public License as published by
+#- the Free Software Foundation, either version 3 of the License, or
+#- (at your option) any later version.
+#-
+#- This program is distributed in the hope that it will be useful,
+#- but WITHOUT ANY WARRANTY; without even the implied warranty of
+#- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#- GNU General Public License for more details.
+#-
+#- You should have received a copy of the GNU General Public License
+#- along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+"""
+A local HTTP server that sits between the media player and YouTube.
+
+Remote videos are fetched in the byte ranges the player asks for and kept in
+a sparse file per video, so seeking back and replaying is served from disk.
+Local files are served as they are. Both support HTTP Range requests.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import os
+import re
+import json
+import uuid
+import errno
+import socket
+import logging
+import mimetypes
+import threading
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.request import Request, urlopen
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urllib2 import Request, urlopen
+
+
+logger = logging.getLogger("afproxy")
+
+# bytes to transfer at a time
+bytecount = 64 * 1024
+# write the range index to disk every n bytes
+index_interval = 4 * 1024 * 1024
+
+default_folder = os.path.join(os.path.expanduser("~"), ".cache", "antiflashplayer", "proxy")
+default_size = 2048 * 1024 * 1024
+
+
+#------------------------------------------------------------
+# Range Cache
+#------------------------------------------------------------
+class RangeCache(object):
+    """
+    A sparse file holding the parts of a remote resource fetched so far.
+
+    The byte ranges present are kept in a json index next to the data file.
+    """
+    def __init__(self, folder, key):
+        self.key        = key
+        self.data_path  = os.path.join(folder, key + ".data")
+        self.index_path = os.path.join(folder, key + ".json")
+        self.length     = None
+        self.mimetype   = None
+        self.ranges     = list()
+        self.lock       = threading.Lock()
+        self.refs       = 0
+        self._unsaved   = 0
+
+        if os.path.exists(self.index_path) and os.path.exists(self.data_path):
+            try:
+                with open(self.index_path) as fp:
+                    index = json.load(fp)
+                self.length   = index["length"]
+                self.mimetype = index.get("mimetype")
+                self.ranges   = [tuple(r) for r in index["ranges"]]
+            except (ValueError, KeyError):
+                logger.warning("Discarding corrupt cache index: %s" % self.index_path)
+                self.ranges   = list()
+            self.fp = open(self.data_path, "r+b")
+        else:
+            self.fp = open(self.data_path, "w+b")
+
+    def cached(self, pos):
+        """ Returns the end of the cached run starting at pos, or None """
+        for start, end in self.ranges:
+            if start <= pos < end:
+                return end
+            if start > pos:
+                break
+
+    def next_cached(self, pos):
+        """ Returns the start of the first cached run after pos, or None """
+        for start, end in self.ranges:
+            if start > pos:
+                return start
+
+    def read(self, pos, size):
+        with self.lock:
+            self.fp.seek(pos)
+            return self.fp.read(size)
+
+    def write(self, pos, data):
+        with self.lock:
+            self.fp.seek(pos)
+            self.fp.write(data)
+            self._add(pos, pos + len(data))
+            self._unsaved += len(data)
+            if self._unsaved >= index_interval:
+                self._save()
+
+    def _add(self, start, end):
+        ranges = list()
+        for s, e in self.ranges:
+            if e < start or s > end:
+                ranges.append((s, e))
+            else:
+                start, end = min(s, start), max(e, end)
+        ranges.append((start, end))
+        ranges.sort()
+        self.ranges = ranges
+
+    def size(self):
+        return sum(e - s for s, e in self.ranges)
+
+    def _save(self):
+        self.fp.flush()
+        with open(self.index_path, "w") as fp:
+            json.dump({"length": self.length, "mimetype": self.mimetype,
+                       "ranges": self.ranges}, fp)
+        self._unsaved = 0
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def close(self):
+        self.save()
+        self.fp.close()
+
+
+class CacheStore(object):
+    """ A folder of RangeCaches limited to max_size bytes, evicted LRU """
+    def __init__(self, folder=default_folder, max_size=default_size):
+        self.folder   = folder
+        self.max_size = max_size
+        self.entries  = dict()
+        self.lock     = threading.Lock()
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def open(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = RangeCache(self.folder, key)
+            entry.refs += 1
+        # mtime of the index is our LRU timestamp
+        entry.save()
+        self.evict()
+        return entry
+
+    def release(self, entry):
+        with self.lock:
+            entry.refs -= 1
+            if entry.refs > 0:
+                return
+            del self.entries[entry.key]
+        entry.close()
+        self.evict()
+
+    def evict(self):
+        """ Remove the least recently used entries until we are below max_size """
+        with self.lock:
+            candidates = list()
+            total = 0
+            for fn in os.listdir(self.folder):
+                if not fn.endswith(".json"):
+                    continue
+                key = fn[:-5]
+                if key in self.entries:
+                    total += self.entries[key].size()
+                    continue
+                path = os.path.join(self.folder, fn)
+                try:
+                    with open(path) as fp:
+                        size = sum(e - s for s, e in json.load(fp)["ranges"])
+                    mtime = os.path.getmtime(path)
+                except (ValueError, KeyError, OSError, IOError):
+                    size, mtime = 0, 0
+                total += size
+                candidates.append((mtime, key, size))
+            candidates.sort()
+            for mtime, key, size in candidates:
+                if total <= self.max_size:
+                    break
+                logger.debug("Evicting %s (%i bytes)" % (key, size))
+                for ext in (".json", ".data"):
+                    try:
+                        os.remove(os.path.join(self.folder, key + ext))
+                    except OSError:
+                        pass
+                total -= size
+
+
+#------------------------------------------------------------
+# Sources
+#------------------------------------------------------------
+class FileSource(object):
+    """ Serves a file from disk """
+    def __init__(self, path, mimetype=None):
+        self.path     = path
+        self.mimetype = mimetype or mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    def get_length(self):
+        return os.path.getsize(self.path)
+
+    def iter_range(self, start, end):
+        with open(self.path, "rb") as fp:
+            fp.seek(start)
+            while start < end:
+                buf = fp.read(min(bytecount, end - start))
+                if not buf:
+                    break
+                start += len(buf)
+                yield buf
+
+    def release(self):
+        pass
+
+
+class RemoteSource(object):
+    """ Serves a remote url through a RangeCache """
+    content_range = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+    def __init__(self, store, key, url, mimetype=None):
+        self.store  = store
+        self.url    = url
+        self.entry  = store.open(key)
+        if mimetype:
+            self.entry.mimetype = mimetype
+
+    @property
+    def mimetype(self):
+        return self.entry.mimetype or "application/octet-stream"
+
+    def _fetch(self, start, end=None):
+        req = Request(self.url)
+        req.add_header("Range", "bytes=%i-%s" % (start, end - 1 if end else ""))
+        fp = urlopen(req)
+        info = fp.info()
+        if self.entry.length is None:
+            match = self.content_range.match(info.get("Content-Range", ""))
+            if match:
+                self.entry.length = int(match.group(3))
+            elif start == 0:
+                self.entry.length = int(info["Content-Length"])
+            if self.entry.mimetype is None:
+                self.entry.mimetype = info.get("Content-Type")
+        if start != 0 and not info.get("Content-Range"):
+            fp.close()
+            raise IOError("Upstream server ignored our Range request")
+        return fp
+
+    def get_length(self):
+        if self.entry.length is None:
+            self._fetch(0, 1).close()
+        return self.entry.length
+
+    def iter_range(self, start, end):
+        entry = self.entry
+        while start < end:
+            cached_end = entry.cached(start)
+            if cached_end is not None:
+                stop = min(cached_end, end)
+                while start < stop:
+                    buf = entry.read(start, min(bytecount, stop - start))
+                    if not buf:
+                        return
+                    start += len(buf)
+                    yield buf
+            else:
+                stop = min(entry.next_cached(start) or end, end)
+                with self._fetch(start, stop) as fp:
+                    while start < stop:
+                        buf = fp.read(min(bytecount, stop - start))
+                        if not buf:
+                            raise IOError("Upstream connection closed early")
+                        entry.write(start, buf)
+                        start += len(buf)
+                        yield buf
+
+    def release(self):
+        self.store.release(self.entry)
+
+
+#------------------------------------------------------------
+# HTTP Server
+#------------------------------------------------------------
+class ProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    range_header = re.compile(r"bytes=(\d*)-(\d*)$")
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_HEAD(self):
+        self.handle_request(False)
+
+    def do_GET(self):
+        self.handle_request(True)
+
+    def handle_request(self, body):
+        source = self.server.sources.get(self.path.lstrip("/"))
+        if source is None:
+            self.send_error(404)
+            return
+        try:
+            length = source.get_length()
+        except (IOError, OSError):
+            logger.exception("Cannot open %s" % self.path)
+            self.send_error(502)
+            return
+
+        start, end = 0, length
+        match = self.range_header.match(self.headers.get("Range", "").strip())
+        if match and (match.group(1) or match.group(2)):
+            first, last = match.groups()
+            if not first:
+                start = max(0, length - int(last))
+            else:
+                start = int(first)
+                if last:
+                    end = min(int(last) + 1, length)
+            if start >= end:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%i" % length)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %i-%i/%i" % (start, end - 1, length))
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", source.mimetype)
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+
+        if not body:
+            return
+        try:
+            for buf in source.iter_range(start, end):
+                self.wfile.write(buf)
+        except (IOError, OSError, socket.error) as e:
+            # EPIPE/ECONNRESET: the player hung up, usually because it seeked
+            if getattr(e, "errno", None) not in (errno.EPIPE, errno.ECONNRESET):
+                logger.exception("Error while serving %s" % self.path)
+            self.close_connection = True
+
+
+class ProxyServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Proxy(object):
+    """ Manages the proxy server thread and the resources it serves """
+    def __init__(self, folder=default_folder, max_size=default_size, port=0):
+        self.store  = CacheStore(folder, max_size)
+        self.server = ProxyServer(("127.0.0.1", port), ProxyHandler)
+        self.server.sources = dict()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="afproxy")
+        self.thread.daemon = True
+        self.thread.start()
+        logger.debug("Proxy listening on port %i" % self.server.server_address[1])
+
+    def _register(self, source, filename):
+        token = "%s/%s" % (uuid.uuid4().hex, filename)
+        self.server.sources[token] = source
+        return token, "http://127.0.0.1:%i/%s" % (self.server.server_address[1], token)
+
+    def serve_url(self, key, url, filename="video", mimetype=None):
+        """
+        Serve a remote url, caching it under key.
+        The url may change (e.g. expired signatures) as long as the key doesn't.
+        Returns (token, local_url)
+        """
+        return self._register(RemoteSource(self.store, key, url, mimetype), filename)
+
+    def serve_file(self, path, mimetype=None):
+        """ Serve a local file. Returns (token, local_url) """
+        return self._register(FileSource(path, mimetype), os.path.basename(path))
+
+    def release(self, token):
+        source = self.server.sources.pop(token, None)
+        if source is not None:
+            source.release()
+
+    def stop(self):
+        self.server.shutdown()
+        for token in list(self.server.sources):
+            self.release(token)
+        self.server.server_close()
+
+
+__all__ = ["Proxy", "CacheStore", "RangeCache"]
@@ -60,6 +60,14 @@ import subprocess
 import copy
 import platform
 import string
+import threading
+import collections
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 try:
     import readline
@@ -68,6 +76,9 @@ except ImportError:
 else:
     HAS_READLINE=True
 
+# Subtitle Cache
+subtitle_cache  = os.path.join(os.path.expanduser("~"), ".cache", "antiflashplayer", "subtitles")
+
 # Filename Rules
 allow_spaces    = False
 allow_invalid   = False
@@ -111,6 +122,146 @@ class TempFile(io.TextIOWrapper):
             self.tempfile.close()
         self.tempfile.unlink() #get rid of it, close() should do the work on *NIX systems, but bsts.
 
+# Resolve Cache
+class ResolveCache(object):
+    """ A thread-safe LRU cache whose entries expire after ttl seconds """
+    def __init__(self, size=32, ttl=1800):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = collections.OrderedDict()
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                stamp, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if time.time() - stamp > self.ttl:
+                return default
+            self._data[key] = (stamp, value)
+            return value
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time(), value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    def __len__(self):
+        return len(self._data)
+
+class Resolver(object):
+    """
+    Looks up video_info and subtitle tracks through a ResolveCache.
+    prefetch() resolves in background threads; a lookup of an entry that is
+    still being resolved waits for that result instead of resolving twice.
+    """
+    def __init__(self, cache=None, workers=2):
+        self.cache = cache if cache is not None else ResolveCache()
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._inflight = dict()
+        self._queue = None
+    def _get(self, key, func, *a):
+        while True:
+            with self._lock:
+                value = self.cache.get(key)
+                if value is not None:
+                    return value
+                event = self._inflight.get(key)
+                if event is None:
+                    event = self._inflight[key] = threading.Event()
+                    break
+            event.wait()
+        try:
+            value = func(*a)
+            if value is not None:
+                self.cache.set(key, value)
+            return value
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+    def video_info(self, video_id):
+        return self._get(("video_info", video_id), resolve3, video_id)
+    def subtitles(self, video_id):
+        return self._get(("subtitles", video_id), getSubTracks, video_id)
+    def prefetch(self, video_id, subtitles=False):
+        if self._queue is None:
+            self._queue = queue.Queue()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name="afp-prefetch-%i" % i)
+                thread.daemon = True
+                thread.start()
+        self._queue.put((video_id, subtitles))
+    def _worker(self):
+        while True:
+            video_id, subtitles = self._queue.get()
+            try:
+                self.video_info(video_id)
+                if subtitles:
+                    self.subtitles(video_id)
+            except Exception:
+                # the foreground lookup will run into it again and report it
+                logging.getLogger("afp").debug("prefetch of %s failed" % video_id, exc_info=True)
+
+def in_background(func, *a):
+    """ Run func(*a) in a thread. Returns a function that waits for the result """
+    result = dict()
+    def run():
+        try:
+            result["value"] = func(*a)
+        except Exception:
+            result["error"] = sys.exc_info()[1]
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    def wait():
+        thread.join()
+        if "error" in result:
+            raise result["error"]
+        return result["value"]
+    return wait
+
+def fetch_subtitles(video_id, resolver, lang=None):
+    """
+    Get a SRT file for video_id, converting the track in lang (or the first one).
+    SRT files are kept in subtitle_cache as <id>.<language>.srt, an empty
+    <id>[.<language>].none means there are none
+    Returns (language, filename) or None
+    """
+    key = tofilename(lang) if lang else None
+    marker = os.path.join(subtitle_cache, "{0}.{1}.none".format(video_id, key) if key else "{0}.none".format(video_id))
+    if os.path.exists(subtitle_cache):
+        if key:
+            filename = os.path.join(subtitle_cache, "{0}.{1}.srt".format(video_id, key))
+            if os.path.exists(filename):
+                return lang, filename
+        else:
+            for fn in sorted(os.listdir(subtitle_cache)):
+                if fn.startswith(video_id + ".") and fn.endswith(".srt"):
+                    return fn[len(video_id)+1:-4], os.path.join(subtitle_cache, fn)
+        if os.path.exists(marker):
+            return None
+    tracks = resolver.subtitles(video_id)
+    if lang:
+        tracks = [t for t in tracks if lang.lower() in (getattr(t, "lang_code", "").lower(), t.lang_original.lower())]
+    if not os.path.exists(subtitle_cache):
+        os.makedirs(subtitle_cache)
+    if len(tracks)<1:
+        # so we don't ask again every time it's played
+        io.open(marker, "w").close()
+        return None
+    track = tracks[0]
+    srt = track.getSRT()
+    filename = os.path.join(subtitle_cache, "{0}.{1}.srt".format(video_id, key or tofilename(track.lang_original)))
+    with io.open(filename + ".part", "w", encoding="utf-8") as fp:
+        fp.write(srt)
+    os.rename(filename + ".part", filename)
+    return track.lang_original, filename
+
 def welcome():
     print("AntiFlashPlayer for YouTube {0} (libyo {1})".format(version, libyo.version))
     print("(c) 2011-2012 by Orochimarufan")
@@ -139,15 +290,32 @@ def main(ARGC,ARGV):
     parser.add_argument("-n","--not-quiet",dest="quiet",action="store_false",default=True,help="Show Media Player Output")
     parser.add_argument("-x","--xspf",dest="xspf",action="store_true",default=False,help="Don't Play the URL directly, but create a XSPF Playlist and play that. (With Title Information etc.)")
     parser.add_argument("-s","--sub",dest="sub",action="store_true",default=False,help="Enable Subtitles (use %%s in the cmd for subtitlefile)")
+    parser.add_argument("-l","--lang",metavar="LANG",dest="lang",default=None,help="Subtitle Language (code or name) [Default: the first one]")
     parser.add_argument("-i","--internal",dest="int",action="store_true",default=False,help="Treat VideoID as AFP internal command\nUse '%(prog)s -i help' for more Informations.")
     parser.add_argument("-v","--verbose",dest="verbose",action="store_true",default=False,help="Output more Details")
+    parser.add_argument("-P","--proxy",dest="proxy",action="store_true",default=False,help="Play through a local caching proxy (Seeking and replaying won't re-download)")
+    parser.add_argument("--proxy-cache",metavar="DIR",dest="proxy_cache",default=None,help="Where the proxy keeps its cache [Default: ~/.cache/antiflashplayer/proxy]")
+    parser.add_argument("--proxy-size",metavar="MB",dest="proxy_size",type=int,default=2048,help="Maximum size of the proxy cache [Default: %(default)sMB]")
+    parser.add_argument("-D","--database",metavar="DB",dest="database",default=None,help="A YouFeed Database. Videos downloaded by YouFeed are played from disk.")
+    parser.add_argument("-p","--playlist",dest="playlist",action="store_true",default=False,help="Treat VideoID as the ID of a Playlist in the YouFeed Database (-D) and play it")
+    parser.add_argument("--lookahead",metavar="N",dest="lookahead",type=int,default=2,help="Resolve N Playlist items ahead of playback [Default: %(default)s]")
+    parser.add_argument("--profile",metavar="DIR",dest="profile_dir",default=None,help="Profile AFP: write cProfile stats and tracemalloc snapshots to DIR")
     #parser.add_argument("-s","--shell",dest="shell",action="store_true",default=False,help="Run internal Shell")
     args    = parser.parse_args(ARGV[1:])
     args.id = args.id.lstrip("\\")
     args.prog = parser.prog
 
+    if args.profile_dir:
+        from yfmetrics import Profiler
+        with Profiler(args.profile_dir):
+            return dispatch(args)
+    return dispatch(args)
+
+def dispatch(args):
     if args.int:
         return internal_cmd(args)
+    elif args.playlist:
+        return play_playlist(args)
     #elif args.shell:
     #    return afp_shell(args)
     else:
@@ -183,7 +351,108 @@ def internal_cmd(args):
         return 1
     return 0
 
-def process(args):
+class LocalInfo(object):
+    """ Provides the video_info fields we use for a YouFeed LocalVideo """
+    def __init__(self, local):
+        video = local.video
+        self.video_id    = local.video_id
+        self.title       = video.title or local.video_id
+        self.uploader    = video.author.name if video.author is not None else ""
+        self.description = video.description or ""
+
+def open_yfdb(args):
+    """ Open the YouFeed Database given by -D """
+    if getattr(args, "db", None) is None:
+        import yfdb
+        if not os.path.exists(args.database):
+            raise IOError("YouFeed Database does not exist: {0}".format(args.database))
+        args.db = yfdb.DB.open(args.database)
+    return args.db
+
+def find_local(args, video_id, fmt_request):
+    """ Look for a file YouFeed downloaded in one of the requested formats """
+    if not args.database:
+        return None
+    import yfdb
+    db = open_yfdb(args)
+    root = os.path.dirname(db.sqlite_file)
+    session = db.Session()
+    try:
+        candidates = session.query(yfdb.LocalVideo).\
+                filter(yfdb.LocalVideo.video_id == video_id).\
+                filter(yfdb.LocalVideo.fmt.in_(fmt_request)).all()
+        candidates.sort(key=lambda v: fmt_request.index(v.fmt))
+        for local in candidates:
+            path = os.path.normpath(os.path.join(root, local.location))
+            if os.path.exists(path):
+                return path, local.fmt, LocalInfo(local)
+    finally:
+        session.close()
+
+def get_proxy(args):
+    """ Start the caching proxy (once) """
+    if getattr(args, "proxy_server", None) is None:
+        import afproxy
+        args.proxy_server = afproxy.Proxy(args.proxy_cache or afproxy.default_folder,
+                                          args.proxy_size * 1024 * 1024)
+        args.proxy_server.start()
+    return args.proxy_server
+
+def make_fmt_request(args):
+    """ The list of acceptable fmt values, best first """
+    fmt_map = profiles.profiles[cichoice.unify(args.avc)][0]
+    if args.fmt is None and not args.force:
+        return [fmt_map[i] for i in (1080,720,480,360,240) if i in fmt_map and i<=qchoice.unify(args.quality)]
+    elif args.fmt is not None:
+        return [args.fmt]
+    elif args.force:
+        return [fmt_map[qchoice.unify(args.quality)]]
+
+def play_playlist(args):
+    """
+    Play a YouFeed Playlist in order.
+    Items YouFeed downloaded are played from disk, the others are resolved
+    args.lookahead items ahead of playback
+    """
+    if not args.database:
+        print("ERROR: Playlist mode requires a YouFeed Database (-D)")
+        return 1
+    import yfdb
+    db = open_yfdb(args)
+    session = db.Session()
+    playlist = session.query(yfdb.Playlist).get(args.id)
+    if playlist is None:
+        print("ERROR: Unknown Playlist: {0}".format(args.id))
+        return 1
+    print("Playing \"{0}\" by {1}".format(playlist.title, playlist.user_name))
+    video_ids = [item.video_id for item in session.query(yfdb.PlaylistItem).\
+            filter(yfdb.PlaylistItem.playlist_id == playlist.id).\
+            order_by(yfdb.PlaylistItem.index.asc()).all()]
+    session.close()
+
+    if args.proxy:
+        get_proxy(args)
+    fmt_request = make_fmt_request(args)
+    resolver = Resolver()
+    prefetched = set()
+    for i, video_id in enumerate(video_ids):
+        for ahead in video_ids[i+1:i+1+args.lookahead]:
+            if ahead not in prefetched and find_local(args, ahead, fmt_request) is None:
+                resolver.prefetch(ahead, args.sub)
+            prefetched.add(ahead)
+        print("[{0}/{1}] ".format(i+1, len(video_ids)), end="")
+        item_args = copy.copy(args)
+        item_args.id = video_id
+        item_args.extract_url = False
+        try:
+            process(item_args, resolver)
+        except YouTubeException:
+            print(sys.exc_info()[1])
+    return 0
+
+def process(args, resolver=None):
+    if resolver is None:
+        resolver = Resolver()
     if args.extract_url:
         args.url=args.id
         try:
@@ -191,51 +460,69 @@ def process(args):
         except AttributeError:
             print("ERROR: invalid URL")
             return
-    fmt_map = profiles.profiles[cichoice.unify(args.avc)][0]
-    if args.fmt is None and not args.force:
-        fmt_request   = [fmt_map[i] for i in (1080,720,480,360,240) if i in fmt_map and i<=qchoice.unify(args.quality)]
-    elif args.fmt is not None:
-        fmt_request   = [args.fmt]
-    elif args.force:
-        fmt_request   = [fmt_map[qchoice.unify(args.quality)]]
+    # subtitles don't depend on the video url, get them while we resolve
+    if args.sub:
+        subtitles = in_background(fetch_subtitles, args.id, resolver, args.lang)
+    fmt_request = make_fmt_request(args)
 
     print("Receiving Video with ID '{0}'".format(args.id))
-    video_info = resolve3(args.id)
-    if not video_info:
-        print("ERROR: Could not find Video (Maybe your Internet connection is down?)")
-        return 1
-
-    print("Found Video: \"{0}\"".format(video_info.title))
-    print("Searching for a video url: {0}p ({1})".format(qchoice.unify(args.quality),args.avc))
-    if (args.verbose):
-        print("Requested FMT: [{0}]".format(",".join(str(k) for k in fmt_request)))
-        print("Available FMT: [{0}]".format(",".join(str(k) for k in video_info.urlmap.keys())))
-    for fmt in fmt_request:
-        if fmt in video_info.urlmap:
-            url = video_info.fmt_url(fmt)
-            break
-    else:
-        print("ERROR: Could not find a video url matching your request. maybe try another profile?")
-        return 1
-    if args.verbose:
-        print("Found FMT: {0} ({1})".format(fmt,profiles.descriptions[fmt]))
+    local = find_local(args, args.id, fmt_request)
+    if local:
+        url, fmt, video_info = local
+        print("Found local Video: \"{0}\" ({1})".format(video_info.title,profiles.descriptions[fmt]))
+        if args.verbose:
+            print("Local File: "+url)
     else:
-        print("Found a Video URL: {0}".format(profiles.descriptions[fmt]))
+        video_info = resolver.video_info(args.id)
+        if not video_info:
+            print("ERROR: Could not find Video (Maybe your Internet connection is down?)")
+            return 1
+
+        print("Found Video: \"{0}\"".format(video_info.title))
+        print("Searching for a video url: {0}p ({1})".format(qchoice.unify(args.quality),args.avc))
+        if (args.verbose):
+            print("Requested FMT: [{0}]".format(",".join(str(k) for k in fmt_request)))
+            print("Available FMT: [{0}]".format(",".join(str(k) for k in video_info.urlmap.keys())))
+        for fmt in fmt_request:
+            if fmt in video_info.urlmap:
+                url = video_info.fmt_url(fmt)
+                break
+        else:
+            print("ERROR: Could not find a video url matching your request. maybe try another profile?")
+            return 1
+        if args.verbose:
+            print("Found FMT: {0} ({1})".format(fmt,profiles.descriptions[fmt]))
+        else:
+            print("Found a Video URL: {0}".format(profiles.descriptions[fmt]))
+
+    #Proxy
+    proxy_token = None
+    if args.proxy:
+        proxy = get_proxy(args)
+        if local:
+            proxy_token, url = proxy.serve_file(url)
+        else:
+            proxy_token, url = proxy.serve_url("{0}-{1}".format(args.id,fmt), url,
+                "{0}.{1}".format(args.id,profiles.file_extensions[fmt]))
+        if args.verbose:
+            print("Proxy URL: "+url)
 
     #Subtitles
     subtitle_file=""
     if args.sub:
         print("Looking for Subtitles",end="\r")
-        tracks = getSubTracks(args.id)
-        if len(tracks)<1:
+        try:
+            found = subtitles()
+        except Exception:
+            # no reason not to play it anyway
+            print("ERROR: Could not get Subtitles: {0}".format(sys.exc_info()[1]))
+            logging.getLogger("afp").debug("subtitles for %s failed" % args.id, exc_info=True)
+            found = None
+        if found is None:
             print("No Subtitles Found!  ")
         else:
-            track = tracks[0]
-            print("Enabling Subtitles: "+track.lang_original)
-            srtfile = TempFile("afpSubtitle_",".srt")
-            srtfile.write(track.getSRT())
-            srtfile.unlock()
-            subtitle_file = srtfile.name
+            print("Enabling Subtitles: "+found[0])
+            subtitle_file = found[1]
 
     #XSPF File
     if args.xspf:
@@ -271,23 +558,35 @@ def process(args):
     subprocess.call(argv,stdout=out_fp,stderr=out_fp)
     if args.xspf:
         temp.dispose()
+    if proxy_token is not None:
+        proxy.release(proxy_token)
     return 0
 
 def afp_shell(args):
     my_args = copy.copy(args)
     running = True
+    resolver = Resolver()
+    playqueue = collections.deque()
     parser = LibyoArgumentParser(prog="AFP Shell",may_exit=False,autoprint_usage=False,error_handle=sys.stdout)
-    parser.add_argument("id",help="VideoID / URL / literals '+exit', '+pass', '+print'", metavar="OPERATION")
-    parser.add_argument("-s","--switches",dest="switches",help="Set enabled switches (u,x,f,n,v,s)",choices=switchchoice(["u","x","f","n","v","s"]),metavar="SW")
+    parser.add_argument("id",help="VideoID / URL / literals '+exit', '+pass', '+print', '+queue', '+next', '+play', '+flush'", metavar="OPERATION")
+    parser.add_argument("ids",help="VideoIDs / URLs to add to the queue (+queue)",nargs="*",metavar="ID")
+    parser.add_argument("-s","--switches",dest="switches",help="Set enabled switches (u,x,f,n,v,s,p)",choices=switchchoice(["u","x","f","n","v","s","p"]),metavar="SW")
     parser.add_argument("-a","--avc",dest="avc",help="Set Profile",choices=cichoice(profiles.profiles.keys()),metavar="PROFILE")
     parser.add_argument("-q","--quality",dest="quality",help="Set Quality Level",choices=qchoice.new(1080,720,480,360,240))
     parser.add_argument("-c","--cmd",dest="command",help="set command")
+    parser.add_argument("-l","--lang",dest="lang",help="Set Subtitle Language")
     if HAS_READLINE:
         readline.parse_and_bind("\eA: previous-history")
         readline.parse_and_bind("\eB: next-history")
     else:
         print("WARNING: No Readline extension found. Readline functionality will NOT be available. If you're on Windows you might want to consider PyReadline.")
-    sw = my_args.switches = ("u" if args.extract_url else "")+("x" if args.xspf else "")+("f" if args.force else"")+("n" if not args.quiet else "")+("v" if args.verbose else "")+("s" if args.sub else "")
+    sw = my_args.switches = ("u" if args.extract_url else "")+("x" if args.xspf else "")+("f" if args.force else"")+("n" if not args.quiet else "")+("v" if args.verbose else "")+("s" if args.sub else "")+("p" if args.proxy else "")
+    def play(video_id):
+        my_args.id = video_id
+        try:
+            process(my_args, resolver)
+        except YouTubeException:
+            print(sys.exc_info()[1])
     while running:
         line = input("{0}> ".format(args.prog))
         try:
@@ -302,20 +601,51 @@ def afp_shell(args):
             my_args.quiet = "n" not in my_args.switches
             my_args.verbose = "v" in my_args.switches
             my_args.sub = "s" in my_args.switches
+            my_args.proxy = "p" in my_args.switches
             sw = my_args.switches
         if my_args.id =="+pass":
             continue
         elif my_args.id == "+print":
-            print("Switches: [{0}]\nProfile: {1}p {2}\nCommand: {3}".format(my_args.switches,my_args.quality,my_args.avc,my_args.command))
+            print("Switches: [{0}]\nProfile: {1}p {2}\nCommand: {3}\nSubtitles: {4}".format(my_args.switches,my_args.quality,my_args.avc,my_args.command,my_args.lang or "first"))
+            print("Queue: [{0}]\nCached: {1}".format(",".join(playqueue),len(resolver.cache)))
+            continue
+        elif my_args.id == "+queue":
+            for video_id in my_args.ids:
+                if my_args.extract_url:
+                    try:
+                        video_id = getIdFromUrl(video_id)
+                    except AttributeError:
+                        print("ERROR: invalid URL: {0}".format(video_id))
+                        continue
+                playqueue.append(video_id)
+                resolver.prefetch(video_id, my_args.sub)
+            print("Queue: [{0}]".format(",".join(playqueue)))
+            continue
+        elif my_args.id in ("+next", "+play"):
+            operation = my_args.id
+            if my_args.ids:
+                print("ERROR: {0} takes no IDs, use '+queue' to add them".format(operation))
+                continue
+            if not playqueue:
+                print("Queue is empty.")
+            # ids in the queue are already extracted from their URLs
+            extract_url, my_args.extract_url = my_args.extract_url, False
+            try:
+                while playqueue:
+                    play(playqueue.popleft())
+                    if operation == "+next":
+                        break
+            finally:
+                my_args.extract_url = extract_url
+            continue
+        elif my_args.id == "+flush":
+            resolver.cache.clear()
             continue
         elif my_args.id == "+exit":
             running = False
             break
         else:
-            try:
-                process(my_args)
-            except YouTubeException:
-                print(sys.exc_info()[1])
+            play(my_args.id)
     #end while
     return 0
 
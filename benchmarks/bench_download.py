@@ -0,0 +1,241 @@
+#!/usr/bin/python3
+#-------------------------------------------------------------------------------
+#- YouFeed download benchmark
+#- Copyright (C) 2013  Orochimarufan
+#-                 Authors: Orochimarufan <orochimarufan.x3@gmail.com>
+#-
+#- This program is free software: you can redistribute it and/or modify
+#- it under the terms of the GNU General Public License as published by
+#- the Free Software Foundation, either version 3 of the License, or
+#- (at your option) any later version.
+#-
+#- This program is distributed in the hope that it will be useful,
+#- but WITHOUT ANY WARRANTY; without even the implied warranty of
+#- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#- GNU General Public License for more details.
+#-
+#- You should have received a copy of the GNU General Public License
+#- along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+"""
+Benchmark of youfeed's run_download against fileserver's injected faults.
+
+For every fault profile, file size and concurrency, a child process downloads
+a batch of files with run_download (each worker thread with its own session)
+while the server counts requests and bytes. Reported per scenario:
+
+    goodput     bytes of complete, correct files per second of wall time
+    retries     requests beyond the first per file
+    refetched   bytes the server sent that did not end up in a good file
+    cpu_per_mb  CPU seconds of the downloading process per MB stored
+    failed      downloads run_download gave up on
+    corrupt     files run_download stored that don't match the content
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import datetime
+import threading
+import subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+sys.path.insert(0, root)
+sys.path.insert(0, here)
+
+import fileserver
+from bench_sync import git_revision, versions, Namespace
+
+
+#------------------------------------------------------------
+# Scenario (runs in a child process)
+#------------------------------------------------------------
+def md5file(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as fp:
+        for buf in iter(lambda: fp.read(1 << 20), b""):
+            md5.update(buf)
+    return md5.hexdigest()
+
+
+def run_scenario(scenario):
+    import resource
+    import youfeed
+    import yfdb
+
+    tmp = tempfile.mkdtemp(prefix="yf_bench_")
+    try:
+        db = yfdb.DB.open(os.path.join(tmp, "youfeed.db"))
+        db.setOptionValue("playlists_folder", "playlists")
+        db.setOptionValue("videos_folder", "videos")
+        args = Namespace(db=db, root=tmp, p=False, d=False)
+
+        session = db.Session()
+        video_ids = ["bench%06i" % i for i in range(scenario["files"])]
+        for video_id in video_ids:
+            session.add(yfdb.Video(id=video_id, title=video_id))
+        session.commit()
+        session.close()
+
+        pending = list(reversed(video_ids))
+        results = dict()
+        lock = threading.Lock()
+
+        def worker():
+            session = db.Session()
+            while True:
+                with lock:
+                    if not pending:
+                        break
+                    video_id = pending.pop()
+                video = session.query(yfdb.Video).get(video_id)
+                url = "%s/file/%i/%s" % (scenario["base"], scenario["size"], video_id)
+                local = youfeed.run_download(args, session, video, url, scenario["fmt"])
+                results[video_id] = local.location if local is not None else None
+            session.close()
+
+        stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+        usage0 = resource.getrusage(resource.RUSAGE_SELF)
+        t0 = time.time()
+        try:
+            threads = [threading.Thread(target=worker) for i in range(scenario["concurrency"])]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            wall = time.time() - t0
+            usage1 = resource.getrusage(resource.RUSAGE_SELF)
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        expected = fileserver.expected_digest(scenario["size"])
+        good = failed = corrupt = 0
+        for video_id, location in results.items():
+            if location is None:
+                failed += 1
+            elif md5file(os.path.join(tmp, location)) != expected:
+                corrupt += 1
+            else:
+                good += 1
+    finally:
+        shutil.rmtree(tmp)
+
+    return dict(wall=wall, good=good, failed=failed, corrupt=corrupt,
+                cpu=(usage1.ru_utime - usage0.ru_utime) + (usage1.ru_stime - usage0.ru_stime))
+
+
+#------------------------------------------------------------
+# Driver
+#------------------------------------------------------------
+def server_stats(server):
+    with server.lock:
+        return dict(server.stats)
+
+
+def run(profile, spec, size, concurrency, files, fmt):
+    faults = fileserver.Faults.parse(spec)
+    server = fileserver.FileServer(faults).start()
+    try:
+        scenario = dict(base=server.base, size=size, concurrency=concurrency, files=files, fmt=fmt)
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "-child", json.dumps(scenario)],
+                                stdout=subprocess.PIPE)
+        out = proc.communicate()[0]
+        if proc.returncode != 0:
+            raise RuntimeError("Scenario failed: %r" % scenario)
+        child = json.loads(out.decode("utf8").strip().splitlines()[-1])
+        stats = server_stats(server)
+    finally:
+        server.stop()
+
+    stored = child["good"] * size
+    sent = stats.get("bytes_sent", 0)
+    return dict(
+        params=dict(profile=profile, faults=faults.as_dict(), size=size, concurrency=concurrency, files=files),
+        wall=child["wall"],
+        goodput=stored / child["wall"] if child["wall"] else 0,
+        requests=stats.get("requests", 0),
+        retries=stats.get("requests", 0) - files,
+        errors_injected=stats.get("errors", 0),
+        disconnects=stats.get("disconnects", 0),
+        bytes_sent=sent,
+        refetched=sent - stored,
+        cpu_per_mb=child["cpu"] / (stored / float(1 << 20)) if stored else None,
+        good=child["good"], failed=child["failed"], corrupt=child["corrupt"])
+
+
+def compare(old, new):
+    """ Print the relative change between two result files """
+    def key(r):
+        p = r["params"]
+        return (p["profile"], p["size"], p["concurrency"])
+    old_results = dict((key(r), r) for r in old["results"])
+    print("Comparing %s (old) with %s (new)" % (old.get("commit"), new.get("commit")))
+    for result in new["results"]:
+        was = old_results.get(key(result))
+        if was is None:
+            continue
+        print("%-10s size=%-9i c=%-2i goodput %7.2f -> %7.2f MB/s  retries %4i -> %4i  refetched %6.1f -> %6.1f MB" % (
+            key(result) + (was["goodput"] / (1 << 20), result["goodput"] / (1 << 20), was["retries"], result["retries"],
+            was["refetched"] / float(1 << 20), result["refetched"] / float(1 << 20))))
+
+
+def intlist(s):
+    return [int(i) for i in s.split(",")]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0], description="youfeed download benchmark with fault injection")
+    parser.add_argument("-profiles", default=",".join(sorted(fileserver.PROFILES)),
+                        help="Fault profiles to run: %s" % ", ".join(sorted(fileserver.PROFILES)))
+    parser.add_argument("-faults", default="", help="Run a custom fault spec instead, e.g. throttle=2M,disconnect=0.3")
+    parser.add_argument("-sizes", default="1M,16M", help="File sizes [%(default)s]")
+    parser.add_argument("-concurrency", type=intlist, default=[1, 4], help="Parallel downloads [1,4]")
+    parser.add_argument("-files", type=int, default=16, help="Files per scenario [%(default)s]")
+    parser.add_argument("-fmt", type=int, default=18, help="fmt to record the downloads as [%(default)s]")
+    parser.add_argument("-o", dest="output", help="Write the results to this json file")
+    parser.add_argument("-compare", metavar="JSON", help="Compare the results with an earlier result file")
+    parser.add_argument("-child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv[1:])
+
+    if args.child:
+        print(json.dumps(run_scenario(json.loads(args.child))))
+        return 0
+
+    if args.faults:
+        profiles = [("custom", args.faults)]
+    else:
+        profiles = [(name, fileserver.PROFILES[name]) for name in args.profiles.split(",")]
+
+    results = list()
+    for name, spec in profiles:
+        for size in map(fileserver.parse_size, args.sizes.split(",")):
+            for concurrency in args.concurrency:
+                r = run(name, spec, size, concurrency, args.files, args.fmt)
+                results.append(r)
+                print("%-10s size=%-9i c=%-2i %7.2f MB/s  retries=%-3i refetched=%7.1f MB  cpu=%s s/MB  good=%i failed=%i corrupt=%i" % (
+                    name, size, concurrency, r["goodput"] / (1 << 20), r["retries"], r["refetched"] / float(1 << 20),
+                    "%.3f" % r["cpu_per_mb"] if r["cpu_per_mb"] is not None else "-",
+                    r["good"], r["failed"], r["corrupt"]))
+
+    report = dict(commit=git_revision(), date=datetime.datetime.utcnow().isoformat(),
+                  versions=versions(), results=results)
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(json.load(fp), report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
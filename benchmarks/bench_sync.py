@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+#-------------------------------------------------------------------------------
+#- YouFeed sync benchmark
+#- Copyright (C) 2013  Orochimarufan
+#-                 Authors: Orochimarufan <orochimarufan.x3@gmail.com>
+#-
+#- This program is free software: you can redistribute it and/or modify
+#- it under the terms of the GNU General Public License as published by
+#- the Free Software Foundation, either version 3 of the License, or
+#- (at your option) any later version.
+#-
+#- This program is distributed in the hope that it will be useful,
+#- but WITHOUT ANY WARRANTY; without even the implied warranty of
+#- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#- GNU General Public License for more details.
+#-
+#- You should have received a copy of the GNU General Public License
+#- along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+"""
+Offline benchmark of youfeed's sync path.
+
+Drives run_sync, run_playlist and run_mkplaylist against a scratch yfdb and
+the synthetic feeds of gdata_server. Each scenario runs in its own process so
+its peak RSS can be reported. For every phase it records wall time, queries
+issued, HTTP requests and the bytes the server sent; the results are written as json so runs on
+different commits can be compared with -compare.
+
+Phases:
+    sync        first run_sync of the playlist (everything is new)
+    resync      run_sync of the unchanged playlist (the nightly case)
+    playlist    run_playlist in -d mode
+    mkplaylist  run_mkplaylist
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import datetime
+import platform
+import subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+sys.path.insert(0, root)
+sys.path.insert(0, here)
+
+import gdata_server
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=root,
+                                       stderr=subprocess.STDOUT).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def peak_rss_kb():
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on OS X, kilobytes everywhere else
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+#------------------------------------------------------------
+# Scenario (runs in a child process)
+#------------------------------------------------------------
+class Namespace(object):
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+
+def http_stats(base):
+    """ (requests, bytes sent) so far """
+    from urllib.request import urlopen
+    with urlopen(base + "/_stats") as fp:
+        stats = json.loads(fp.read().decode("utf8"))
+    return stats.get("total", 0), stats.get("bytes", 0)
+
+
+def run_scenario(scenario):
+    import youfeed
+    import yfdb
+    from sqlalchemy import event
+
+    youfeed.gdata_url = scenario["gdata_url"]
+    base = scenario["gdata_url"].rsplit("/feeds/api/", 1)[0]
+
+    tmp = tempfile.mkdtemp(prefix="yf_bench_")
+    try:
+        db = yfdb.DB.open(os.path.join(tmp, "youfeed.db"))
+        db.setOptionValue("playlists_folder", "playlists")
+        db.setOptionValue("videos_folder", "videos")
+
+        queries = [0]
+        @event.listens_for(db.engine, "before_cursor_execute")
+        def count(*a):
+            queries[0] += 1
+
+        args = Namespace(db=db, root=tmp, p=False, d=True, forceall=False, names=[])
+        session = db.Session()
+        job = yfdb.Job(name="bench", type="playlist", playlist_id=scenario["playlist_id"], status=0)
+        session.add(job)
+        session.commit()
+
+        phases = dict()
+        def phase(name, func, *a):
+            q0, h0 = queries[0], http_stats(base)
+            t0 = time.time()
+            stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+            try:
+                result = func(*a)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            h1 = http_stats(base)
+            phases[name] = dict(wall=time.time() - t0,
+                                queries=queries[0] - q0,
+                                http=h1[0] - h0[0],
+                                wire=h1[1] - h0[1])
+            return result
+
+        playlist = phase("sync", youfeed.run_sync, args, session, job)
+        playlist = phase("resync", youfeed.run_sync, args, session, job)
+
+        # pretend some videos were downloaded already, so mkplaylist has work
+        local = int(scenario["size"] * scenario["local"])
+        if local:
+            items = session.query(yfdb.PlaylistItem).\
+                filter(yfdb.PlaylistItem.playlist_id == playlist.id).\
+                order_by(yfdb.PlaylistItem.index.asc()).limit(local).all()
+            lookup_table = youfeed.make_job_qa(args, job)
+            for item in items:
+                session.add(yfdb.LocalVideo(video_id=item.video_id, fmt=lookup_table[0],
+                    location="videos/%s.mp4" % item.video_id, created="2013-01-01T00:00:00"))
+            session.commit()
+
+        vids = phase("playlist", youfeed.run_playlist, args, session, job, playlist)
+        phase("mkplaylist", youfeed.run_mkplaylist, args, session, job, playlist, vids)
+        session.close()
+    finally:
+        shutil.rmtree(tmp)
+
+    return dict(phases=phases, peak_rss_kb=peak_rss_kb())
+
+
+#------------------------------------------------------------
+# Driver
+#------------------------------------------------------------
+def spawn(scenario):
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "-child", json.dumps(scenario)],
+                            stdout=subprocess.PIPE)
+    out = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise RuntimeError("Scenario failed: %r" % scenario)
+    return json.loads(out.decode("utf8").strip().splitlines()[-1])
+
+
+def versions():
+    info = dict(python=platform.python_version())
+    for name in ("libyo", "sqlalchemy"):
+        try:
+            module = __import__(name)
+            info[name] = getattr(module, "__version__", None) or getattr(module, "version", None)
+        except ImportError:
+            info[name] = None
+    return info
+
+
+def compare(old, new):
+    """ Print the relative change between two result files """
+    def key(result):
+        p = result["params"]
+        return (p["size"], p["page_size"], p["users"], p["latency"])
+    old_results = dict((key(r), r) for r in old["results"])
+    print("Comparing %s (old) with %s (new)" % (old.get("commit"), new.get("commit")))
+    for result in new["results"]:
+        base = old_results.get(key(result))
+        if base is None:
+            continue
+        print("size=%i page=%i users=%i latency=%gms" % key(result))
+        for name, phase in sorted(result["phases"].items()):
+            was = base["phases"].get(name)
+            if not was:
+                continue
+            print("  %-10s wall %8.3fs -> %8.3fs (%+6.1f%%)  queries %7i -> %7i  http %5i -> %5i  wire %9.1f -> %9.1f kB" % (name,
+                was["wall"], phase["wall"], (phase["wall"] / was["wall"] - 1) * 100 if was["wall"] else 0,
+                was["queries"], phase["queries"], was["http"], phase["http"],
+                was.get("wire", 0) / 1024., phase["wire"] / 1024.))
+        print("  peak rss   %i kB -> %i kB" % (base["peak_rss_kb"], result["peak_rss_kb"]))
+
+
+def intlist(s):
+    return [int(i) for i in s.split(",")]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0], description="Offline youfeed sync benchmark")
+    parser.add_argument("-sizes", type=intlist, default=[100, 1000, 10000, 50000], help="Playlist sizes [100,1000,10000,50000]")
+    parser.add_argument("-page", type=int, default=50, help="Feed page size [%(default)s]")
+    parser.add_argument("-users", type=intlist, default=[50], help="Uploader cardinalities [50]")
+    parser.add_argument("-latency", type=float, default=0, help="Server latency per request in ms [%(default)s]")
+    parser.add_argument("-compress", action="store_true", help="Have the server gzip its answers")
+    parser.add_argument("-local", type=float, default=0.5, help="Fraction of videos that are already downloaded [%(default)s]")
+    parser.add_argument("-o", dest="output", help="Write the results to this json file")
+    parser.add_argument("-compare", metavar="JSON", help="Compare the results with an earlier result file")
+    parser.add_argument("-child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv[1:])
+
+    if args.child:
+        print(json.dumps(run_scenario(json.loads(args.child))))
+        return 0
+
+    results = list()
+    for size in args.sizes:
+        for users in args.users:
+            config = gdata_server.Config(size, args.page, users, args.latency / 1000., compress=args.compress)
+            server = gdata_server.GDataServer(config).start()
+            try:
+                scenario = dict(size=size, local=args.local, gdata_url=server.gdata_url,
+                                playlist_id="%s%i" % (config.prefix, size))
+                result = spawn(scenario)
+            finally:
+                server.stop()
+            params = config.as_dict()
+            params["latency"] = args.latency
+            params["local"] = args.local
+            result["params"] = params
+            results.append(result)
+
+            print("size=%i page=%i users=%i latency=%gms peak_rss=%ikB" % (size, args.page, users, args.latency, result["peak_rss_kb"]))
+            for name in ("sync", "resync", "playlist", "mkplaylist"):
+                phase = result["phases"][name]
+                print("  %-10s %8.3fs %7i queries %5i http %9.1f kB" % (name, phase["wall"], phase["queries"], phase["http"],
+                                                                     phase["wire"] / 1024.))
+
+    report = dict(commit=git_revision(), date=datetime.datetime.utcnow().isoformat(),
+                  versions=versions(), results=results)
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(json.load(fp), report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+#-------------------------------------------------------------------------------
+#- YouFeed worker check
+#- Copyright (C) 2013  Orochimarufan
+#-                 Authors: Orochimarufan <orochimarufan.x3@gmail.com>
+#-
+#- This program is free software: you can redistribute it and/or modify
+#- it under the terms of the GNU General Public License as published by
+#- the Free Software Foundation, either version 3 of the License, or
+#- (at your option) any later version.
+#-
+#- This program is distributed in the hope that it will be useful,
+#- but WITHOUT ANY WARRANTY; without even the implied warranty of
+#- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#- GNU General Public License for more details.
+#-
+#- You should have received a copy of the GNU General Public License
+#- along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+"""
+Several 'youfeed worker -once' processes on one scratch SQLite database.
+
+Every job points at a playlist of gdata_server, and all of those playlists
+have the same videos, so the workers compete for every single download. The
+"resolved" urls point at fileserver, which is throttled so the downloads
+overlap. With -kill, one worker is SIGKILLed in the middle of the run; once
+its leases have expired, the jobs are made due again and a fresh worker has to
+pick up what the dead one left.
+
+The check fails (exit status 1) if a video/fmt was stored twice, if the file
+server was asked for more files than were stored, or if videos are missing
+at the end.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import argparse
+import tempfile
+import datetime
+import subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+sys.path.insert(0, root)
+sys.path.insert(0, here)
+
+import gdata_server
+import fileserver
+import yfdb
+from bench_sync import git_revision, versions
+
+
+#------------------------------------------------------------
+# Worker (runs in a child process)
+#------------------------------------------------------------
+def run_worker(setup, argv):
+    """ youfeed main, with the feeds and the resolver pointed at the local servers """
+    import youfeed
+    youfeed.gdata_url = setup["gdata_url"]
+    fmts = set()
+    for profile in youfeed.ytprofiles.profiles.values():
+        fmts.update(profile[0].values())
+    for n in range(1, setup["size"] + 1):
+        video_id = gdata_server.video_id(n)
+        url = "%s/file/%i/%s" % (setup["file_base"], setup["file_size"], video_id)
+        youfeed.resolve_cache[video_id] = (time.time() + 3600, dict((fmt, url) for fmt in fmts))
+    return youfeed.main(["youfeed"] + argv)
+
+
+#------------------------------------------------------------
+# Driver
+#------------------------------------------------------------
+def start_worker(setup, database, ttl, log):
+    argv = ["-db", database, "-noserve", "worker", "-once", "-ttl", str(ttl)]
+    # unbuffered, so the log of a killed worker is complete
+    env = dict(os.environ, PYTHONUNBUFFERED="1")
+    with open(log, "ab") as fp:
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__), "-child", json.dumps(setup)] + argv,
+                                stdout=fp, stderr=subprocess.STDOUT, env=env)
+
+
+def count_lines(log, text):
+    with open(log) as fp:
+        return sum(1 for line in fp if text in line)
+
+
+def run(args):
+    feeds = gdata_server.GDataServer(gdata_server.Config(args.size, 50, 10, args.latency / 1000.)).start()
+    files = fileserver.FileServer(fileserver.Faults.parse(args.faults)).start()
+    tmp = tempfile.mkdtemp(prefix="yf_workers_")
+    database = os.path.join(tmp, "youfeed.db")
+    setup = dict(gdata_url=feeds.gdata_url, file_base=files.base, file_size=args.file_size, size=args.size)
+    try:
+        # the jobs
+        with open(os.devnull, "w") as null:
+            for i in range(args.jobs):
+                subprocess.check_call([sys.executable, os.path.abspath(__file__), "-child", json.dumps(setup),
+                                       "-db", database, "-noserve", "job", "add", "job%02i" % i, "playlist",
+                                       "PLbench%02i" % i, "-noidcheck"], stdout=null, stderr=subprocess.STDOUT)
+
+        t0 = time.time()
+        logs = [os.path.join(tmp, "worker%i.log" % i) for i in range(args.workers)]
+        workers = [start_worker(setup, database, args.ttl, log) for log in logs]
+
+        killed = None
+        if args.kill:
+            time.sleep(args.kill)
+            killed = workers[0]
+            killed.send_signal(signal.SIGKILL)
+        for worker in workers:
+            worker.wait()
+        wall = time.time() - t0
+
+        db = yfdb.DB.open(database)
+        if killed is not None:
+            # let the dead worker's leases expire, then make the jobs due again
+            session = db.Session()
+            stale = session.query(yfdb.Lease).count()
+            time.sleep(args.ttl + 1)
+            for schedule in session.query(yfdb.PlaylistSchedule):
+                schedule.next_check = 0
+            session.commit()
+            session.close()
+            log = os.path.join(tmp, "recovery.log")
+            logs.append(log)
+            start_worker(setup, database, args.ttl, log).wait()
+        else:
+            stale = 0
+
+        session = db.Session()
+        stored = dict()
+        for local in session.query(yfdb.LocalVideo):
+            key = (local.video_id, local.fmt)
+            stored[key] = stored.get(key, 0) + 1
+        leases = session.query(yfdb.Lease).count()
+        synced = session.query(yfdb.SyncRecord).count()
+        session.close()
+        with files.lock:
+            requests = files.stats.get("requests", 0)
+        claimed = [count_lines(log, "[WORKER] Claimed job") for log in logs]
+        skipped = [count_lines(log, "being downloaded by another worker") for log in logs]
+    finally:
+        feeds.stop()
+        files.stop()
+        if not args.keep:
+            shutil.rmtree(tmp)
+        else:
+            print("Kept %s" % tmp)
+
+    return dict(
+        params=dict(workers=args.workers, jobs=args.jobs, size=args.size, file_size=args.file_size,
+                    faults=args.faults, ttl=args.ttl, kill=args.kill),
+        wall=wall,
+        stored=len(stored),
+        duplicates=sum(n - 1 for n in stored.values()),
+        missing=args.size - len(stored),
+        file_requests=requests,
+        syncs=synced,
+        claimed=claimed,
+        skipped=skipped,
+        leases_left=leases,
+        leases_at_kill=stale)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0], description="youfeed worker lease check with several processes")
+    parser.add_argument("-workers", type=int, default=3, help="Worker processes [%(default)s]")
+    parser.add_argument("-jobs", type=int, default=6, help="Jobs, all on playlists with the same videos [%(default)s]")
+    parser.add_argument("-size", type=int, default=20, help="Videos per playlist [%(default)s]")
+    parser.add_argument("-file-size", dest="file_size", type=fileserver.parse_size, default="1M",
+                        help="Size of each video [1M]")
+    parser.add_argument("-faults", default="throttle=4M", help="fileserver faults [%(default)s]")
+    parser.add_argument("-latency", type=float, default=20, help="GData response latency in ms [%(default)s]")
+    parser.add_argument("-ttl", type=int, default=5, help="Worker lease ttl in seconds [%(default)s]")
+    parser.add_argument("-kill", type=float, metavar="SECONDS",
+                        help="SIGKILL the first worker after SECONDS and check that its work is picked up")
+    parser.add_argument("-keep", action="store_true", help="Keep the scratch directory")
+    parser.add_argument("-o", dest="output", help="Write the result to this json file")
+
+    # -child SETUP (youfeed commandline)
+    if argv[1:2] == ["-child"]:
+        return run_worker(json.loads(argv[2]), argv[3:])
+    args = parser.parse_args(argv[1:])
+
+    r = run(args)
+    print("workers=%i jobs=%i size=%i wall=%.2fs stored=%i duplicates=%i missing=%i file_requests=%i syncs=%i" % (
+        args.workers, args.jobs, args.size, r["wall"], r["stored"], r["duplicates"], r["missing"],
+        r["file_requests"], r["syncs"]))
+    print("jobs claimed per worker: %s, downloads left to others: %s, leases left: %i" % (
+        r["claimed"], r["skipped"], r["leases_left"]))
+
+    report = dict(commit=git_revision(), date=datetime.datetime.utcnow().isoformat(),
+                  versions=versions(), result=r)
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+
+    ok = not r["duplicates"] and not r["missing"] and not r["leases_left"]
+    # a killed worker may have been half way through a file
+    if not args.kill:
+        ok = ok and r["file_requests"] == r["stored"]
+    print("[ %s ]" % ("OK" if ok else "FAIL"))
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
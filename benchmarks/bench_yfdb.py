@@ -0,0 +1,340 @@
+#!/usr/bin/python3
+#-------------------------------------------------------------------------------
+#- yfdb microbenchmarks
+#- Copyright (C) 2013  Orochimarufan
+#-                 Authors: Orochimarufan <orochimarufan.x3@gmail.com>
+#-
+#- This program is free software: you can redistribute it and/or modify
+#- it under the terms of the GNU General Public License as published by
+#- the Free Software Foundation, either version 3 of the License, or
+#- (at your option) any later version.
+#-
+#- This program is distributed in the hope that it will be useful,
+#- but WITHOUT ANY WARRANTY; without even the implied warranty of
+#- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#- GNU General Public License for more details.
+#-
+#- You should have received a copy of the GNU General Public License
+#- along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+"""
+Microbenchmarks of the yfdb operations youfeed depends on, at production scale.
+
+A database with 1M videos, 2M playlist items, 500k local videos and 50k users
+(times -scale) is populated once. Every operation is then timed on a fresh
+copy of it, once with sqlite's default settings and once with tuned PRAGMAs:
+
+    add_head/add_middle/add_tail    addPlaylistVideo on a big playlist
+    get_option                      getOptionValue
+    local_lookup                    the LocalVideo query of run_video
+    export_items                    the PlaylistItem query of export_command
+    export_local                    the per-item LocalVideo query of export_command
+    job_list                        the query of 'job list'
+    v2import                        v2import_command ingesting a pl/ folder
+
+Writes are rolled back, so each repetition sees the same database.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import datetime
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+sys.path.insert(0, root)
+sys.path.insert(0, here)
+
+from bench_sync import git_revision, versions, Namespace
+
+
+# production volumes
+VOLUMES = dict(videos=1000000, playlist_videos=2000000, local=500000, users=50000,
+               playlists=20000, jobs=300)
+
+# size of the playlist addPlaylistVideo is run on
+BIG_PLAYLIST = 10000
+
+SETTINGS = {
+    "default": (),
+    "tuned": ("PRAGMA journal_mode=WAL",
+              "PRAGMA synchronous=NORMAL",
+              "PRAGMA cache_size=-65536",
+              "PRAGMA temp_store=MEMORY",
+              "PRAGMA mmap_size=268435456"),
+}
+
+FMTS = (37, 22, 35, 18, 5)
+
+
+def video_id(n):
+    return "v%010i" % n
+
+def user_id(n):
+    return "u%021i" % n
+
+def playlist_id(n):
+    return "PL%016i" % n
+
+
+#------------------------------------------------------------
+# Population
+#------------------------------------------------------------
+def chunked(iterable, size=20000):
+    chunk = list()
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+
+
+def populate(filename, volumes):
+    """ Fill a new yfdb with synthetic rows using bulk inserts """
+    import yfdb
+    db = yfdb.DB.open(filename)
+    engine = db.engine
+    rnd = random.Random(42)
+    v = volumes
+
+    def insert(table, rows):
+        for chunk in chunked(rows):
+            engine.execute(table.insert(), chunk)
+
+    t0 = time.time()
+    insert(yfdb.User.__table__, (dict(id=user_id(i), username="user%i" % i, name="User %i" % i, status=0)
+                                 for i in range(v["users"])))
+    insert(yfdb.Video.__table__, (dict(id=video_id(i), user_id=user_id(i % v["users"]), title="Video %i" % i,
+                                       description="Description of video %i" % i, categories="Education",
+                                       keywords="bench, %i" % i, uploaded="2012-01-01T00:00:00.000Z",
+                                       duration=60 + i % 3600, status=0,
+                                       thumbnails='[["120", "90", "0", "http://i.ytimg.com/vi/%s/default.jpg"]]' % video_id(i))
+                                  for i in range(v["videos"])))
+    insert(yfdb.Playlist.__table__, (dict(id=playlist_id(i), title="Playlist %i" % i, user_id=user_id(i % v["users"]),
+                                          user_name="user%i" % (i % v["users"]), status=0)
+                                     for i in range(v["playlists"])))
+
+    # playlist 0 is the big one, the rest is spread evenly
+    def items():
+        big = min(BIG_PLAYLIST, v["playlist_videos"])
+        for i in range(big):
+            yield dict(playlist_id=playlist_id(0), index=i, video_id=video_id(rnd.randrange(v["videos"])))
+        rest = v["playlist_videos"] - big
+        per = max(1, rest // max(1, v["playlists"] - 1))
+        for i in range(rest):
+            yield dict(playlist_id=playlist_id(1 + i // per), index=i % per, video_id=video_id(rnd.randrange(v["videos"])))
+    insert(yfdb.PlaylistItem.__table__, items())
+
+    insert(yfdb.LocalVideo.__table__, (dict(video_id=video_id(i * v["videos"] // v["local"]), fmt=FMTS[i % len(FMTS)],
+                                            location="videos/%s-%032x-%i.mp4" % (video_id(i), i, FMTS[i % len(FMTS)]),
+                                            created="2013-01-01T00:00:00", status=0)
+                                       for i in range(v["local"])))
+    insert(yfdb.Job.__table__, (dict(name=("v2import_job%i" if i % 10 == 0 else "job%i") % i, type="playlist",
+                                     playlist_id=playlist_id(i % v["playlists"]), status=0)
+                                for i in range(v["jobs"])))
+    db.setOptionValue("playlists_folder", "playlists")
+    db.setOptionValue("videos_folder", "videos")
+    return time.time() - t0
+
+
+def make_v2_pldir(folder, volumes, playlists=10, items=100):
+    """ A youfeed v2 pl/ folder with playlists of items, half of them downloaded """
+    pldir = os.path.join(folder, "pl")
+    dldir = os.path.join(folder, "v2videos")
+    os.makedirs(pldir)
+    os.makedirs(dldir)
+    n = volumes["videos"]
+    for p in range(playlists):
+        meta = dict(meta=dict(playlist_id="v2bench%04i" % p, author="user%i" % p, name="v2 Playlist %i" % p,
+                              description="imported"),
+                    local=list(), downloads=dict())
+        for i in range(items):
+            vid = "w%010i" % (p * items + i)
+            meta["local"].append(dict(id=vid, title="v2 Video %s" % vid, category="Music", description="old",
+                                      tags=["v2", "bench"], uploaded="2011-01-01T00:00:00.000Z",
+                                      thumbnail=dict(sqDefault="http://i.ytimg.com/vi/%s/default.jpg" % vid,
+                                                     hqDefault="http://i.ytimg.com/vi/%s/hqdefault.jpg" % vid),
+                                      duration=120, uploader="user%i" % ((p * items + i) % volumes["users"])))
+            if i % 2 == 0:
+                path = os.path.join(dldir, "%s.mp4" % vid)
+                open(path, "wb").close()
+                meta["downloads"][vid] = dict(path=path, fmt=18, type="mp4")
+        with open(os.path.join(pldir, "v2bench%04i.plm" % p), "w") as fp:
+            json.dump(meta, fp)
+    return pldir
+
+
+#------------------------------------------------------------
+# Operations
+#------------------------------------------------------------
+def stats(times):
+    times = sorted(times)
+    n = len(times)
+    return dict(n=n, mean=sum(times) / n, median=times[n // 2], p95=times[min(n - 1, int(n * .95))],
+                min=times[0], max=times[-1])
+
+
+def timed(func, repeat):
+    times = list()
+    for i in range(repeat):
+        t0 = time.time()
+        func(i)
+        times.append(time.time() - t0)
+    return stats(times)
+
+
+def run_setting(filename, setting, volumes, repeat, workdir):
+    import youfeed
+    import yfdb
+    from sqlalchemy import event
+
+    db = yfdb.DB.open(filename)
+    @event.listens_for(db.engine, "connect")
+    def pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in SETTINGS[setting]:
+            cursor.execute(pragma)
+        cursor.close()
+
+    rnd = random.Random(7)
+    results = dict()
+    lookup_table = [37, 22, 35, 18, 5]
+    big = min(BIG_PLAYLIST, volumes["playlist_videos"])
+
+    def add(index):
+        def op(i):
+            session = db.Session()
+            try:
+                db.addPlaylistVideo(playlist_id(0), video_id(rnd.randrange(volumes["videos"])), index, session=session)
+                session.flush()
+            finally:
+                session.rollback()
+                session.close()
+        return op
+
+    for name, index in (("add_head", 0), ("add_middle", big // 2), ("add_tail", big)):
+        try:
+            results[name] = timed(add(index), repeat)
+        except Exception as e:
+            results[name] = dict(error="%s: %s" % (type(e).__name__, str(e).splitlines()[0]))
+
+    results["get_option"] = timed(lambda i: db.getOptionValue("videos_folder"), repeat * 10)
+
+    session = db.Session()
+    def local_lookup(i):
+        session.query(yfdb.LocalVideo).\
+            filter(yfdb.LocalVideo.video_id == video_id(rnd.randrange(volumes["videos"]))).\
+            filter(yfdb.LocalVideo.fmt.in_(lookup_table)).all()
+    results["local_lookup"] = timed(local_lookup, repeat)
+
+    def export_items(i):
+        session.query(yfdb.PlaylistItem).filter(yfdb.PlaylistItem.playlist_id == playlist_id(i % volumes["playlists"])).\
+            filter(yfdb.PlaylistItem.index >= 1).all()
+    results["export_items"] = timed(export_items, repeat)
+
+    def export_local(i):
+        session.query(yfdb.LocalVideo).filter(yfdb.LocalVideo.video_id == video_id(rnd.randrange(volumes["videos"]))).\
+            filter(yfdb.LocalVideo.fmt.in_(lookup_table)).order_by(yfdb.LocalVideo.fmt.desc()).first()
+    results["export_local"] = timed(export_local, repeat)
+
+    def job_list(i):
+        session.query(yfdb.Job).filter(~yfdb.Job.name.startswith("v2import_")).all()
+    results["job_list"] = timed(job_list, repeat)
+    session.close()
+
+    # v2import changes the database for good, so it goes last
+    pldir = make_v2_pldir(os.path.join(workdir, "v2_" + setting), volumes)
+    args = Namespace(db=db, root=os.path.dirname(filename), pldir=pldir, move=False)
+    cwd = os.getcwd()
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        results["v2import"] = timed(lambda i: youfeed.v2import_command(args), 1)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        os.chdir(cwd)
+
+    db.engine.dispose()
+    return results
+
+
+#------------------------------------------------------------
+# Driver
+#------------------------------------------------------------
+def print_results(results):
+    for setting, ops in sorted(results.items()):
+        print("[%s]" % setting)
+        for name, r in sorted(ops.items()):
+            if "error" in r:
+                print("  %-14s ERROR %s" % (name, r["error"]))
+            else:
+                print("  %-14s n=%-5i median %9.3fms  p95 %9.3fms  max %9.3fms" % (
+                    name, r["n"], r["median"] * 1000, r["p95"] * 1000, r["max"] * 1000))
+
+
+def compare(old, new):
+    print("Comparing %s (old) with %s (new), median times" % (old.get("commit"), new.get("commit")))
+    for setting, ops in sorted(new["results"].items()):
+        print("[%s]" % setting)
+        for name, r in sorted(ops.items()):
+            was = old["results"].get(setting, {}).get(name)
+            if not was or "error" in was or "error" in r:
+                continue
+            print("  %-14s %9.3fms -> %9.3fms (%+6.1f%%)" % (name, was["median"] * 1000, r["median"] * 1000,
+                  (r["median"] / was["median"] - 1) * 100 if was["median"] else 0))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0], description="yfdb microbenchmarks")
+    parser.add_argument("-scale", type=float, default=1.0, help="Scale the production volumes [%(default)s]")
+    parser.add_argument("-repeat", type=int, default=20, help="Repetitions per operation [%(default)s]")
+    parser.add_argument("-settings", default="default,tuned", help="sqlite settings to run [%(default)s]")
+    parser.add_argument("-keep", metavar="DIR", help="Keep/reuse the populated database in DIR")
+    parser.add_argument("-o", dest="output", help="Write the results to this json file")
+    parser.add_argument("-compare", metavar="JSON", help="Compare the results with an earlier result file")
+    args = parser.parse_args(argv[1:])
+
+    volumes = dict((k, max(1, int(n * args.scale))) for k, n in VOLUMES.items())
+    workdir = tempfile.mkdtemp(prefix="yf_bench_")
+    try:
+        folder = args.keep or workdir
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        template = os.path.join(folder, "yfdb_bench_%g.db" % args.scale)
+        populated = None
+        if not os.path.exists(template):
+            print("Populating %s: %s" % (template, ", ".join("%s=%i" % i for i in sorted(volumes.items()))))
+            populated = populate(template, volumes)
+            print("Populated in %.1fs" % populated)
+
+        results = dict()
+        for setting in args.settings.split(","):
+            filename = os.path.join(workdir, "%s.db" % setting)
+            shutil.copy(template, filename)
+            results[setting] = run_setting(filename, setting, volumes, args.repeat, workdir)
+    finally:
+        shutil.rmtree(workdir)
+
+    print_results(results)
+    report = dict(commit=git_revision(), date=datetime.datetime.utcnow().isoformat(), versions=versions(),
+                  volumes=volumes, populate_time=populated, results=results)
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(json.load(fp), report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+#-------------------------------------------------------------------------------
+#- Fault-injecting file server
+#- Copyright (C) 2013  Orochimarufan
+#-                 Authors: Orochimarufan <orochimarufan.x3@gmail.com>
+#-
+#- This program is free software: you can redistribute it and/or modify
+#- it under the terms of the GNU General Public License as published by
+#- the Free Software Foundation, either version 3 of the License, or
+#- (at your option) any later version.
+#-
+#- This program is distributed in the hope that it will be useful,
+#- but WITHOUT ANY WARRANTY; without even the implied warranty of
+#- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#- GNU General Public License for more details.
+#-
+#- You should have received a copy of the GNU General Public License
+#- along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+"""
+A local range-capable HTTP file server that misbehaves on purpose.
+
+GET /file/<size>/<name> serves <size> bytes of synthetic content; the byte at
+offset o is content_block[o % len(content_block)], see expected_digest().
+
+Faults (all optional, see Faults):
+    throttle    limit each connection to n bytes/s
+    first_byte  wait n seconds before sending the response
+    disconnect  probability of dropping a connection in the middle of the body
+    error_rate  probability of starting a burst of 403/5xx responses
+    error_burst length of such a burst
+    lie         advertise a Content-Length that is off by n bytes (but send
+                the real content), then close the connection
+
+GET /_stats returns the counters as json.
+"""
+
+from __future__ import print_function
+
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+
+content_block = bytes(bytearray(random.Random(0x796f7566).getrandbits(8) for i in range(65521)))
+chunk_size = 64 * 1024
+
+
+def content(start, end):
+    """ The synthetic content between start and end """
+    block = len(content_block)
+    parts = list()
+    while start < end:
+        offset = start % block
+        n = min(block - offset, end - start)
+        parts.append(content_block[offset:offset + n])
+        start += n
+    return b"".join(parts)
+
+
+def expected_digest(size):
+    """ md5 of a complete file of size bytes """
+    md5 = hashlib.md5()
+    for start in range(0, size, 1 << 20):
+        md5.update(content(start, min(start + (1 << 20), size)))
+    return md5.hexdigest()
+
+
+def parse_size(s):
+    """ 64k, 16M, 1G, 123 """
+    s = str(s).strip()
+    mult = {"k": 1 << 10, "m": 1 << 20, "g": 1 << 30}.get(s[-1:].lower())
+    return int(float(s[:-1]) * mult) if mult else int(float(s))
+
+
+class Faults(object):
+    """ What goes wrong """
+    def __init__(self, throttle=0, first_byte=0.0, disconnect=0.0, error_rate=0.0,
+                 error_burst=1, lie=0, seed=1):
+        self.throttle    = throttle
+        self.first_byte  = first_byte
+        self.disconnect  = disconnect
+        self.error_rate  = error_rate
+        self.error_burst = error_burst
+        self.lie         = lie
+        self.seed        = seed
+
+    @classmethod
+    def parse(cls, spec):
+        """ throttle=2M,disconnect=0.3,... """
+        kw = dict()
+        for item in filter(None, spec.split(",")):
+            key, value = item.split("=", 1)
+            if key in ("throttle", "lie", "error_burst", "seed"):
+                kw[key] = parse_size(value)
+            else:
+                kw[key] = float(value)
+        return cls(**kw)
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+# named fault profiles
+PROFILES = {
+    "clean":        "",
+    "throttled":    "throttle=4M",
+    "slowstart":    "first_byte=2",
+    "disconnect":   "disconnect=0.3",
+    "errors":       "error_rate=0.2,error_burst=3",
+    "liar":         "lie=4096",
+    "hostile":      "throttle=8M,first_byte=0.5,disconnect=0.2,error_rate=0.1,error_burst=2",
+}
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    range_header = re.compile(r"bytes=(\d*)-(\d*)$")
+    path_re = re.compile(r"/file/(\d+)(/.*)?$")
+
+    def log_message(self, format, *args):
+        pass
+
+    def count(self, key, n=1):
+        with self.server.lock:
+            self.server.stats[key] = self.server.stats.get(key, 0) + n
+
+    def do_GET(self):
+        server = self.server
+        faults = server.faults
+
+        if self.path == "/_stats":
+            with server.lock:
+                body = json.dumps(server.stats).encode("utf8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        match = self.path_re.match(self.path)
+        if not match:
+            self.send_error(404)
+            return
+        size = int(match.group(1))
+        self.count("requests")
+
+        with server.lock:
+            if server.burst > 0:
+                server.burst -= 1
+                error = True
+            elif server.random.random() < faults.error_rate:
+                server.burst = faults.error_burst - 1
+                error = True
+            else:
+                error = False
+            disconnect = server.random.random() < faults.disconnect
+            cut = server.random.random()
+
+        if faults.first_byte:
+            time.sleep(faults.first_byte)
+
+        if error:
+            self.count("errors")
+            self.send_error(server.random.choice((403, 500, 502, 503)))
+            return
+
+        start, end = 0, size
+        match = self.range_header.match(self.headers.get("Range", "").strip())
+        if match and (match.group(1) or match.group(2)):
+            first, last = match.groups()
+            if not first:
+                start = max(0, size - int(last))
+            else:
+                start = int(first)
+                if last:
+                    end = min(int(last) + 1, size)
+            if start >= end:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%i" % size)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.count("range_requests")
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %i-%i/%i" % (start, end - 1, size))
+        else:
+            self.send_response(200)
+        length = end - start
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(max(0, length + faults.lie)))
+        self.end_headers()
+
+        stop = start + int(length * cut) if disconnect else end
+        began = time.time()
+        sent = 0
+        try:
+            while start < stop:
+                n = min(chunk_size, stop - start)
+                self.wfile.write(content(start, start + n))
+                start += n
+                sent += n
+                if faults.throttle:
+                    delay = sent / float(faults.throttle) - (time.time() - began)
+                    if delay > 0:
+                        time.sleep(delay)
+        except (IOError, OSError):
+            pass
+        finally:
+            self.count("bytes_sent", sent)
+        if disconnect or faults.lie:
+            if disconnect:
+                self.count("disconnects")
+            self.close_connection = True
+
+
+    def do_HEAD(self):
+        match = self.path_re.match(self.path)
+        if not match:
+            self.send_error(404)
+            return
+        # not counted as a request, those are the downloads
+        self.count("head_requests")
+        self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(max(0, int(match.group(1)) + self.server.faults.lie)))
+        self.end_headers()
+
+
+class FileServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, faults=None, port=0):
+        HTTPServer.__init__(self, ("127.0.0.1", port), FileHandler)
+        self.faults = faults or Faults()
+        self.random = random.Random(self.faults.seed)
+        self.burst  = 0
+        self.lock   = threading.Lock()
+        self.stats  = dict()
+        self.base   = "http://127.0.0.1:%i" % self.server_address[1]
+
+    def url(self, size, name="file"):
+        return "%s/file/%i/%s" % (self.base, size, name)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name="fileserver")
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0], description="Serve synthetic files with injected faults")
+    parser.add_argument("-port", type=int, default=8081)
+    parser.add_argument("-profile", choices=sorted(PROFILES), default="clean", help="Named fault profile")
+    parser.add_argument("-faults", default="", help="Additional faults, e.g. throttle=2M,disconnect=0.3")
+    args = parser.parse_args(argv[1:])
+    faults = Faults.parse(",".join(filter(None, (PROFILES[args.profile], args.faults))))
+    server = FileServer(faults, args.port)
+    print("Serving %s/file/<size>/<name> with faults %r" % (server.base, faults.as_dict()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+#-------------------------------------------------------------------------------
+#- GData v2 stand-in server
+#- Copyright (C) 2013  Orochimarufan
+#-                 Authors: Orochimarufan <orochimarufan.x3@gmail.com>
+#-
+#- This program is free software: you can redistribute it and/or modify
+#- it under the terms of the GNU General Public License as published by
+#- the Free Software Foundation, either version 3 of the License, or
+#- (at your option) any later version.
+#-
+#- This program is distributed in the hope that it will be useful,
+#- but WITHOUT ANY WARRANTY; without even the implied warranty of
+#- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#- GNU General Public License for more details.
+#-
+#- You should have received a copy of the GNU General Public License
+#- along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+"""
+A local HTTP server that serves synthetic YouTube GData v2 Atom documents.
+
+Serves feeds/api/playlists/<id>, feeds/api/users/<id> and feeds/api/videos/<id>
+with the elements youfeed reads. The content is deterministic for a given
+configuration, so runs against it are comparable.
+
+With compress, answers are gzip or deflate encoded if the client accepts it.
+
+GET /_stats returns the request counters (and the body bytes sent) as json.
+"""
+
+from __future__ import print_function
+
+import sys
+import json
+import time
+import zlib
+import argparse
+import threading
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+    from xml.sax.saxutils import escape, quoteattr
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from xml.sax.saxutils import escape, quoteattr
+
+
+NAMESPACES = ('xmlns="http://www.w3.org/2005/Atom" '
+              'xmlns:openSearch="http://a9.com/-/spec/opensearch/1.1/" '
+              'xmlns:media="http://search.yahoo.com/mrss/" '
+              'xmlns:gd="http://schemas.google.com/g/2005" '
+              'xmlns:yt="http://gdata.youtube.com/schemas/2007"')
+
+
+class Config(object):
+    """ What the server serves """
+    def __init__(self, size=1000, page_size=50, users=50, latency=0.0, prefix="PLbench", compress=False):
+        self.size       = size          # number of videos in each playlist
+        self.page_size  = page_size     # entries per feed page
+        self.users      = users         # number of distinct uploaders
+        self.latency    = latency       # seconds to wait before answering
+        self.prefix     = prefix
+        self.compress   = compress      # honor Accept-Encoding
+
+    def as_dict(self):
+        return dict(size=self.size, page_size=self.page_size, users=self.users, latency=self.latency,
+                    compress=self.compress)
+
+
+def video_id(n):
+    return "v%010i" % n
+
+def user_id(n):
+    return "u%021i" % n
+
+
+def user_entry(n):
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<entry %s><id>tag:youtube.com,2008:user:%s</id>'
+            '<title>User %i</title>'
+            '<yt:userId>%s</yt:userId>'
+            '<yt:username display=%s>user%i</yt:username>'
+            '</entry>') % (NAMESPACES, user_id(n), n, user_id(n), quoteattr("User %i" % n), n)
+
+
+def media_group(config, n):
+    uploader = n % config.users
+    return ('<media:group>'
+            '<media:category label="Education" scheme="http://gdata.youtube.com/schemas/2007/categories.cat">Education</media:category>'
+            '<media:credit role="uploader" scheme="urn:youtube" yt:display=%s>user%i</media:credit>'
+            '<media:description type="plain">%s</media:description>'
+            '<media:keywords>bench, video, %i</media:keywords>'
+            '<media:thumbnail url="http://i.ytimg.com/vi/%s/default.jpg" height="90" width="120" time="00:00:30" yt:name="default"/>'
+            '<media:thumbnail url="http://i.ytimg.com/vi/%s/hqdefault.jpg" height="360" width="480" yt:name="hqdefault"/>'
+            '<media:title type="plain">Benchmark Video %i</media:title>'
+            '<yt:duration seconds="%i"/>'
+            '<yt:uploaded>2012-%02i-%02iT12:00:00.000Z</yt:uploaded>'
+            '<yt:uploaderId>UC%s</yt:uploaderId>'
+            '<yt:videoid>%s</yt:videoid>'
+            '</media:group>') % (
+                quoteattr("User %i" % uploader), uploader,
+                escape("Description of video %i. " % n * 8), n,
+                video_id(n), video_id(n), n,
+                60 + (n * 37) % 3600, 1 + n % 12, 1 + n % 28,
+                user_id(uploader), video_id(n))
+
+
+def playlist_feed(config, playlist_id, base, start, count):
+    stop = min(start + count, config.size + 1)
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<feed %s>' % NAMESPACES,
+             '<id>tag:youtube.com,2008:playlist:%s</id>' % playlist_id,
+             '<title>Benchmark Playlist %s</title>' % escape(playlist_id),
+             '<author><name>user0</name><yt:userId>%s</yt:userId></author>' % user_id(0),
+             '<openSearch:totalResults>%i</openSearch:totalResults>' % config.size,
+             '<openSearch:startIndex>%i</openSearch:startIndex>' % start]
+    if stop <= config.size:
+        parts.append('<link rel="next" type="application/atom+xml" href=%s/>' %
+            quoteattr("%s/feeds/api/playlists/%s?start-index=%i&max-results=%i" % (base, playlist_id, stop, count)))
+    for n in range(start, stop):
+        parts.append('<entry><id>tag:youtube.com,2008:playlist:%s:%i</id>%s<yt:position>%i</yt:position></entry>' %
+            (playlist_id, n, media_group(config, n), n))
+    parts.append('</feed>')
+    return "".join(parts)
+
+
+def video_entry(config, n):
+    return ('<?xml version="1.0" encoding="UTF-8"?><entry %s><id>tag:youtube.com,2008:video:%s</id>%s</entry>' %
+            (NAMESPACES, video_id(n), media_group(config, n)))
+
+
+class GDataHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def encoding(self):
+        """ The Content-Encoding to answer with """
+        if not self.server.config.compress:
+            return None
+        accepted = [e.split(";")[0].strip() for e in (self.headers.get("Accept-Encoding") or "").split(",")]
+        for encoding in ("gzip", "deflate"):
+            if encoding in accepted:
+                return encoding
+        return None
+
+    def reply(self, code, body, content_type="application/atom+xml; charset=UTF-8"):
+        """ Send body; returns the bytes sent """
+        body = body.encode("utf8")
+        encoding = self.encoding()
+        if encoding is not None:
+            z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS)
+            body = z.compress(body) + z.flush()
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return len(body)
+
+    def do_GET(self):
+        server = self.server
+        config = server.config
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip("/").split("/")
+
+        if parts == ["_stats"]:
+            with server.lock:
+                return self.reply(200, json.dumps(server.stats), "application/json")
+
+        if config.latency:
+            time.sleep(config.latency)
+
+        kind = parts[2] if len(parts) == 4 and parts[:2] == ["feeds", "api"] else "unknown"
+        with server.lock:
+            server.stats[kind] = server.stats.get(kind, 0) + 1
+            server.stats["total"] = server.stats.get("total", 0) + 1
+
+        if kind == "playlists" and parts[3].startswith(config.prefix):
+            start = int(query.get("start-index", ["1"])[0])
+            count = min(int(query.get("max-results", [config.page_size])[0]), config.page_size)
+            sent = self.reply(200, playlist_feed(config, parts[3], server.base, start, count))
+        elif kind == "users" and parts[3].startswith("u") and int(parts[3][1:]) < config.users:
+            sent = self.reply(200, user_entry(int(parts[3][1:])))
+        elif kind == "videos" and parts[3].startswith("v"):
+            sent = self.reply(200, video_entry(config, int(parts[3][1:])))
+        else:
+            sent = self.reply(404, '<?xml version="1.0" encoding="UTF-8"?><errors xmlns="http://schemas.google.com/g/2005">'
+                            '<error><domain>GData</domain><code>ResourceNotFoundException</code></error></errors>')
+        with server.lock:
+            server.stats["bytes"] = server.stats.get("bytes", 0) + sent
+
+
+class GDataServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, config, port=0):
+        HTTPServer.__init__(self, ("127.0.0.1", port), GDataHandler)
+        self.config = config
+        self.base   = "http://127.0.0.1:%i" % self.server_address[1]
+        self.lock   = threading.Lock()
+        self.stats  = dict()
+
+    @property
+    def gdata_url(self):
+        """ The value for youfeed.gdata_url """
+        return self.base + "/feeds/api/"
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name="gdata-server")
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0], description="Serve synthetic GData v2 feeds")
+    parser.add_argument("-port", type=int, default=8080)
+    parser.add_argument("-size", type=int, default=1000, help="Videos per playlist")
+    parser.add_argument("-page", type=int, default=50, help="Entries per page")
+    parser.add_argument("-users", type=int, default=50, help="Number of distinct uploaders")
+    parser.add_argument("-latency", type=float, default=0, help="Response latency in ms")
+    parser.add_argument("-compress", action="store_true", help="gzip/deflate the answers if the client accepts it")
+    args = parser.parse_args(argv[1:])
+    server = GDataServer(Config(args.size, args.page, args.users, args.latency / 1000., compress=args.compress), args.port)
+    print("Serving on %s (playlist ids start with '%s')" % (server.gdata_url, server.config.prefix))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+#-------------------------------------------------------------------------------
+#- YouFeed import-time budget
+#- Copyright (C) 2013  Orochimarufan
+#-                 Authors: Orochimarufan <orochimarufan.x3@gmail.com>
+#-
+#- This program is free software: you can redistribute it and/or modify
+#- it under the terms of the GNU General Public License as published by
+#- the Free Software Foundation, either version 3 of the License, or
+#- (at your option) any later version.
+#-
+#- This program is distributed in the hope that it will be useful,
+#- but WITHOUT ANY WARRANTY; without even the implied warranty of
+#- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#- GNU General Public License for more details.
+#-
+#- You should have received a copy of the GNU General Public License
+#- along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+"""
+Checks the youfeed fast paths against an import-time budget.
+
+Every command is run under `python -X importtime` against a scratch database.
+It fails if a command takes longer than the budget to import its modules, or
+if it imports any of the modules that only the resolver/download paths need.
+Requires python 3.7+.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+root    = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+youfeed = os.path.join(root, "youfeed.py")
+
+# commands that are called from cron/monitoring
+commands = (
+    ("-V",),
+    ("config", "list"),
+    ("config", "get", "videos_folder"),
+    ("job", "list"),
+    )
+
+# modules these commands must not import
+forbidden = (
+    "libyo.youtube.resolve",
+    "libyo.youtube.auth",
+    "libyo.urllib",
+    "urllib.request",
+    "http.client",
+    "lxml",
+    )
+
+
+def importtime(database, command):
+    """ Run youfeed and return ({module: cumulative us}, total us) """
+    proc = subprocess.Popen([sys.executable, "-X", "importtime", youfeed, "-db", database] + list(command),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=os.path.dirname(database))
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError("youfeed %s failed:\n%s" % (" ".join(command), err.decode("utf8", "replace")))
+    
+    modules = dict()
+    total = 0
+    for line in err.decode("utf8", "replace").splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue # header
+        cumulative = int(fields[1])
+        name = fields[2].rstrip()
+        modules[name.strip()] = cumulative
+        # top level imports are indented by one space
+        if len(name) - len(name.lstrip()) == 1:
+            total += cumulative
+    return modules, total
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0], description="youfeed import-time budget check")
+    parser.add_argument("-budget", type=float, default=400, help="Import time budget per command in ms [%(default)s]")
+    parser.add_argument("-top", type=int, default=5, help="Show the N most expensive imports [%(default)s]")
+    args = parser.parse_args(argv[1:])
+    
+    tmp = tempfile.mkdtemp(prefix="yf_importtime_")
+    database = os.path.join(tmp, "youfeed.db")
+    failed = False
+    try:
+        # create the schema outside of the measurement
+        importtime(database, ("job", "list"))
+        
+        for command in commands:
+            modules, total = importtime(database, command)
+            bad = sorted(m for m in modules for f in forbidden if m == f or m.startswith(f + "."))
+            ok = not bad and total <= args.budget * 1000
+            failed |= not ok
+            
+            print("[%s] youfeed %-28s %7.1fms" % (" OK " if ok else "FAIL", " ".join(command), total / 1000.))
+            for name, us in sorted(modules.items(), key=lambda i: -i[1])[:args.top]:
+                print("         %-40s %7.1fms" % (name, us / 1000.))
+            if bad:
+                print("         forbidden imports: %s" % ", ".join(bad))
+    finally:
+        shutil.rmtree(tmp)
+    
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
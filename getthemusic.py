@@ -94,6 +94,7 @@ def main(ARGV):
     parser.add_argument("-f","--force",action="store_true",dest="f",default=False,help="force recoding (don't allow format guessing)")
     parser.add_argument("-o","--overwrite",action="store_true",dest="o",default=False,help="Overwrite existing files")
     parser.add_argument("-v","--verbose",action="store_true",dest="verbose",default=False,help="Print FFmpeg output")
+    parser.add_argument("--profile",metavar="DIR",dest="profile_dir",default=None,help="Profile GetTheMusic: write cProfile stats and tracemalloc snapshots to DIR")
     subparsers = parser.add_subparsers()
     parser_dir = subparsers.add_parser("dir",aliases=["folder"])
     parser_dir.add_argument("dir",metavar="DIRECTORY",help="The directory to Read")
@@ -107,6 +108,13 @@ def main(ARGV):
     parser_sin.add_argument("-o","--outfile","--output",metavar="MUSICFILE",dest="target",default=None,help="The Output File")
     global args
     args = parser.parse_args(ARGV[1:])
+    if args.profile_dir:
+        from yfmetrics import Profiler
+        with Profiler(args.profile_dir):
+            return run(args)
+    return run(args)
+
+def run(args):
     DIRECTORY = None; NAME = None; TARGET = args.target; JOBTYPE=None
     if "sin" in args:
         FN_IN=args.sin
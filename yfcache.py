@@ -0,0 +1,359 @@
+#!/usr/bin/python3
+#-------------------------------------------------------------------------------
+#- YouFeed HTTP cache
+#- Copyright (C) 2013  Orochimarufan
+#-                 Authors: Orochimarufan <orochimarufan.x3@gmail.com>
+#-
+#- This program is free software: you can redistribute it and/or modify
+#- it under the terms of the GNU General Public License as published by
+#- the Free Software Foundation, either version 3 of the License, or
+#- (at your option) any later version.
+#-
+#- This program is distributed in the hope that it will be useful,
+#- but WITHOUT ANY WARRANTY; without even the implied warranty of
+#- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#- GNU General Public License for more details.
+#-
+#- You should have received a copy of the GNU General Public License
+#- along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+"""
+On-disk cache for the GData responses.
+
+Every response is one file in the cache directory, named by the sha1 of the
+url and the request headers; the first line is a json header (status,
+response headers, when it expires), the rest is the decoded body. A
+response is recorded while it is read, so nothing waits for it to be
+complete. Hits touch their file, and the least recently used files go when
+the directory grows over max_size.
+
+How long a response stays fresh comes from the ttls by endpoint (users,
+videos and feeds, see endpoint()), otherwise from its Cache-Control or Expires
+header. A stale response with an ETag is revalidated with If-None-Match.
+
+Modes:
+    on      fresh responses come from the cache, the rest is fetched and stored
+    record  everything is fetched and stored, errors and no-store responses
+            too (as already stale), so replay gets them
+    replay  everything comes from the cache, fresh or not; anything else raises
+            CacheMiss. Runs against a recorded cache need no network and see
+            the same answers every time
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import io
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import threading
+from email.utils import parsedate_tz, mktime_tz
+
+import yfnet
+import yfmetrics
+
+
+MODES       = ("on", "off", "record", "replay")
+ENDPOINTS   = ("users", "videos", "feeds")
+
+# what's worth keeping: documents and the errors that don't go away; a 403
+# may just be the quota, and get_make_user would take it for a suspended user.
+# record keeps the rest as well, but only replay answers with it
+STATUSES    = (200, 404, 410)
+# what a replayed response needs
+HEADERS     = ("Content-Type", "ETag", "Last-Modified", "Cache-Control", "Expires", "Date")
+
+_replace = getattr(os, "replace", os.rename)
+
+
+class CacheMiss(yfnet.Unavailable):
+    """ replay mode, and the cache doesn't have it """
+
+
+def endpoint(url):
+    """ 'users' for .../users/<id>, 'videos' for .../videos/<id>, 'feeds' for the rest """
+    path = url.split("?", 1)[0].rstrip("/").split("/")
+    if len(path) > 1 and path[-2] in ("users", "videos"):
+        return path[-2]
+    return "feeds"
+
+
+def lifetime(headers, now=None):
+    """ Seconds a response is fresh for by its headers; None if it may not be stored """
+    control = (headers.get("Cache-Control") or "").lower()
+    if "no-store" in control:
+        return None
+    if "no-cache" in control:
+        return 0
+    match = re.search(r"max-age\s*=\s*(\d+)", control)
+    if match:
+        return int(match.group(1))
+    expires = parsedate_tz(headers.get("Expires") or "")
+    if expires is not None:
+        date = parsedate_tz(headers.get("Date") or "")
+        return max(0, mktime_tz(expires) - (mktime_tz(date) if date is not None else now or time.time()))
+    return 0
+
+
+class Response(io.BytesIO):
+    """ A response from the cache, looks enough like what urlopen returns """
+    def __init__(self, url, entry, body):
+        io.BytesIO.__init__(self, body)
+        self.url        = url
+        self.code       = entry["status"]
+        self.headers    = dict(entry["headers"])
+
+    def getcode(self):
+        return self.code
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+
+class Recorder(object):
+    """ Reads a response from the network and writes it to the cache as it goes """
+    def __init__(self, cache, key, entry, fp):
+        self.cache      = cache
+        self.key        = key
+        self.entry      = entry
+        self.fp         = fp
+        self.url        = entry["url"]
+        self.code       = entry["status"]
+        self.headers    = fp.info()
+        self.size       = 0
+        self.complete   = False
+        self.tmp        = "%s.%s.tmp" % (cache.path_of(key), uuid.uuid4().hex[:8])
+        self.out        = open(self.tmp, "wb")
+        self.out.write(json.dumps(entry).encode("utf8") + b"\n")
+
+    def read(self, n=-1):
+        try:
+            data = self.fp.read(n) if n is not None and n >= 0 else self.fp.read()
+        except Exception:
+            self._discard()
+            raise
+        if self.out is not None:
+            if data:
+                self.out.write(data)
+                self.size += len(data)
+            if not data or n is None or n < 0:
+                self.complete = True
+        return data
+
+    def getcode(self):
+        return self.code
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def _discard(self):
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+            os.remove(self.tmp)
+
+    def close(self):
+        if self.out is not None and not self.complete:
+            # the rest of a document that was only looked at is worth having, too
+            try:
+                while self.read(65536):
+                    pass
+            except Exception:
+                pass
+        self.fp.close()
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+            self.cache.commit(self.key, self.tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Cache(object):
+    """ The cache in directory path, see the module docstring """
+    def __init__(self, path, mode="on", max_size=64 << 20, ttls=None):
+        self.path       = path
+        self.mode       = mode
+        self.max_size   = max_size
+        self.ttls       = dict(ttls or {})
+        self.size       = None
+        self.lock       = threading.Lock()
+
+    @classmethod
+    def from_options(cls, db, path, mode=None):
+        """ The cache in path as configured in db; mode overrides cache_mode. None if it's off """
+        mode = mode or db.getOptionValue("cache_mode") or "on"
+        if mode == "off":
+            return None
+        if mode not in MODES:
+            print("[ERROR] Unknown cache mode '%s', using on" % mode)
+            mode = "on"
+        max_size = yfnet.parse_rate(db.getOptionValue("cache_size") or "64M")
+        ttls = dict((key, float(value)) for key, value in
+                    yfnet.parse_pairs(db.getOptionValue("cache_ttl") or "users=86400") if value != "server")
+        return cls(path, mode, max_size, ttls)
+
+    @staticmethod
+    def key(url, headers):
+        """ The sha1 of url and the request headers """
+        text = "\n".join([url] + sorted("%s: %s" % (k.lower(), v) for k, v in headers))
+        return hashlib.sha1(text.encode("utf8")).hexdigest()
+
+    def path_of(self, key):
+        return os.path.join(self.path, key)
+
+    #------------------------------
+    # Entries
+    def load(self, key):
+        """ (entry, body) of key, or (None, None) """
+        try:
+            with open(self.path_of(key), "rb") as fp:
+                entry = json.loads(fp.readline().decode("utf8"))
+                return entry, fp.read()
+        except (IOError, OSError, ValueError):
+            return None, None
+
+    def touch(self, key):
+        try:
+            os.utime(self.path_of(key), None)
+        except OSError:
+            pass
+
+    def _expires(self, url, status, headers, now):
+        # the overrides are for documents, errors go by what the server says
+        ttl = self.ttls.get(endpoint(url)) if status == 200 else None
+        if ttl is None:
+            ttl = lifetime(headers, now)
+            if ttl is None:
+                return None
+        return now + ttl
+
+    def commit(self, key, tmp):
+        """ Put a recorded response in place, evict what's over max_size """
+        size = os.path.getsize(tmp)
+        with self.lock:
+            # a revalidated entry replaces itself
+            try:
+                size -= os.path.getsize(self.path_of(key))
+            except OSError:
+                pass
+            _replace(tmp, self.path_of(key))
+            if self.size is None:
+                self.size = self._scan()[0]
+            else:
+                self.size += size
+            if self.max_size and self.size > self.max_size:
+                self._evict()
+
+    def _scan(self):
+        files = list()
+        for name in os.listdir(self.path):
+            if name.endswith(".tmp"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, name))
+        return sum(f[1] for f in files), files
+
+    def _evict(self):
+        # down to 90%, so we don't do this on every store
+        self.size, files = self._scan()
+        for mtime, size, name in sorted(files):
+            if self.size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                continue
+            self.size -= size
+            yfmetrics.count("gdata_cache_evictions")
+
+    def _response(self, url, entry, body):
+        yfmetrics.count("gdata_cache_hits")
+        yfmetrics.count("gdata_cache_bytes", len(body))
+        if entry["status"] != 200:
+            raise yfnet.HTTPError(url, entry["status"], "cached", dict(entry["headers"]), io.BytesIO(body))
+        return Response(url, entry, body)
+
+    #------------------------------
+    # Requests
+    def open(self, url, headers, fetch):
+        """
+        The response to url from the cache, or from fetch(extra_headers) while
+        recording it. Errors are raised as urllib's HTTPError, like urlopen does
+        """
+        key = self.key(url, headers)
+        entry, body = self.load(key) if self.mode != "record" else (None, None)
+        if entry is not None and entry["status"] not in STATUSES and self.mode != "replay":
+            # recorded for replay, or from before we stopped keeping those
+            entry = None
+        now = time.time()
+        if entry is not None and (self.mode == "replay" or (entry["expires"] or 0) > now):
+            self.touch(key)
+            return self._response(url, entry, body)
+        if self.mode == "replay":
+            yfmetrics.count("gdata_cache_misses")
+            raise CacheMiss("%s is not in the cache" % url)
+
+        etag = entry and dict(entry["headers"]).get("ETag")
+        try:
+            fp = fetch([("If-None-Match", etag)] if etag else [])
+        except yfnet.HTTPError as e:
+            if e.getcode() == 304 and entry is not None:
+                # still the same, good for another while
+                yfmetrics.count("gdata_cache_revalidated")
+                entry["expires"] = self._expires(url, entry["status"], e.headers, now) or now
+                self._store(key, entry, body)
+                return self._response(url, entry, body)
+            if e.getcode() not in STATUSES and self.mode != "record":
+                raise
+            # the error reads like a response, and closes it when it goes away
+            fp, status = e, e.getcode()
+        else:
+            status = fp.getcode() or 200
+        yfmetrics.count("gdata_cache_misses")
+
+        info = fp.info()
+        expires = self._expires(url, status, info, now)
+        if self.mode == "record" and (expires is None or status not in STATUSES):
+            # replay has to see what this run saw; stale, so on never uses it
+            expires = now
+        if expires is None:
+            if status != 200:
+                raise yfnet.HTTPError(url, status, "", info, fp)
+            return fp
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        entry = dict(url=url, status=status, stored=now, expires=expires,
+                     headers=[(k, info[k]) for k in HEADERS if info.get(k) is not None])
+        if status != 200:
+            # error documents are small, and nobody has to remember to close them
+            try:
+                body = fp.read()
+            finally:
+                fp.close()
+            self._store(key, entry, body)
+            raise yfnet.HTTPError(url, status, "", dict(entry["headers"]), io.BytesIO(body))
+        return Recorder(self, key, entry, fp)
+
+    def _store(self, key, entry, body):
+        tmp = "%s.%s.tmp" % (self.path_of(key), uuid.uuid4().hex[:8])
+        with open(tmp, "wb") as out:
+            out.write(json.dumps(entry).encode("utf8") + b"\n")
+            out.write(body)
+        self.commit(key, tmp)
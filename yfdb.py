@@ -27,7 +27,9 @@ from sqlalchemy import (create_engine, Table, Column, ForeignKey,
     String, Integer, DateTime, Text, Enum)
 from sqlalchemy.schema import PrimaryKeyConstraint, Index
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 
 
@@ -35,7 +37,10 @@ Base = declarative_base()
 logger = logging.getLogger("yfdb")
 
 # yfdb schema version
-DB_VERSION = 1
+DB_VERSION = 5
+
+# seconds sqlite waits for another connection's write lock
+BUSY_TIMEOUT = 60
 
 
 # Tables
@@ -75,6 +80,8 @@ class LocalVideo(Base):
     created  = Column(String)
     status   = Column(Integer, default=0)
     
+    # a worse format than the job asked for, to make a deadline
+    ST_DOWNGRADED = 0x1
     ST_V2IMPORT = 0x200
     
     def __repr__(self):
@@ -158,6 +165,8 @@ class Job(Base):
     export  = Column(String(4096))
     range   = Column(String(10))
     status  = Column(Integer, nullable=False, default='0')
+    # its downloads go before those of jobs with a lower one
+    priority = Column(Integer, nullable=False, default=0)
     
     ST_DISABLED = 0x1
     ST_NODL     = 0x2
@@ -167,6 +176,89 @@ class Job(Base):
     ST_V2IMPORT = 0x200
 
 
+class PlaylistSchedule(Base):
+    """ When to check a Playlist for changes next """
+    __tablename__ = 'schedule'
+    
+    playlist_id = Column(String, ForeignKey(Playlist.id), primary_key=True)
+    
+    # unix timestamps
+    last_check  = Column(Integer)
+    last_change = Column(Integer)
+    next_check  = Column(Integer, index=True)
+    # seconds between the last and the next check
+    interval    = Column(Integer)
+    
+    def __repr__(self):
+        return "<Playlist Schedule: playlist_id='%s' next_check=%s interval=%s>" % \
+            (self.playlist_id, self.next_check, self.interval)
+
+
+class SyncRecord(Base):
+    """ The outcome of a Playlist sync """
+    __tablename__ = 'sync_history'
+    
+    id          = Column(Integer, primary_key=True)
+    playlist_id = Column(String, ForeignKey(Playlist.id), index=True)
+    time        = Column(Integer)
+    new_items   = Column(Integer)
+    total_items = Column(Integer)
+
+
+class Lease(Base):
+    """ A worker's claim on a job or a download, see yfworker """
+    __tablename__ = 'leases'
+    
+    # "job" (key: job name) or "download" (key: video_id)
+    kind        = Column(String, primary_key=True)
+    key         = Column(String, primary_key=True)
+    owner       = Column(String, index=True)
+    
+    # unix timestamps
+    heartbeat   = Column(Integer)
+    expires     = Column(Integer)
+    
+    def __repr__(self):
+        return "<Lease: %s '%s' owner='%s' expires=%s>" % (self.kind, self.key, self.owner, self.expires)
+
+
+class Download(Base):
+    """ A video waiting to be downloaded, see yfsched """
+    __tablename__ = 'downloads'
+    
+    id          = Column(Integer, primary_key=True)
+    video_id    = Column(String, ForeignKey('videos.id'), index=True)
+    video       = relationship('Video')
+    # the job that queued it and the formats it accepts, best first (json)
+    job         = Column(String(32))
+    formats     = Column(String)
+    
+    state       = Column(String(16), index=True, nullable=False, default='pending')
+    priority    = Column(Integer, nullable=False, default=0)
+    attempts    = Column(Integer, nullable=False, default=0)
+    last_error  = Column(Text)
+    # the file being written, kept so an interrupted transfer can be resumed
+    fmt         = Column(Integer)
+    location    = Column(String(4096))
+    bytes_done  = Column(Integer, nullable=False, default=0)
+    
+    # unix timestamps
+    created     = Column(Integer)
+    updated     = Column(Integer)
+    
+    ST_PENDING      = "pending"
+    ST_RESOLVING    = "resolving"
+    ST_TRANSFERRING = "transferring"
+    ST_DONE         = "done"
+    ST_FAILED       = "failed"
+    
+    # states a worker is (or was, before it died) busy with
+    ACTIVE = (ST_RESOLVING, ST_TRANSFERRING)
+    
+    def __repr__(self):
+        return "<Download: id=%s video_id='%s' state='%s'>" % (self.id, self.video_id, self.state)
+
+
 # DB migration helper
 def db_version_migrate(engine, ver=None):
     """
@@ -198,6 +290,18 @@ def db_version_migrate(engine, ver=None):
     # Migration code. Template:
     #if case(_version_):
     #   engine.execute(_modify_schema_to_match_next_version_)
+    if case(1):
+        # 2: playlist schedule and sync history
+        Base.metadata.create_all(engine, tables=[PlaylistSchedule.__table__, SyncRecord.__table__])
+    if case(2):
+        # 3: worker leases
+        Base.metadata.create_all(engine, tables=[Lease.__table__])
+    if case(3):
+        # 4: download queue
+        Base.metadata.create_all(engine, tables=[Download.__table__])
+    if case(4):
+        # 5: job priority
+        engine.execute("ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
     
     set_version(engine, DB_VERSION)
 
@@ -208,10 +312,10 @@ def is_sqlite(engine):
 
 def get_version(engine):
     if is_sqlite(engine):
-        return engine.execute("PRAGMA user_version").fetchone()[0]
+        return engine.execute("PRAGMA user_version").scalar()
     else:
         if "options" in engine.dialect.table_names():
-            return int(engine.execute("SELECT value FROM options WHERE key='db_version'").fetchone()[0])
+            return int(engine.execute("SELECT value FROM options WHERE key='db_version'").scalar())
         else:
             return 0
 
@@ -248,9 +352,22 @@ class DB(object):
     """
     
     @classmethod
-    def open(cls, filename, echo=False):
-        """ Open a YFDB sqlite file """
-        engine = create_engine('sqlite:///' + filename, echo=echo)
+    def open(cls, filename, echo=False, pooled=False):
+        """
+        Open a YFDB sqlite file
+        
+        pooled keeps the connections open between sessions, for long running
+        processes and threads. A pooled connection may be used by a different
+        thread next time, so sqlite's same-thread check has to be off.
+        """
+        # concurrent jobs wait for each other's write locks
+        connect_args = {"timeout": BUSY_TIMEOUT}
+        if pooled:
+            connect_args["check_same_thread"] = False
+            engine = create_engine('sqlite:///' + filename, echo=echo,
+                poolclass=QueuePool, connect_args=connect_args)
+        else:
+            engine = create_engine('sqlite:///' + filename, echo=echo, connect_args=connect_args)
         db = cls(engine)
         db.sqlite_file = os.path.abspath(filename)
         return db
@@ -345,13 +462,19 @@ class DB(object):
             else:
                 index = item.index + 1
         else:
-            if session.query(PlaylistItem).filter(PlaylistItem.playlist_id
-                == playlist_id).filter(PlaylistItem.index == index).count() != 0:
-                for record in session.query(PlaylistItem).filter(
-                    PlaylistItem.playlist_id == playlist_id).filter(
-                    PlaylistItem.index >= index).order_by(
-                    PlaylistItem.index.desc()).all():
-                    record.index += 1
+            items = session.query(PlaylistItem).filter(PlaylistItem.playlist_id == playlist_id)
+            if items.filter(PlaylistItem.index == index).count() != 0:
+                # move the rest up in two statements: sqlite checks the key
+                # row by row, so a plain index + 1 runs into the next item
+                items.filter(PlaylistItem.index >= index).update(
+                    {PlaylistItem.index: -PlaylistItem.index - 1}, synchronize_session=False)
+                items.filter(PlaylistItem.index < 0).update(
+                    {PlaylistItem.index: -PlaylistItem.index}, synchronize_session=False)
+                # the items the session has loaded are at their old index
+                for record in list(session.identity_map.values()):
+                    if isinstance(record, PlaylistItem) and record.playlist_id == playlist_id \
+                            and record.index >= index:
+                        session.expunge(record)
         pi = PlaylistItem(playlist_id=playlist_id, index=index, video_id=video_id)
         session.add(pi)
         return pi
@@ -375,9 +498,13 @@ class DB(object):
         return session.query(Option).get(key)
     
     def getOptionValue(self, key):
-        opt = self.getOption(key)
-        if opt is not None:
-            return opt[1].value
+        session = self.Session()
+        try:
+            opt = self.getOption(key, session=session)
+            if opt is not None:
+                return opt.value
+        finally:
+            session.close()
     
     @sqlworker
     def setOptionValue(self, key, value, session):
@@ -387,6 +514,42 @@ class DB(object):
             session.add(opt)
         else:
             opt.value = value
+    
+    #------------------------------
+    # Leases
+    #   each is a transaction of its own, sqlite serializes them
+    def claimLease(self, kind, key, owner, ttl, now):
+        """ Take a lease that is free, expired or already ours; returns whether we hold it """
+        table = Lease.__table__
+        with self.engine.begin() as conn:
+            taken = conn.execute(table.update().
+                where(table.c.kind == kind).where(table.c.key == key).
+                where((table.c.expires < now) | (table.c.owner == owner)).
+                values(owner=owner, heartbeat=now, expires=now + ttl)).rowcount
+            if taken:
+                return True
+            try:
+                conn.execute(table.insert().values(kind=kind, key=key, owner=owner,
+                                                   heartbeat=now, expires=now + ttl))
+            except IntegrityError:
+                return False
+        return True
+    
+    def renewLeases(self, owner, ttl, now):
+        """ Extend all leases of owner; returns the (kind, key) it still holds """
+        table = Lease.__table__
+        with self.engine.begin() as conn:
+            conn.execute(table.update().where(table.c.owner == owner).
+                         values(heartbeat=now, expires=now + ttl))
+            return set((row.kind, row.key) for row in
+                       conn.execute(table.select().where(table.c.owner == owner)))
+    
+    def releaseLease(self, kind, key, owner):
+        table = Lease.__table__
+        with self.engine.begin() as conn:
+            conn.execute(table.delete().where(table.c.kind == kind).
+                         where(table.c.key == key).where(table.c.owner == owner))
 
-__all__=["DB", "Video", "Playlist", "PlaylistItem", "User", "LocalVideo", "Job", "Option"]
+__all__=["DB", "Video", "Playlist", "PlaylistItem", "User", "LocalVideo", "Job", "Option",
+         "PlaylistSchedule", "SyncRecord", "Lease", "Download"]
 
@@ -0,0 +1,571 @@
+#!/usr/bin/python3
+#-------------------------------------------------------------------------------
+#- YouFeed run metrics
+#- Copyright (C) 2013  Orochimarufan
+#-                 Authors: Orochimarufan <orochimarufan.x3@gmail.com>
+#-
+#- This program is free software: you can redistribute it and/or modify
+#- it under the terms of the GNU General Public License as published by
+#- the Free Software Foundation, either version 3 of the License, or
+#- (at your option) any later version.
+#-
+#- This program is distributed in the hope that it will be useful,
+#- but WITHOUT ANY WARRANTY; without even the implied warranty of
+#- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#- GNU General Public License for more details.
+#-
+#- You should have received a copy of the GNU General Public License
+#- along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+"""
+Per-job phase timings and counters of a youfeed run, tracing and profiling.
+
+The code being measured only calls the module level phase(), count(), span(),
+add_span(), profiled() and snapshot(); they do nothing unless a run, tracer or
+profiler is active, so run_download & co. still work on their own.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import datetime
+import threading
+from contextlib import contextmanager
+
+__all__ = ["RunMetrics", "JobMetrics", "phase", "count", "current", "bound",
+           "Profiler", "profiled", "snapshot", "Tracer", "span", "add_span", "SqlStats"]
+
+
+# the phases of a job, in pipeline order
+PHASES  = ("sync", "check", "access", "resolve", "download", "playlist")
+
+# the counters youfeed keeps
+COUNTERS = ("pages", "videos_new", "videos_known", "downloads", "downloads_failed", "downloads_deferred",
+            "bytes_downloaded", "retries", "retry_wait_seconds", "errors_transient", "errors_fatal",
+            "breaker_trips", "breaker_wait_seconds", "gdata_wire_bytes", "gdata_decoded_bytes",
+            "gdata_cache_hits", "gdata_cache_misses", "resolve_cache_hits", "resolve_cache_misses",
+            "db_queries")
+
+_local  = threading.local()
+
+_replace = getattr(os, "replace", os.rename)
+
+
+class JobMetrics(object):
+    """ Timings and counters of a single job """
+    def __init__(self, run, name):
+        self.run        = run
+        self.name       = name
+        self.started    = time.time()
+        self.duration   = None
+        self.status     = "running"
+        self.phases     = dict()
+        self.counters   = dict()
+        self._lock      = threading.Lock()
+
+    def add_time(self, phase, seconds):
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def count(self, counter, n=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def finish(self, status="ok"):
+        self.duration   = time.time() - self.started
+        self.status     = status
+
+    def as_dict(self):
+        return dict(type="job", run=self.run.id, job=self.name,
+                    start=datetime.datetime.utcfromtimestamp(self.started).isoformat(),
+                    duration=self.duration, status=self.status,
+                    phases=dict(self.phases), counters=dict(self.counters))
+
+
+class RunMetrics(object):
+    """ All jobs of one 'youfeed run' """
+    def __init__(self):
+        self.id         = uuid.uuid4().hex
+        self.started    = time.time()
+        self.duration   = None
+        self.jobs       = list()
+        self.sqlstats   = None
+        self.hosts      = dict()
+        self._engines   = list()
+
+    def add_job(self, name):
+        """ A new JobMetrics, for work that isn't done in a job() block """
+        job = JobMetrics(self, name)
+        self.jobs.append(job)
+        return job
+
+    @contextmanager
+    def job(self, name):
+        """ Make a new JobMetrics current in this thread while the block runs """
+        job = self.add_job(name)
+        previous = getattr(_local, "job", None)
+        _local.job = job
+        try:
+            yield job
+        except BaseException:
+            job.finish("error")
+            raise
+        else:
+            job.finish()
+        finally:
+            _local.job = previous
+
+    def attach(self, engine):
+        """ Count the queries issued through a SQLAlchemy engine as db_queries """
+        from sqlalchemy import event
+        event.listen(engine, "before_cursor_execute", _count_query)
+        self._engines.append(engine)
+
+    def finish(self):
+        for job in self.jobs:
+            if job.duration is None:
+                job.finish()
+        from sqlalchemy import event
+        for engine in self._engines:
+            event.remove(engine, "before_cursor_execute", _count_query)
+        del self._engines[:]
+        self.duration = time.time() - self.started
+
+    def totals(self):
+        counters = dict()
+        for job in self.jobs:
+            for k, v in job.counters.items():
+                counters[k] = counters.get(k, 0) + v
+        return counters
+
+    def as_dict(self):
+        return dict(type="run", run=self.id,
+                    start=datetime.datetime.utcfromtimestamp(self.started).isoformat(),
+                    duration=self.duration, jobs=len(self.jobs),
+                    failed=sum(1 for job in self.jobs if job.status != "ok"),
+                    counters=self.totals(), hosts=self.hosts)
+
+    #------------------------------
+    # Output
+    def write_log(self, path):
+        """ Append one json line per job and one for the whole run """
+        with open(path, "a") as fp:
+            for job in self.jobs:
+                fp.write(json.dumps(job.as_dict(), sort_keys=True) + "\n")
+            fp.write(json.dumps(self.as_dict(), sort_keys=True) + "\n")
+            if self.sqlstats is not None:
+                sql = self.sqlstats.as_dict()
+                sql["run"] = self.id
+                fp.write(json.dumps(sql, sort_keys=True) + "\n")
+
+    def write_textfile(self, path):
+        """ Write a textfile for the node_exporter textfile collector """
+        lines = list()
+        def metric(name, kind, help, samples):
+            lines.append("# HELP youfeed_%s %s" % (name, help))
+            lines.append("# TYPE youfeed_%s %s" % (name, kind))
+            for labels, value in samples:
+                label = ",".join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+                lines.append("youfeed_%s%s %s" % (name, "{%s}" % label if label else "", _number(value)))
+
+        metric("run_start_timestamp_seconds", "gauge", "Start of the last run",
+               [((), self.started)])
+        metric("run_duration_seconds", "gauge", "Wall time of the last run",
+               [((), self.duration or 0)])
+        metric("job_duration_seconds", "gauge", "Wall time of each job in the last run",
+               [((("job", job.name),), job.duration or 0) for job in self.jobs])
+        metric("job_success", "gauge", "1 if the job finished without an exception",
+               [((("job", job.name),), int(job.status == "ok")) for job in self.jobs])
+        # always write the known series, so alerts don't see them come and go
+        phases = list(PHASES) + sorted(set(k for job in self.jobs for k in job.phases) - set(PHASES))
+        metric("job_phase_seconds", "gauge", "Time spent in each phase of a job",
+               [((("job", job.name), ("phase", phase)), job.phases.get(phase, 0.0))
+                for job in self.jobs for phase in phases])
+        counters = sorted(set(COUNTERS) | set(k for job in self.jobs for k in job.counters))
+        for counter in counters:
+            metric("job_%s" % counter, "gauge", "%s in the last run" % counter.replace("_", " "),
+                   [((("job", job.name),), job.counters.get(counter, 0)) for job in self.jobs])
+        hosts = sorted(self.hosts.items())
+        metric("host_breaker_trips", "gauge", "Times a host was paused after failing in a row",
+               [((("host", host),), st["trips"]) for host, st in hosts])
+        metric("host_breaker_open", "gauge", "1 if the host was still paused at the end of the run",
+               [((("host", host),), int(st["open"])) for host, st in hosts])
+
+        # the collector may read at any time, so never let it see a partial file
+        tmp = "%s.%i.tmp" % (path, os.getpid())
+        with open(tmp, "w") as fp:
+            fp.write("\n".join(lines) + "\n")
+        _replace(tmp, path)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _count_query(*args):
+    count("db_queries")
+
+
+#------------------------------------------------------------
+# Instrumentation
+#------------------------------------------------------------
+def current():
+    """ The JobMetrics of the calling thread, or None """
+    return getattr(_local, "job", None)
+
+
+@contextmanager
+def bound(job):
+    """ Make an existing JobMetrics (or None) current in this thread, for work done on its behalf """
+    previous = getattr(_local, "job", None)
+    _local.job = job
+    try:
+        yield job
+    finally:
+        _local.job = previous
+
+
+def current_phase():
+    """ The phase the calling thread is in, or None """
+    return getattr(_local, "phase", None)
+
+
+@contextmanager
+def phase(name):
+    """ Add the time spent in the block to phase 'name' of the current job """
+    job = getattr(_local, "job", None)
+    if job is None and _tracer is None:
+        yield
+        return
+    previous = getattr(_local, "phase", None)
+    _local.phase = name
+    t0 = time.time()
+    try:
+        yield
+    finally:
+        t1 = time.time()
+        _local.phase = previous
+        if job is not None:
+            job.add_time(name, t1 - t0)
+        if _tracer is not None:
+            _tracer.add(name, "phase", t0, t1)
+
+
+def count(counter, n=1):
+    """ Add n to a counter of the current job """
+    job = getattr(_local, "job", None)
+    if job is not None:
+        job.count(counter, n)
+
+
+#------------------------------------------------------------
+# Profiling
+#------------------------------------------------------------
+_profiler = None
+
+
+class Profiler(object):
+    """
+    cProfile and tracemalloc for a whole command.
+    
+    Used as a context manager around the command. Every section() gets its own
+    .pstats file in the directory, the rest of the command goes to main.pstats.
+    snapshot() dumps a tracemalloc snapshot (python 3.4+ only). A summary of
+    the top entries is printed when the command is done, even if it was
+    interrupted.
+    """
+    def __init__(self, directory, top=15):
+        self.directory  = directory
+        self.top        = top
+        self.stack      = list()
+        self.pstats     = list()
+        self.snapshots  = list()
+        self.tracemalloc = None
+
+    def __enter__(self):
+        global _profiler
+        import cProfile
+        self._cProfile = cProfile
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        try:
+            import tracemalloc
+        except ImportError:
+            print("[PROF ] tracemalloc is not available, not taking memory snapshots")
+        else:
+            tracemalloc.start()
+            self.tracemalloc = tracemalloc
+        _profiler = self
+        self._push("main")
+        return self
+
+    def __exit__(self, *exc):
+        global _profiler
+        self.snapshot("exit")
+        while self.stack:
+            self._pop()
+        if self.tracemalloc is not None:
+            self.tracemalloc.stop()
+        _profiler = None
+        self.summary()
+        return False
+
+    def _push(self, name):
+        if self.stack:
+            self.stack[-1][1].disable()
+        profile = self._cProfile.Profile()
+        self.stack.append((name, profile))
+        profile.enable()
+
+    def _pop(self):
+        name, profile = self.stack.pop()
+        profile.disable()
+        path = os.path.join(self.directory, "%s.pstats" % _filename(name))
+        # a name may come up more than once (-forceall with duplicates, shell)
+        n = 1
+        while path in self.pstats:
+            n += 1
+            path = os.path.join(self.directory, "%s.%i.pstats" % (_filename(name), n))
+        profile.dump_stats(path)
+        self.pstats.append(path)
+        if self.stack:
+            self.stack[-1][1].enable()
+
+    @contextmanager
+    def section(self, name):
+        self._push(name)
+        try:
+            yield
+        finally:
+            self._pop()
+
+    def snapshot(self, label):
+        if self.tracemalloc is None:
+            return
+        snapshot = self.tracemalloc.take_snapshot()
+        path = os.path.join(self.directory, "%02i-%s.snapshot" % (len(self.snapshots), _filename(label)))
+        snapshot.dump(path)
+        current, peak = self.tracemalloc.get_traced_memory()
+        self.snapshots.append((label, path, current, peak))
+
+    def summary(self):
+        import pstats
+        print("[PROF ] Profiles written to %s" % self.directory)
+        if self.pstats:
+            print("[PROF ] Top %i functions by cumulative time:" % self.top)
+            stats = pstats.Stats(*self.pstats)
+            stats.sort_stats("cumulative").print_stats(self.top)
+        if self.snapshots:
+            print("[PROF ] Traced memory:")
+            for label, path, current, peak in self.snapshots:
+                print("    %-40s %9.1f kB (peak %9.1f kB)" % (label, current / 1024., peak / 1024.))
+            if len(self.snapshots) > 1:
+                # leave out what profiling itself allocates
+                filters = [self.tracemalloc.Filter(False, pattern) for pattern in
+                           ("*/cProfile.py", "*/pstats.py", "*/tracemalloc.py", __file__, "<frozen importlib._bootstrap*>")]
+                first = self.tracemalloc.Snapshot.load(self.snapshots[0][1]).filter_traces(filters)
+                last = self.tracemalloc.Snapshot.load(self.snapshots[-1][1]).filter_traces(filters)
+                print("[PROF ] Top %i allocation sites by growth (%s -> %s):" % (
+                    self.top, self.snapshots[0][0], self.snapshots[-1][0]))
+                for stat in last.compare_to(first, "lineno")[:self.top]:
+                    print("    %s" % stat)
+
+
+def _filename(name):
+    return "".join(c if c.isalnum() or c in "-_." else "_" for c in name)
+
+
+@contextmanager
+def profiled(name):
+    """ Profile the block into its own .pstats file, if -profile is active """
+    if _profiler is None:
+        yield
+    else:
+        with _profiler.section(name):
+            yield
+
+
+def snapshot(label):
+    """ Take a tracemalloc snapshot, if -profile is active """
+    if _profiler is not None:
+        _profiler.snapshot(label)
+
+
+#------------------------------------------------------------
+# Tracing
+#------------------------------------------------------------
+_tracer = None
+
+
+class Tracer(object):
+    """
+    Collects spans and writes them in the Chrome trace_event format.
+    
+    The file can be opened in chrome://tracing or Perfetto; every thread
+    gets its own track.
+    """
+    def __init__(self):
+        self.events     = list()
+        self.threads    = dict()
+        self.pid        = os.getpid()
+        self._lock      = threading.Lock()
+
+    def start(self):
+        global _tracer
+        _tracer = self
+        return self
+
+    def stop(self):
+        global _tracer
+        if _tracer is self:
+            _tracer = None
+
+    def add(self, name, cat, start, end, args=None):
+        thread = threading.current_thread()
+        event = dict(name=name, cat=cat, ph="X", pid=self.pid, tid=thread.ident,
+                     ts=int(start * 1e6), dur=max(0, int((end - start) * 1e6)))
+        if args:
+            event["args"] = args
+        with self._lock:
+            self.events.append(event)
+            self.threads.setdefault(thread.ident, thread.name)
+
+    def write(self, path):
+        with self._lock:
+            events = [dict(name="thread_name", ph="M", pid=self.pid, tid=tid, args=dict(name=name))
+                      for tid, name in self.threads.items()]
+            events.extend(self.events)
+        with open(path, "w") as fp:
+            json.dump(dict(traceEvents=events, displayTimeUnit="ms"), fp)
+
+
+@contextmanager
+def span(name, cat="youfeed", **args):
+    """ Record the block as a span, if tracing """
+    if _tracer is None:
+        yield
+        return
+    t0 = time.time()
+    try:
+        yield
+    finally:
+        _tracer.add(name, cat, t0, time.time(), args)
+
+
+def add_span(name, start, end, cat="youfeed", **args):
+    """ Record a span that was measured by other means, if tracing """
+    if _tracer is not None:
+        _tracer.add(name, cat, start, end, args)
+
+
+#------------------------------------------------------------
+# SQL statistics
+#------------------------------------------------------------
+_sql_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_sql_lists = re.compile(r"\(\?(?:\s*,\s*\?)+\)")
+_sql_space = re.compile(r"\s+")
+
+
+def normalize_sql(statement):
+    """ Make statements that only differ in their parameters look the same """
+    statement = _sql_literals.sub("?", statement)
+    statement = _sql_lists.sub("(?, ...)", statement)
+    return _sql_space.sub(" ", statement).strip()
+
+
+class SqlStats(object):
+    """
+    Counts and times every statement executed through an engine.
+    
+    Statements are grouped by their normalized text and attributed to the
+    phase and to the first function outside of SQLAlchemy, yfdb and this
+    module that caused them. A statement that runs more than 'limit' times in
+    one job is flagged, that's usually a query in a loop (N+1).
+    """
+    _skip = ("sqlalchemy", "yfdb.py", "yfmetrics.py", "contextlib.py", "<string>")
+
+    def __init__(self, limit=100):
+        self.limit      = limit
+        self.statements = dict()
+        self.per_job    = dict()
+        self._lock      = threading.Lock()
+
+    def attach(self, engine):
+        from sqlalchemy import event
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+        return self
+
+    def detach(self, engine):
+        from sqlalchemy import event
+        event.remove(engine, "before_cursor_execute", self._before)
+        event.remove(engine, "after_cursor_execute", self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("yfmetrics_t0", list()).append(time.time())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.time() - conn.info["yfmetrics_t0"].pop()
+        sql = normalize_sql(statement)
+        where = "%s (%s)" % (self._caller(), current_phase() or "-")
+        job = current()
+        job = job.name if job is not None else None
+        with self._lock:
+            st = self.statements.get(sql)
+            if st is None:
+                st = self.statements[sql] = dict(count=0, time=0.0, max=0.0, where=dict())
+            st["count"] += 1
+            st["time"] += elapsed
+            st["max"] = max(st["max"], elapsed)
+            st["where"][where] = st["where"].get(where, 0) + 1
+            if job is not None:
+                self.per_job[(job, sql)] = self.per_job.get((job, sql), 0) + 1
+
+    def _caller(self):
+        frame = sys._getframe(2)
+        while frame is not None:
+            filename = frame.f_code.co_filename
+            if not any(skip in filename for skip in self._skip):
+                return "%s:%s" % (os.path.basename(filename), frame.f_code.co_name)
+            frame = frame.f_back
+        return "?"
+
+    def flagged(self):
+        """ [(job, statement, count)] of the statements that ran more than limit times in a job """
+        with self._lock:
+            return sorted(((job, sql, n) for (job, sql), n in self.per_job.items() if n > self.limit),
+                          key=lambda x: -x[2])
+
+    def as_dict(self):
+        with self._lock:
+            statements = [dict(sql=sql, count=st["count"], time=st["time"], max=st["max"], where=dict(st["where"]))
+                          for sql, st in self.statements.items()]
+        statements.sort(key=lambda st: -st["time"])
+        return dict(type="sqlstats", limit=self.limit, statements=statements,
+                    flagged=[dict(job=job, sql=sql, count=n) for job, sql, n in self.flagged()])
+
+    def summary(self, top=15):
+        stats = self.as_dict()
+        statements = stats["statements"]
+        print("[ SQL ] %i statements, %i distinct, %.3fs total" % (
+            sum(st["count"] for st in statements), len(statements), sum(st["time"] for st in statements)))
+        for st in statements[:top]:
+            where = sorted(st["where"].items(), key=lambda x: -x[1])
+            print("%8i x %9.1fms (max %7.1fms)  %s" % (st["count"], st["time"] * 1000, st["max"] * 1000,
+                                                       _shorten(st["sql"])))
+            print("%31s from %s" % ("", ", ".join("%s %ix" % w for w in where[:3])))
+        for item in stats["flagged"]:
+            print("[ SQL ] N+1? %ix in job '%s': %s" % (item["count"], item["job"], _shorten(item["sql"])))
+
+
+def _shorten(sql, width=100):
+    return sql if len(sql) <= width else sql[:width - 3] + "..."
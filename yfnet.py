@@ -0,0 +1,634 @@
+#!/usr/bin/python3
+#-------------------------------------------------------------------------------
+#- YouFeed network helpers
+#- Copyright (C) 2013  Orochimarufan
+#-                 Authors: Orochimarufan <orochimarufan.x3@gmail.com>
+#-
+#- This program is free software: you can redistribute it and/or modify
+#- it under the terms of the GNU General Public License as published by
+#- the Free Software Foundation, either version 3 of the License, or
+#- (at your option) any later version.
+#-
+#- This program is distributed in the hope that it will be useful,
+#- but WITHOUT ANY WARRANTY; without even the implied warranty of
+#- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#- GNU General Public License for more details.
+#-
+#- You should have received a copy of the GNU General Public License
+#- along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+"""
+Bandwidth shaping, retries and compressed transfers for the downloads and
+the GData requests.
+
+A Shaper holds token buckets: one global, one per host pattern and one per
+job. The global rate is split between the jobs that are downloading by their
+weight; every transfer takes its bytes from all the buckets that apply and
+waits for the slowest.
+
+Options (rates are bytes/s, with k/M/G suffixes; 0 is unlimited):
+    shape_rate      global rate, optionally by time of day:
+                    "08:00-18:00=1M,22:00-06:00=0,4M" (first matching window,
+                    then the default)
+    shape_hosts     "*.googlevideo.com=2M,host=500k"
+    shape_weights   "jobname=3,other=0.5" (default 1)
+
+Retries for the network requests (RetryPolicy, Breakers): transient errors
+are retried after an exponential backoff with full jitter (or as long as the
+server's Retry-After says), errors that won't go away are not. A host that
+fails net_breaker times in a row is left alone by all the workers for
+net_cooldown seconds, then one more request decides whether it's back.
+    net_retries     attempts after the first one (5)
+    net_backoff     seconds before the first retry, doubled for every
+                    further one (0.5) up to net_backoff_max (60)
+    net_breaker     failures in a row that pause a host (5)
+    net_cooldown    seconds a host is paused for at first (30)
+
+GData requests accept gzip and deflate (ACCEPT_ENCODING); a Decoder
+decompresses the response while the parser reads it.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import time
+import zlib
+import errno
+import socket
+import random
+import fnmatch
+import threading
+from email.utils import parsedate_tz, mktime_tz
+
+try:
+    from urllib.error import HTTPError, URLError
+    from http.client import HTTPException
+except ImportError:
+    from urllib2 import HTTPError, URLError
+    from httplib import HTTPException
+
+import yfmetrics
+
+
+def parse_rate(text):
+    """ '2M' -> 2097152; None for unlimited """
+    text = text.strip()
+    if not text:
+        return None
+    factor = 1
+    suffix = text[-1].upper()
+    if suffix in "KMG":
+        factor = 1024 ** ("KMG".index(suffix) + 1)
+        text = text[:-1]
+    rate = int(float(text) * factor)
+    return rate or None
+
+
+def parse_pairs(text):
+    """ 'a=1,b=2' -> [('a', '1'), ('b', '2')] """
+    pairs = list()
+    for item in filter(None, (i.strip() for i in (text or "").split(","))):
+        key, value = item.rsplit("=", 1)
+        pairs.append((key.strip(), value.strip()))
+    return pairs
+
+
+def format_size(size):
+    return "%.1f MB" % (size / 1048576.)
+
+
+def format_rate(rate):
+    return "%.1f kB/s" % (rate / 1024.) if rate is not None else "unlimited"
+
+
+class Schedule(object):
+    """ A rate by time of day: [((start, stop), rate)] minutes after midnight, and a default """
+    def __init__(self, windows=(), default=None):
+        self.windows    = list(windows)
+        self.default    = default
+
+    @classmethod
+    def parse(cls, text):
+        schedule = cls()
+        for item in filter(None, (i.strip() for i in (text or "").split(","))):
+            if "=" not in item:
+                schedule.default = parse_rate(item)
+                continue
+            window, rate = item.rsplit("=", 1)
+            start, stop = (cls._minutes(t) for t in window.split("-"))
+            schedule.windows.append(((start, stop), parse_rate(rate)))
+        return schedule
+
+    @staticmethod
+    def _minutes(text):
+        hours, minutes = text.strip().split(":")
+        return int(hours) * 60 + int(minutes)
+
+    def rate(self, now=None):
+        t = time.localtime(now)
+        minute = t.tm_hour * 60 + t.tm_min
+        for (start, stop), rate in self.windows:
+            # a window may span midnight
+            if start <= minute < stop if start <= stop else (minute >= start or minute < stop):
+                return rate
+        return self.default
+
+    def __bool__(self):
+        return bool(self.windows) or self.default is not None
+    __nonzero__ = __bool__
+
+
+class TokenBucket(object):
+    """
+    rate bytes/s with up to burst bytes saved up.
+
+    take() hands out tokens on credit: the bucket may go negative, and the
+    caller has to wait until it would have been refilled.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate       = rate
+        self.burst      = burst
+        self.tokens     = self._burst()
+        self.stamp      = time.time()
+        self.lock       = threading.Lock()
+
+    def _burst(self):
+        # a second's worth by default
+        return self.burst if self.burst is not None else (self.rate or 0)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill(time.time())
+            self.rate = rate
+
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(self._burst(), self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, n, now=None):
+        """ Take n tokens; returns the seconds to wait before using them """
+        with self.lock:
+            if not self.rate:
+                return 0.0
+            now = now or time.time()
+            self._refill(now)
+            self.tokens -= n
+            return -self.tokens / float(self.rate) if self.tokens < 0 else 0.0
+
+
+class Transfer(object):
+    """ One download going through the shaper """
+    def __init__(self, shaper, job, host):
+        self.shaper     = shaper
+        self.job        = job
+        self.host       = host
+        self.started    = self.stamp = time.time()
+        self.bytes      = 0
+        self.allotted   = 0.0
+        self.waited     = 0.0
+        self.limited    = False
+
+    def _allot(self, now):
+        rate = self.shaper.allotment(self)
+        if rate is not None:
+            self.allotted += rate * (now - self.stamp)
+            self.limited = True
+        self.stamp = now
+
+    def consume(self, n):
+        """ Account for n bytes received, sleeping as long as the buckets say """
+        now = time.time()
+        self._allot(now)
+        self.bytes += n
+        delay = self.shaper.take(self, n, now)
+        if delay > 0:
+            self.waited += delay
+            time.sleep(delay)
+
+    def close(self):
+        self._allot(time.time())
+        self.shaper.finish(self)
+
+
+class Shaper(object):
+    """ The token buckets of a run, see the module docstring """
+    def __init__(self, schedule=None, hosts=(), weights=None):
+        self.schedule   = schedule or Schedule()
+        self.hosts      = [(pattern, TokenBucket(rate)) for pattern, rate in hosts]
+        self.weights    = dict(weights or {})
+        self.bucket     = TokenBucket(self.schedule.rate())
+        self.jobs       = dict()
+        self.active     = list()
+        self.since      = dict()
+        self.stats      = dict()
+        self.lock       = threading.Lock()
+
+    @classmethod
+    def from_options(cls, db, rate=None):
+        """ The shaper configured in db (rate overrides shape_rate), or None if nothing is limited """
+        schedule = Schedule.parse(rate if rate is not None else db.getOptionValue("shape_rate"))
+        hosts = [(pattern, parse_rate(value)) for pattern, value in parse_pairs(db.getOptionValue("shape_hosts"))]
+        hosts = [(pattern, value) for pattern, value in hosts if value]
+        if not schedule and not hosts:
+            return None
+        weights = dict((job, float(value)) for job, value in parse_pairs(db.getOptionValue("shape_weights")))
+        return cls(schedule, hosts, weights)
+
+    def transfer(self, job, host):
+        transfer = Transfer(self, job, host)
+        with self.lock:
+            if not any(t.job == job for t in self.active):
+                self.since[job] = transfer.started
+            self.active.append(transfer)
+            if job not in self.jobs:
+                self.jobs[job] = TokenBucket(None)
+        return transfer
+
+    def _host_bucket(self, host):
+        for pattern, bucket in self.hosts:
+            if fnmatch.fnmatch(host, pattern):
+                return pattern, bucket
+        return None, None
+
+    def _reshare(self, rate):
+        """ Split rate between the jobs that are downloading by their weight (None: unlimited) """
+        active_jobs = set(t.job for t in self.active)
+        total = sum(self.weights.get(job, 1.0) for job in active_jobs)
+        for job in active_jobs:
+            self.jobs[job].set_rate(rate * self.weights.get(job, 1.0) / total if rate else None)
+
+    def allotment(self, transfer):
+        """ The rate transfer is entitled to right now, None if unlimited """
+        with self.lock:
+            rate = self.schedule.rate()
+            self.bucket.set_rate(rate)
+            # every time, so the shares follow the schedule into unlimited windows, too
+            self._reshare(rate)
+            allotted = None
+            if rate:
+                # the job's share, evenly between its transfers
+                share = self.jobs[transfer.job].rate
+                allotted = share / sum(1 for t in self.active if t.job == transfer.job)
+            pattern, bucket = self._host_bucket(transfer.host)
+            if bucket is not None:
+                host_rate = bucket.rate / float(sum(1 for t in self.active if
+                                                    self._host_bucket(t.host)[0] == pattern))
+                allotted = host_rate if allotted is None else min(allotted, host_rate)
+            return allotted
+
+    def take(self, transfer, n, now):
+        delay = self.bucket.take(n, now)
+        delay = max(delay, self.jobs[transfer.job].take(n, now))
+        bucket = self._host_bucket(transfer.host)[1]
+        if bucket is not None:
+            delay = max(delay, bucket.take(n, now))
+        return delay
+
+    def finish(self, transfer):
+        # a job's throughput is over the time it had any transfer going
+        elapsed = 0.0
+        with self.lock:
+            self.active.remove(transfer)
+            if not any(t.job == transfer.job for t in self.active):
+                elapsed = transfer.stamp - self.since.pop(transfer.job)
+                # the others get what this job leaves
+                self._reshare(self.schedule.rate())
+            stats = self.stats.setdefault(transfer.job, dict(bytes=0, seconds=0.0, allotted=0.0, waited=0.0))
+            stats["bytes"] += transfer.bytes
+            stats["seconds"] += elapsed
+            stats["waited"] += transfer.waited
+            if transfer.limited:
+                stats["allotted"] += transfer.allotted
+        yfmetrics.count("shaped_bytes", transfer.bytes)
+        if elapsed:
+            yfmetrics.count("shaped_seconds", elapsed)
+        yfmetrics.count("throttled_seconds", transfer.waited)
+        if transfer.limited:
+            yfmetrics.count("allotted_bytes", int(transfer.allotted))
+
+    def summary(self):
+        """ Print actual and allotted throughput per job """
+        print("[SHAPE] Bandwidth now: %s" % format_rate(self.schedule.rate()))
+        with self.lock:
+            stats = sorted(self.stats.items())
+        for job, st in stats:
+            if not st["seconds"]:
+                continue
+            print("[SHAPE] %-20s %s of %s allotted, waited %.1fs" % (
+                job, format_rate(st["bytes"] / st["seconds"]),
+                format_rate(st["allotted"] / st["seconds"]) if st["allotted"] else "unlimited",
+                st["waited"]))
+
+
+#------------------------------
+# Retries
+TRANSIENT   = "transient"
+FATAL       = "fatal"
+
+# 403 is transient for the video servers: they answer throttled clients with
+# it, too. GData means it (private videos, suspended users), see API_FATAL
+FATAL_CODES = frozenset((400, 401, 404, 405, 410, 411, 413, 414, 416, 451))
+API_FATAL   = FATAL_CODES | frozenset((403,))
+NET_ERRNOS  = frozenset(getattr(errno, name) for name in ("ECONNRESET", "ECONNREFUSED", "ECONNABORTED",
+              "ETIMEDOUT", "EPIPE", "EHOSTUNREACH", "ENETUNREACH", "ENETDOWN") if hasattr(errno, name))
+
+
+def retry_after(headers, now=None):
+    """ The seconds a Retry-After header asks for, None if there is none """
+    value = headers.get("Retry-After") if headers is not None else None
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, mktime_tz(date) - (now or time.time()))
+
+
+class Unavailable(URLError):
+    """ There is no answer to be had right now, retrying won't help """
+
+
+class HostPaused(Unavailable):
+    """ A host is paused for longer than we're willing to wait """
+
+
+def classify(exc, fatal=FATAL_CODES):
+    """
+    (kind, delay) for an exception raised by a request: kind is TRANSIENT or
+    FATAL, delay what the server asked us to wait (or None). HTTP errors are
+    FATAL if their code is in fatal (or they aren't errors, like 304)
+    """
+    if isinstance(exc, Unavailable):
+        return FATAL, None
+    if isinstance(exc, HTTPError):
+        code = exc.getcode()
+        if code in fatal or code < 400:
+            return FATAL, None
+        return TRANSIENT, retry_after(exc.headers)
+    if isinstance(exc, (URLError, HTTPException, socket.timeout, socket.gaierror)):
+        return TRANSIENT, None
+    if isinstance(exc, EnvironmentError) and (exc.errno is None or exc.errno in NET_ERRNOS):
+        # connection refused/reset and short reads; a full disk is not going to get better
+        return TRANSIENT, None
+    return FATAL, None
+
+
+class RetryPolicy(object):
+    """ Exponential backoff with full jitter, capped at cap seconds """
+    def __init__(self, retries=5, base=0.5, cap=60.0):
+        self.retries    = retries
+        self.base       = base
+        self.cap        = cap
+
+    @classmethod
+    def from_options(cls, db):
+        return cls(int(db.getOptionValue("net_retries") or 5),
+                   float(db.getOptionValue("net_backoff") or 0.5),
+                   float(db.getOptionValue("net_backoff_max") or 60))
+
+    def delay(self, retry, asked=None):
+        """ Seconds to wait before retry number retry (0-based); the server may ask for more """
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** retry))
+        if asked is not None:
+            # honor Retry-After, but don't let a server park us for hours
+            delay = max(delay, min(asked, self.cap))
+        return delay
+
+
+class Breakers(object):
+    """
+    Per-host circuit breakers, shared by all the workers of a process.
+
+    A host is open after threshold consecutive failures: wait() blocks
+    everybody until cooldown seconds have passed, then the host is half open,
+    one request goes through and its outcome closes the host again or opens
+    it for twice the cooldown (up to ten times). Those who'd have to wait
+    longer than they're willing to get HostPaused instead.
+    """
+    def __init__(self, threshold=5, cooldown=30.0):
+        self.threshold  = threshold
+        self.cooldown   = cooldown
+        self.hosts      = dict()
+        self.lock       = threading.Condition(threading.Lock())
+
+    @classmethod
+    def from_options(cls, db):
+        return cls(int(db.getOptionValue("net_breaker") or 5), float(db.getOptionValue("net_cooldown") or 30))
+
+    def _host(self, host):
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = dict(failures=0, until=0.0, cooldown=self.cooldown,
+                                            probing=0.0, trips=0, waited=0.0)
+        return state
+
+    def wait(self, host, limit=None):
+        """ Block while host is open; returns the seconds waited """
+        waited = 0.0
+        with self.lock:
+            state = self._host(host)
+            while True:
+                now = time.time()
+                if limit is not None and state["until"] - now > limit:
+                    state["waited"] += waited
+                    raise HostPaused("%s is paused for %.0fs" % (host, state["until"] - now))
+                if now < state["until"]:
+                    self.lock.wait(state["until"] - now)
+                elif state["until"] and now - state["probing"] < state["cooldown"]:
+                    # half open, somebody else is finding out
+                    self.lock.wait(1.0)
+                else:
+                    break
+                waited += time.time() - now
+            if state["until"]:
+                state["probing"] = time.time()
+            state["waited"] += waited
+        if waited:
+            yfmetrics.count("breaker_wait_seconds", waited)
+        return waited
+
+    def success(self, host):
+        with self.lock:
+            state = self._host(host)
+            if state["until"]:
+                print("[ NET ] %s is back" % host)
+            state.update(failures=0, until=0.0, cooldown=self.cooldown, probing=0.0)
+            self.lock.notify_all()
+
+    def failure(self, host):
+        """ Count a transient failure; True if it opened the host """
+        with self.lock:
+            state = self._host(host)
+            state["failures"] += 1
+            if state["until"] and state["probing"]:
+                # the probe failed, back off for longer
+                state["cooldown"] = min(state["cooldown"] * 2, self.cooldown * 10)
+            elif state["failures"] < self.threshold or state["until"] > time.time():
+                return False
+            state["until"] = time.time() + state["cooldown"]
+            state["probing"] = 0.0
+            state["trips"] += 1
+            self.lock.notify_all()
+        print("[ NET ] %s failed %i times in a row, pausing it for %.0fs" % (host, state["failures"], state["cooldown"]))
+        yfmetrics.count("breaker_trips")
+        return True
+
+    def stats(self):
+        """ {host: dict(failures, trips, waited, open)} of the hosts that are failing or were paused """
+        now = time.time()
+        with self.lock:
+            return dict((host, dict(failures=state["failures"], trips=state["trips"],
+                                    waited=round(state["waited"], 3), open=state["until"] > now))
+                        for host, state in self.hosts.items() if state["trips"] or state["failures"])
+
+    def summary(self):
+        """ Print the hosts that failed or were paused """
+        with self.lock:
+            hosts = sorted((host, dict(state)) for host, state in self.hosts.items() if state["trips"] or state["failures"])
+        now = time.time()
+        for host, state in hosts:
+            print("[ NET ] %-30s paused %i times, waited %.1fs%s" % (
+                host, state["trips"], state["waited"],
+                ", open for %.0fs more" % (state["until"] - now) if state["until"] > now else ""))
+
+
+# what gdata and the downloads go by, see configure()
+policy      = RetryPolicy()
+breakers    = Breakers()
+
+
+def configure(db):
+    """ Set up the retry policy and the breakers from the options in db """
+    global policy, breakers
+    policy = RetryPolicy.from_options(db)
+    breakers = Breakers.from_options(db)
+
+
+def call(func, host, label="request", fatal=FATAL_CODES):
+    """
+    func() with retries: transient errors are retried after the policy's
+    backoff, the breakers decide whether host may be asked at all. The last
+    error is raised.
+    """
+    retry = 0
+    while True:
+        breakers.wait(host, policy.cap)
+        try:
+            result = func()
+        except Exception as e:
+            kind, asked = classify(e, fatal)
+            yfmetrics.count("errors_" + kind)
+            if kind == FATAL:
+                # the host did answer
+                breakers.success(host)
+                raise
+            breakers.failure(host)
+            if retry >= policy.retries:
+                raise
+            delay = policy.delay(retry, asked)
+            print("[ NET ] %s failed (%s), retrying in %.1fs" % (label, e, delay))
+            yfmetrics.count("retries")
+            yfmetrics.count("retry_wait_seconds", delay)
+            time.sleep(delay)
+            retry += 1
+        else:
+            breakers.success(host)
+            return result
+
+
+#------------------------------
+# Compression
+ACCEPT_ENCODING = "gzip, deflate"
+
+
+class Decoder(object):
+    """
+    Reads a response and decodes its Content-Encoding (gzip or deflate) on
+    the way, a chunk at a time, so the parser never needs the whole body.
+    The bytes on the wire and decoded are counted as counter_wire_bytes and
+    counter_decoded_bytes when it's closed.
+    """
+    def __init__(self, fp, counter="gdata", chunk=16384):
+        self.fp         = fp
+        self.counter    = counter
+        self.chunk      = chunk
+        self.encoding   = (fp.info().get("Content-Encoding") or "identity").strip().lower()
+        self.zlib       = None
+        if self.encoding in ("gzip", "x-gzip"):
+            self.zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer     = b""
+        self.eof        = False
+        self.wire       = 0
+        self.decoded    = 0
+        self.closed     = False
+
+    def _decompressor(self, data):
+        # deflate ought to come with a zlib header, but some servers send it raw
+        head = bytearray(data[:2])
+        if len(head) == 2 and head[0] & 0x0f == 8 and (head[0] << 8 | head[1]) % 31 == 0:
+            return zlib.decompressobj(zlib.MAX_WBITS)
+        return zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def _fill(self, n):
+        while (n < 0 or len(self.buffer) < n) and not self.eof:
+            data = self.fp.read(self.chunk)
+            self.wire += len(data)
+            if not data:
+                self.eof = True
+                if self.zlib is not None:
+                    self.buffer += self.zlib.flush()
+                break
+            if self.encoding == "deflate" and self.zlib is None:
+                self.zlib = self._decompressor(data)
+            self.buffer += self.zlib.decompress(data) if self.zlib is not None else data
+
+    def read(self, n=-1):
+        if n is None:
+            n = -1
+        self._fill(n)
+        if n < 0:
+            data, self.buffer = self.buffer, b""
+        else:
+            data, self.buffer = self.buffer[:n], self.buffer[n:]
+        self.decoded += len(data)
+        return data
+
+    def info(self):
+        return self.fp.info()
+
+    def getcode(self):
+        return self.fp.getcode()
+
+    def geturl(self):
+        return self.fp.geturl()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.fp.close()
+        yfmetrics.count(self.counter + "_wire_bytes", self.wire)
+        yfmetrics.count(self.counter + "_decoded_bytes", self.decoded)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_decoded(urlopen, req, counter="gdata"):
+    """
+    urlopen(req) for a request that accepts ACCEPT_ENCODING: the response,
+    or the body of an HTTPError, wrapped in a Decoder
+    """
+    try:
+        return Decoder(urlopen(req), counter)
+    except HTTPError as e:
+        if e.fp is None:
+            raise
+        # the error goes on reading through the decoder
+        raise HTTPError(e.filename, e.code, e.msg, e.hdrs, Decoder(e, counter))
@@ -0,0 +1,474 @@
+#!/usr/bin/python3
+#-------------------------------------------------------------------------------
+#- YouFeed scheduling
+#- Copyright (C) 2013  Orochimarufan
+#-                 Authors: Orochimarufan <orochimarufan.x3@gmail.com>
+#-
+#- This program is free software: you can redistribute it and/or modify
+#- it under the terms of the GNU General Public License as published by
+#- the Free Software Foundation, either version 3 of the License, or
+#- (at your option) any later version.
+#-
+#- This program is distributed in the hope that it will be useful,
+#- but WITHOUT ANY WARRANTY; without even the implied warranty of
+#- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#- GNU General Public License for more details.
+#-
+#- You should have received a copy of the GNU General Public License
+#- along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+"""
+Decides when a playlist is checked next.
+
+Every sync is recorded in yfdb's sync_history. A playlist that changed goes
+into the fast lane (checked again after min_interval); one that didn't backs
+off exponentially, but never to more than a fraction of the time since its
+last change, so a playlist that was active yesterday isn't left alone for a
+week. Everything is capped at max_interval.
+
+The downloads table is the persistent backlog: run_video queues into it,
+the download workers work it off and record their progress, so a run that
+was interrupted is picked up by the next one right away. DownloadQueue
+shares a fixed number of download workers between the jobs that run
+concurrently.
+
+Downloads of a higher priority (the job's, or set with 'youfeed queue
+priority') go first. Among the rest, the order is one of ORDERS:
+    index       playlist order
+    newest      most recently uploaded first
+    shortest    shortest duration first
+    smallest    smallest estimated size first
+With a deadline, the queue leaves the downloads that can't be done in time at
+the throughput seen so far for the next run; smallest first gets the most done.
+In adaptive mode, it rather has the downloads step down the formats they
+accept, so everything waiting fits (see step_down).
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import sys
+import json
+import time
+import threading
+import heapq
+import traceback
+from collections import deque, OrderedDict
+
+import yfdb
+import yfmetrics
+
+
+# sync_history rows to keep per playlist
+HISTORY = 50
+
+
+class Policy(object):
+    """ The scheduling parameters, all intervals in seconds """
+    def __init__(self, min_interval=30 * 60, max_interval=24 * 3600, backoff=2.0, ratio=0.5):
+        self.min_interval   = min_interval
+        self.max_interval   = max_interval
+        self.backoff        = backoff
+        self.ratio          = ratio
+
+    @classmethod
+    def from_options(cls, db):
+        """ sched_min, sched_max (minutes) and sched_backoff from the config """
+        policy = cls()
+        value = db.getOptionValue("sched_min")
+        if value:
+            policy.min_interval = int(float(value) * 60)
+        value = db.getOptionValue("sched_max")
+        if value:
+            policy.max_interval = int(float(value) * 60)
+        value = db.getOptionValue("sched_backoff")
+        if value:
+            policy.backoff = float(value)
+        return policy
+
+    def interval(self, previous, new_items, since_change):
+        if new_items:
+            interval = self.min_interval
+        else:
+            interval = (previous or self.min_interval) * self.backoff
+            if since_change is not None:
+                interval = min(interval, since_change * self.ratio)
+        return int(max(self.min_interval, min(self.max_interval, interval)))
+
+
+def record_sync(session, playlist_id, new_items, total_items, policy, now=None):
+    """ Record a sync of playlist_id and schedule its next check """
+    if now is None:
+        now = int(time.time())
+    session.add(yfdb.SyncRecord(playlist_id=playlist_id, time=now,
+                                new_items=new_items, total_items=total_items))
+
+    # forget old history
+    old = session.query(yfdb.SyncRecord.id).\
+        filter(yfdb.SyncRecord.playlist_id == playlist_id).\
+        order_by(yfdb.SyncRecord.id.desc()).offset(HISTORY).first()
+    if old is not None:
+        session.query(yfdb.SyncRecord).\
+            filter(yfdb.SyncRecord.playlist_id == playlist_id).\
+            filter(yfdb.SyncRecord.id <= old.id).delete(synchronize_session=False)
+
+    schedule = session.query(yfdb.PlaylistSchedule).get(playlist_id)
+    if schedule is None:
+        schedule = yfdb.PlaylistSchedule(playlist_id=playlist_id)
+        session.add(schedule)
+    if new_items or schedule.last_change is None:
+        schedule.last_change = now
+        since_change = None
+    else:
+        since_change = now - schedule.last_change
+    schedule.interval = policy.interval(schedule.interval, new_items, since_change)
+    schedule.last_check = now
+    schedule.next_check = now + schedule.interval
+    return schedule
+
+
+def due_jobs(session, jobs, now=None):
+    """ The jobs whose playlist is due for a check; jobs that don't sync are never due """
+    if now is None:
+        now = int(time.time())
+    playlist_ids = [job.playlist_id for job in jobs]
+    schedules = dict((s.playlist_id, s) for s in session.query(yfdb.PlaylistSchedule).
+                     filter(yfdb.PlaylistSchedule.playlist_id.in_(playlist_ids)).all()) if playlist_ids else {}
+    due = list()
+    for job in jobs:
+        if job.status & yfdb.Job.ST_NOSYNC:
+            continue
+        schedule = schedules.get(job.playlist_id)
+        if schedule is None or schedule.next_check is None or schedule.next_check <= now:
+            due.append(job)
+    return due
+
+
+#------------------------------------------------------------
+# Download order
+#------------------------------------------------------------
+ORDERS = ("index", "newest", "shortest", "smallest")
+
+# rough bytes/s of the youtube formats, audio included
+FORMAT_RATES = {
+    5: 40000, 17: 10000, 18: 75000, 22: 300000, 34: 75000, 35: 125000,
+    36: 25000, 37: 500000, 38: 750000, 43: 75000, 44: 125000, 45: 300000,
+    46: 500000,
+}
+
+
+def estimate_size(duration, formats):
+    """ The bytes we'd expect for duration seconds in the best of formats, None if unknown """
+    if not duration or not formats:
+        return None
+    rate = FORMAT_RATES.get(formats[0])
+    return duration * rate if rate is not None else None
+
+
+def rank(order, video, formats):
+    """ Sort key of video among downloads of the same priority; unknowns go last """
+    if order == "newest":
+        # the uploaded timestamps are ISO 8601, negate them character by character
+        return (video.uploaded is None, tuple(-ord(c) for c in video.uploaded or ""))
+    if order == "shortest":
+        return (video.duration is None, video.duration or 0)
+    if order == "smallest":
+        size = estimate_size(video.duration, formats)
+        return (size is None, size or 0)
+    return ()
+
+
+def step_down(formats, factor):
+    """
+    formats (best first), starting with the best one that takes at most
+    factor times the bytes of the first; at least the last one
+    """
+    if factor >= 1 or not formats:
+        return formats
+    best = FORMAT_RATES.get(formats[0])
+    if best is None:
+        return formats
+    for i, fmt in enumerate(formats):
+        rate = FORMAT_RATES.get(fmt)
+        if rate is not None and rate <= best * factor:
+            return formats[i:]
+    return formats[-1:]
+
+
+def parse_deadline(text, now=None):
+    """ 'HH:MM' -> the unix time it is next """
+    hours, minutes = (int(i) for i in text.split(":"))
+    if now is None:
+        now = time.time()
+    t = time.localtime(now)
+    deadline = time.mktime((t.tm_year, t.tm_mon, t.tm_mday, hours, minutes, 0, 0, 0, -1))
+    if deadline <= now:
+        deadline = time.mktime((t.tm_year, t.tm_mon, t.tm_mday + 1, hours, minutes, 0, 0, 0, -1))
+    return deadline
+
+
+#------------------------------------------------------------
+# Download backlog
+#------------------------------------------------------------
+# the jobs of a run enqueue from their own sessions
+_enqueue_lock = threading.Lock()
+
+def enqueue(session, job, video_id, formats, priority=0, now=None):
+    """
+    Queue video_id for job, or return the download that's already queued (or
+    failed) for it. Commits the session.
+    """
+    with _enqueue_lock:
+        download = session.query(yfdb.Download).\
+            filter(yfdb.Download.video_id == video_id).\
+            filter(yfdb.Download.state != yfdb.Download.ST_DONE).first()
+        if download is not None:
+            download.priority = max(download.priority, priority)
+            if download.state == yfdb.Download.ST_FAILED:
+                # give it another go, like every run did before there was a queue
+                set_state(download, yfdb.Download.ST_PENDING)
+        else:
+            if now is None:
+                now = int(time.time())
+            download = yfdb.Download(video_id=video_id, job=job, formats=json.dumps(list(formats)),
+                                     state=yfdb.Download.ST_PENDING, priority=priority, attempts=0,
+                                     bytes_done=0, created=now, updated=now)
+            session.add(download)
+        session.commit()
+    return download
+
+
+def set_state(download, state, error=None):
+    download.state = state
+    download.updated = int(time.time())
+    if error is not None:
+        download.last_error = error
+
+
+def recover(session, now=None):
+    """
+    Put the downloads a dead run or worker left half done back to pending.
+    
+    Those are the active ones that nobody holds a live lease on.
+    """
+    if now is None:
+        now = int(time.time())
+    live = set(key for key, in session.query(yfdb.Lease.key).
+               filter(yfdb.Lease.kind == "download").filter(yfdb.Lease.expires >= now))
+    recovered = 0
+    for download in session.query(yfdb.Download).filter(yfdb.Download.state.in_(yfdb.Download.ACTIVE)):
+        if download.video_id not in live:
+            set_state(download, yfdb.Download.ST_PENDING)
+            recovered += 1
+    return recovered
+
+
+def pending(session, order="index"):
+    """ The pending downloads, most important first """
+    downloads = session.query(yfdb.Download).\
+        filter(yfdb.Download.state == yfdb.Download.ST_PENDING).\
+        order_by(yfdb.Download.priority.desc(), yfdb.Download.id.asc()).all()
+    if order != "index":
+        downloads.sort(key=lambda d: (-d.priority, rank(order, d.video, json.loads(d.formats))))
+    return downloads
+
+
+#------------------------------------------------------------
+# Download workers
+#------------------------------------------------------------
+# the Task a download worker is running
+_local = threading.local()
+
+def current_task():
+    return getattr(_local, "task", None)
+
+
+class Task(object):
+    """ A queued download; wait() returns what func returned (None if it raised or was left for later) """
+    def __init__(self, key, func, args, priority=0, rank=(), size=None, min_size=None, cancel=None):
+        self.key        = key
+        self.func       = func
+        self.args       = args
+        self.priority   = priority
+        self.rank       = rank
+        # estimated bytes, if known, and in the worst format it accepts
+        self.size       = size
+        self.min_size   = min_size
+        # called instead of func when the task is skipped
+        self.cancel     = cancel
+        # set by the queue: the share of size it should get by with (see step_down)
+        self.factor     = 1.0
+        # set by func: the estimated size of the format it got, if it stepped down
+        self.got_size   = None
+        self.result     = None
+        self.done       = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception:
+            print("[ERROR] " + "".join(traceback.format_exception(*sys.exc_info())))
+        finally:
+            self.done.set()
+
+    def skip(self):
+        try:
+            if self.cancel is not None:
+                self.cancel()
+        finally:
+            self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        return self.result
+
+
+class DownloadQueue(object):
+    """
+    The downloads of all running jobs, worked off by a fixed number of threads.
+    
+    Every job has its own line and the workers take from the lines in turn, so
+    a job with three new videos doesn't wait behind one with three hundred;
+    only a line whose next download has a higher priority goes out of turn.
+    Within a line, downloads go by priority, then rank (see ORDERS).
+    put() blocks while maxsize downloads are waiting, which holds back the jobs
+    that scan faster than we download; a job that has nothing waiting may
+    always queue one, so it isn't starved by the others' backlog.
+    
+    Two jobs that want the same video get the same Task. With no workers,
+    put() runs the download right away. After deadline (unix time), or when
+    the estimated size of a download can't be transferred by then, it is
+    skipped. If adaptive, a download is given a factor < 1 when the
+    downloads waiting (it included) won't fit before the deadline at the
+    recent throughput, and is only skipped if it won't fit in its worst
+    format.
+    """
+    def __init__(self, workers=2, maxsize=16, deadline=None, adaptive=False):
+        self.maxsize    = maxsize
+        self.deadline   = deadline
+        self.adaptive   = adaptive
+        self.lines      = OrderedDict()
+        self.tasks      = dict()
+        self.waiting    = 0
+        self.serial     = 0
+        self.closed     = False
+        self.cond       = threading.Condition()
+        # (estimated bytes, seconds) of the last downloads, for the deadline;
+        # estimates on both sides, so a bias in FORMAT_RATES cancels out
+        self.history    = deque(maxlen=10)
+        self.threads    = list()
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name="download-%i" % (i + 1))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, job, key, func, *args, **kw):
+        """
+        Queue func(*args) on behalf of job, returns a Task (the one already queued for key, if any)
+        
+        keywords: priority, rank and size (estimated bytes) of the download,
+        cancel is called if it is skipped
+        """
+        with self.cond:
+            task = self.tasks.get(key)
+            if task is not None:
+                return task
+            task = self.tasks[key] = Task(key, func, args, **kw)
+            if self.threads:
+                while self.waiting >= self.maxsize and self.lines.get(job):
+                    self.cond.wait()
+                heapq.heappush(self.lines.setdefault(job, list()),
+                               (-task.priority, task.rank, self.serial, task))
+                self.serial += 1
+                self.waiting += 1
+                self.cond.notify_all()
+                return task
+        self._run(task)
+        return task
+
+    def _next(self):
+        with self.cond:
+            while not self.waiting and not self.closed:
+                self.cond.wait()
+            if not self.waiting:
+                return None
+            # the first line in the rotation that has the most important download, then it goes to the back
+            job, line = None, None
+            for j, l in self.lines.items():
+                if line is None or l[0][0] < line[0][0]:
+                    job, line = j, l
+            del self.lines[job]
+            task = heapq.heappop(line)[-1]
+            if line:
+                self.lines[job] = line
+            self.waiting -= 1
+            self.cond.notify_all()
+            return task
+
+    def rate(self):
+        """ Recent (estimated) bytes/s of a single download, None before the first """
+        with self.cond:
+            seconds = sum(s for b, s in self.history)
+            return sum(b for b, s in self.history) / seconds if seconds else None
+
+    def fits(self, task, now=None):
+        """ Whether task can still be done before the deadline """
+        if self.deadline is None:
+            return True
+        left = self.deadline - (now or time.time())
+        if left <= 0:
+            return False
+        size = task.min_size if self.adaptive and task.min_size else task.size
+        rate = self.rate()
+        if size is None or rate is None:
+            return True
+        return size / rate <= left
+
+    def factor(self, task, now=None):
+        """ The share of its size task should get by with, so everything waiting fits """
+        rate = self.rate()
+        if not self.adaptive or self.deadline is None or rate is None:
+            return 1.0
+        left = self.deadline - (now or time.time())
+        capacity = rate * max(1, len(self.threads)) * left
+        with self.cond:
+            sizes = [entry[-1].size for line in self.lines.values() for entry in line]
+        remaining = sum(size for size in sizes + [task.size] if size)
+        factor = capacity / remaining if remaining else 1.0
+        # and it has to be done in time itself, whatever the others do
+        if task.size:
+            factor = min(factor, rate * left / task.size)
+        return max(0.0, min(1.0, factor))
+
+    def _run(self, task):
+        if not self.fits(task):
+            print("[QUEUE] Leaving %s for the next run, it can't be done in time" % task.key)
+            yfmetrics.count("downloads_postponed")
+            task.skip()
+            return
+        task.factor = self.factor(task)
+        start = time.time()
+        _local.task = task
+        try:
+            task.run()
+        finally:
+            _local.task = None
+        done = task.got_size if task.got_size is not None else task.size
+        if done and task.result is not None:
+            with self.cond:
+                self.history.append((done, time.time() - start))
+
+    def _work(self):
+        while True:
+            task = self._next()
+            if task is None:
+                return
+            self._run(task)
+
+    def close(self):
+        """ Finish what's queued and stop the workers """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,272 @@
+#!/usr/bin/python3
+#-------------------------------------------------------------------------------
+#- YouFeed daemon
+#- Copyright (C) 2013  Orochimarufan
+#-                 Authors: Orochimarufan <orochimarufan.x3@gmail.com>
+#-
+#- This program is free software: you can redistribute it and/or modify
+#- it under the terms of the GNU General Public License as published by
+#- the Free Software Foundation, either version 3 of the License, or
+#- (at your option) any later version.
+#-
+#- This program is distributed in the hope that it will be useful,
+#- but WITHOUT ANY WARRANTY; without even the implied warranty of
+#- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#- GNU General Public License for more details.
+#-
+#- You should have received a copy of the GNU General Public License
+#- along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+"""
+The 'youfeed serve' daemon and its control socket.
+
+The daemon keeps one process (and with it the imports, the database engine
+and the resolve cache) around, runs the jobs periodically and executes
+commands it gets on a unix socket next to the database.
+
+Protocol: the client sends one json line, either
+    {"argv": [...], "cwd": "..."}   run a youfeed commandline
+    {"control": "status"}           status, pause, resume or stop
+and the daemon answers with json lines {"out": "..."} carrying the output,
+followed by a final {"status": n}.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import threading
+
+try:
+    from socketserver import ThreadingMixIn, UnixStreamServer, StreamRequestHandler
+except ImportError:
+    from SocketServer import ThreadingMixIn, UnixStreamServer, StreamRequestHandler
+
+
+def socket_path(database):
+    """ The control socket of the daemon serving database """
+    return os.path.abspath(database) + ".sock"
+
+
+class ServerUnavailable(Exception):
+    """ There is no daemon listening on the socket """
+
+
+#------------------------------------------------------------
+# Client
+#------------------------------------------------------------
+def request(path, message, out=None):
+    """
+    Send a message to the daemon, copy its output to out.
+    Returns the exit status; raises ServerUnavailable if nobody is listening.
+    """
+    if out is None:
+        out = sys.stdout
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error as e:
+            raise ServerUnavailable(str(e))
+        sock.sendall(json.dumps(message).encode("utf8") + b"\n")
+        fp = sock.makefile("rb")
+        for line in fp:
+            reply = json.loads(line.decode("utf8"))
+            if "out" in reply:
+                out.write(reply["out"])
+                out.flush()
+            if "status" in reply:
+                return reply["status"]
+        # don't let the caller retry: the command may have run (partly)
+        out.write("[ERROR] youfeed serve closed the connection\n")
+        return 1
+    finally:
+        sock.close()
+
+
+#------------------------------------------------------------
+# Daemon
+#------------------------------------------------------------
+class SocketWriter(object):
+    """ File-like object that sends what's written to a client """
+    def __init__(self, wfile):
+        self.wfile  = wfile
+        self.closed = False
+
+    def write(self, text):
+        if not text or self.closed:
+            return
+        try:
+            self.wfile.write(json.dumps({"out": text}).encode("utf8") + b"\n")
+            self.wfile.flush()
+        except (IOError, OSError, socket.error):
+            # the client went away, let the command finish regardless
+            self.closed = True
+
+    def flush(self):
+        pass
+
+
+class ControlHandler(StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            message = json.loads(line.decode("utf8"))
+        except ValueError:
+            return self.reply(status=2, out="[ERROR] Malformed request\n")
+        out = SocketWriter(self.wfile)
+        status = self.server.daemon.handle(message, out)
+        if not out.closed:
+            self.reply(status=status)
+
+    def reply(self, **kw):
+        self.wfile.write(json.dumps(kw).encode("utf8") + b"\n")
+
+
+class ControlServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon(object):
+    """
+    Runs command (a youfeed argv) every interval seconds and the commands it
+    is sent.
+
+    execute(argv) runs a youfeed commandline, sys.stdout is pointed at the
+    client while it does. Commands (and the periodic runs) are executed one
+    at a time.
+    """
+    def __init__(self, path, execute, interval, command=("run",)):
+        self.path       = path
+        self.execute    = execute
+        self.interval   = interval
+        self.command    = list(command)
+        self.paused     = False
+        self.started    = time.time()
+        self.next_run   = time.time()
+        self.last_run   = None
+        self.current    = None
+        self.commands   = 0
+        self.lock       = threading.Lock()
+        self.stopping   = threading.Event()
+        self.wakeup     = threading.Event()
+        self.server     = None
+
+    #------------------------------
+    # Control socket
+    def bind(self):
+        if os.path.exists(self.path):
+            # a leftover from a daemon that died, or one that is still running?
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                os.unlink(self.path)
+            else:
+                raise ServerUnavailable("Another youfeed serve is already listening on %s" % self.path)
+            finally:
+                probe.close()
+        umask = os.umask(0o077)
+        try:
+            self.server = ControlServer(self.path, ControlHandler)
+        finally:
+            os.umask(umask)
+        self.server.daemon = self
+        thread = threading.Thread(target=self.server.serve_forever, name="control")
+        thread.daemon = True
+        thread.start()
+
+    def handle(self, message, out):
+        if "control" in message:
+            return self.control(message["control"], out)
+        argv = message.get("argv", [])
+        return self.run_locked(argv, out, message.get("cwd"))
+
+    def control(self, command, out):
+        if command == "status":
+            out.write(self.status())
+        elif command == "pause":
+            self.paused = True
+            out.write("[SERVE] Periodic runs paused\n")
+        elif command == "resume":
+            self.paused = False
+            out.write("[SERVE] Periodic runs resumed\n")
+            self.wakeup.set()
+        elif command == "stop":
+            out.write("[SERVE] Stopping\n")
+            self.stop()
+        else:
+            out.write("[ERROR] Unknown control command: %s\n" % command)
+            return 2
+        return 0
+
+    def status(self):
+        now = time.time()
+        lines = ["[SERVE] pid %i, up %is, %i commands" % (os.getpid(), now - self.started, self.commands),
+                 "[SERVE] busy: %s" % (" ".join(self.current) if self.current else "no"),
+                 "[SERVE] periodic runs: %s" % ("paused" if self.paused else "every %is" % self.interval)]
+        if self.last_run:
+            lines.append("[SERVE] last run: %s" % time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.last_run)))
+        if not self.paused:
+            lines.append("[SERVE] next run: in %is" % max(0, self.next_run - now))
+        return "\n".join(lines) + "\n"
+
+    #------------------------------
+    # Execution
+    def run_locked(self, argv, out, cwd=None):
+        with self.lock:
+            self.current = argv
+            self.commands += 1
+            stdout, sys.stdout = sys.stdout, out
+            here = os.getcwd()
+            try:
+                if cwd:
+                    os.chdir(cwd)
+                return self.execute(argv) or 0
+            except SystemExit as e:
+                # argparse errors
+                return e.code if isinstance(e.code, int) else 1
+            except Exception:
+                import traceback
+                out.write(traceback.format_exc())
+                return 1
+            finally:
+                os.chdir(here)
+                sys.stdout = stdout
+                self.current = None
+
+    def serve(self):
+        """ The main loop: run periodically until stopped """
+        self.bind()
+        print("[SERVE] Listening on %s, running every %is" % (self.path, self.interval))
+        try:
+            while not self.stopping.is_set():
+                timeout = max(0, self.next_run - time.time()) if not self.paused else None
+                self.wakeup.wait(timeout)
+                self.wakeup.clear()
+                if self.stopping.is_set():
+                    break
+                if self.paused or time.time() < self.next_run:
+                    continue
+                self.last_run = time.time()
+                self.run_locked(self.command, sys.stdout)
+                self.next_run = self.last_run + self.interval
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+            try:
+                os.unlink(self.path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return 0
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
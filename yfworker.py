@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+#-------------------------------------------------------------------------------
+#- YouFeed workers
+#- Copyright (C) 2013  Orochimarufan
+#-                 Authors: Orochimarufan <orochimarufan.x3@gmail.com>
+#-
+#- This program is free software: you can redistribute it and/or modify
+#- it under the terms of the GNU General Public License as published by
+#- the Free Software Foundation, either version 3 of the License, or
+#- (at your option) any later version.
+#-
+#- This program is distributed in the hope that it will be useful,
+#- but WITHOUT ANY WARRANTY; without even the implied warranty of
+#- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#- GNU General Public License for more details.
+#-
+#- You should have received a copy of the GNU General Public License
+#- along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+"""
+Leases for 'youfeed worker'.
+
+Any number of workers, on one or more machines, may share a database and the
+library storage. Before a worker runs a job or downloads a video it
+claims a lease row in yfdb; the lease names the worker and expires after ttl
+seconds unless the worker's heartbeat renews it. A worker that dies leaves
+its leases to expire, then they can be claimed by the others.
+
+The clocks of the machines have to agree to well within ttl.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import os
+import time
+import uuid
+import socket
+import threading
+
+
+def owner_id():
+    """ host:pid:random, unique among the workers of a database """
+    return "%s:%i:%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+class Leases(object):
+    """ The leases of this worker, renewed every ttl/3 seconds while started """
+    def __init__(self, db, ttl=60, owner=None):
+        self.db         = db
+        self.ttl        = ttl
+        self.owner      = owner or owner_id()
+        self.held       = set()
+        self.lock       = threading.Lock()
+        self.stopping   = threading.Event()
+        self.thread     = None
+
+    def claim(self, kind, key):
+        """ Try to get the lease on (kind, key); True if we hold it now """
+        if not self.db.claimLease(kind, key, self.owner, self.ttl, int(time.time())):
+            return False
+        with self.lock:
+            self.held.add((kind, key))
+        return True
+
+    def release(self, kind, key):
+        with self.lock:
+            self.held.discard((kind, key))
+        self.db.releaseLease(kind, key, self.owner)
+
+    def renew(self):
+        """ Renew everything we hold; returns the leases that were lost to another worker """
+        # hold the lock, so a lease claimed meanwhile doesn't look lost
+        with self.lock:
+            held = self.db.renewLeases(self.owner, self.ttl, int(time.time()))
+            lost = self.held - held
+            self.held -= lost
+        for kind, key in lost:
+            print("[WORKER] Lost the lease on %s %s" % (kind, key))
+        return lost
+
+    #------------------------------
+    # Heartbeat
+    def start(self):
+        self.thread = threading.Thread(target=self._heartbeat, name="heartbeat")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def _heartbeat(self):
+        while not self.stopping.wait(self.ttl / 3.):
+            try:
+                self.renew()
+            except Exception as e:
+                # the database may be busy, try again next beat
+                print("[WORKER] Heartbeat failed: %s" % e)
+
+    def stop(self):
+        """ Stop renewing and give up all leases """
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        with self.lock:
+            held, self.held = self.held, set()
+        for kind, key in held:
+            self.db.releaseLease(kind, key, self.owner)
+
+
+class LeasedDownloads(object):
+    """
+    Stands in for a DownloadQueue in worker mode: only downloads what this
+    worker could claim the lease on, and gives the lease up when it's done.
+    """
+    def __init__(self, queue, leases):
+        self.queue      = queue
+        self.leases     = leases
+        self.tasks      = dict()
+
+    def put(self, job, key, func, *args, **kw):
+        if key in self.tasks:
+            return self.tasks[key]
+        lease = key
+        if not self.leases.claim("download", lease):
+            print("[WORKER] %s is being downloaded by another worker" % lease)
+            return None
+        # a download the queue skips gives its lease up, too
+        kw["cancel"] = lambda: self.leases.release("download", lease)
+        task = self.tasks[key] = self.queue.put(job, key, self._download, lease, func, args, **kw)
+        return task
+
+    def _download(self, lease, func, args):
+        try:
+            return func(*args)
+        finally:
+            self.leases.release("download", lease)
@@ -30,6 +30,12 @@ database = "youfeed.db"
 #   number of bytes to recv at a time
 #   can be overriden in database config
 bytecount = 64 * 4096
+# gdata_url
+#   base url of the YouTube GData v2 API
+gdata_url = "https://gdata.youtube.com/feeds/api/"
+# gdata_cache
+#   the yfcache.Cache gdata_link goes through, see open_gdata_cache()
+gdata_cache = None
 
 
 #------------------------------------------------------------
@@ -76,31 +82,92 @@ import json
 import string
 import platform
 import datetime
+import time
 import uuid
 import shutil
+import threading
+from collections import deque, OrderedDict
 
 # libyo
 import libyo
 try:
-    from libyo.youtube.resolve import resolve3
     from libyo.extern import argparse
-    from libyo.youtube.resolve.profiles import descriptions as fmtdesc, file_extensions as fmtext, profiles
-    from libyo.youtube.exception import YouTubeResolveError
-    from libyo.interface.progress.file import SimpleFileProgress
-    from libyo.urllib.download import download as downloadFile
     from libyo.util import choice
-
-# etree, urllib
-    from libyo.compat import etree
-    from libyo.urllib import request, parse
-    from libyo.youtube.auth import urlopen
 except ImportError:
     if libyo.version_info < need_libyo:
         raise ImportError("Insufficent libyo version: %s found, %s required")
     raise
 
-# yfdb
-import yfdb
+
+class LazyModule(object):
+    """
+    Stands in for a module that is only imported once it's actually used.
+    
+    Most subcommands never touch the resolver, the HTTP stack or the database,
+    so we don't make them pay for importing those.
+    LazyModule("a.b", "c") is the lazy version of "from a.b import c"
+    """
+    def __init__(self, name, fromname=None):
+        self._name      = name
+        self._fromname  = fromname
+        self._module    = None
+    
+    def _load(self):
+        try:
+            if self._fromname:
+                module = getattr(__import__(self._name, fromlist=[self._fromname]), self._fromname)
+            else:
+                module = __import__(self._name, fromlist=["__name__"])
+        except ImportError:
+            if libyo.version_info < need_libyo:
+                raise ImportError("Insufficent libyo version: %s found, %s required")
+            raise
+        self._module = module
+        return module
+    
+    def __getattr__(self, attr):
+        return getattr(self._module or self._load(), attr)
+
+
+class LazyChoices(object):
+    """ argparse choices that are only computed when they are needed """
+    def __init__(self, func):
+        self._func  = func
+        self._value = None
+    
+    def _get(self):
+        if self._value is None:
+            self._value = self._func()
+        return self._value
+    
+    def __contains__(self, item):
+        return item in self._get()
+    
+    def __iter__(self):
+        return iter(self._get())
+
+
+# libyo
+resolve     = LazyModule("libyo.youtube.resolve")
+ytprofiles  = LazyModule("libyo.youtube.resolve.profiles")
+ytexception = LazyModule("libyo.youtube.exception")
+progressfile= LazyModule("libyo.interface.progress.file")
+download    = LazyModule("libyo.urllib.download")
+
+# etree, urllib
+etree       = LazyModule("libyo.compat", "etree")
+request     = LazyModule("libyo.urllib", "request")
+parse       = LazyModule("libyo.urllib", "parse")
+auth        = LazyModule("libyo.youtube.auth")
+
+# yfdb, yfmetrics, yfserve, yfsched, yfworker, yfnet
+yfdb        = LazyModule("yfdb")
+yfmetrics   = LazyModule("yfmetrics")
+yfserve     = LazyModule("yfserve")
+yfsched     = LazyModule("yfsched")
+yfworker    = LazyModule("yfworker")
+yfnet       = LazyModule("yfnet")
+yfcache     = LazyModule("yfcache")
 
 
 #------------------------------------------------------------
@@ -147,16 +214,46 @@ def main(argv):
     # print welcome message and check versions
     welcome()
     
-    #---------------------------------------------
     # parse the commandline arguments
-    #---------------------------------------------
-    choice_profile = choice.cichoice(profiles.keys())
+    parser = make_parser(argv[0])
+    args = parser.parse_args(argv[1:])
+    
+    # -V doesn't need the database
+    if args.command_ == "version":
+        print("YouFeed version: %s" % version)
+        print("libyo version:   %s" % libyo.version)
+        print("DB version:      %i" % yfdb.DB_VERSION)
+        return 0
+    
+    # hand the command to a youfeed serve running on the same database
+    if not args.noserve:
+        status = forward(args, argv[1:])
+        if status is not None:
+            return status
+    
+    return execute(args)
+
+
+def make_parser(prog):
+    """ build the commandline parser """
+    choice_profile = LazyChoices(lambda: choice.cichoice(ytprofiles.profiles.keys()))
+    choice_order = LazyChoices(lambda: yfsched.ORDERS)
     choice_quality = choice.qchoice.new(1080, 720, 480, 360, 240)
     
-    parser = argparse.ArgumentParser(prog=argv[0])
+    parser = argparse.ArgumentParser(prog=prog)
     parser.add_argument("-db", dest="database", help="The Database to use", default=database)
     parser.add_argument("-V", dest="command_", action="store_const", const="version",
         help="Display version and quit")
+    parser.add_argument("-profile", dest="profile_dir", metavar="DIR",
+        help="Profile the command: write cProfile stats and tracemalloc snapshots to DIR")
+    parser.add_argument("-sqlstats", action="store_true",
+        help="Count and time the SQL statements of the command and print a summary")
+    parser.add_argument("-sqlstats-limit", dest="sqlstats_limit", metavar="K", type=int, default=100,
+        help="With -sqlstats, flag statements that run more than K times in one job [%(default)s]")
+    parser.add_argument("-cache", choices=("on", "off", "record", "replay"),
+        help="How GData answers are cached in <database>.cache; replay answers only from the cache [option cache_mode, on]")
+    parser.add_argument("-noserve", action="store_true",
+        help="Run the command in this process, even if a 'youfeed serve' is running")
     
     subparsers = parser.add_subparsers(dest="command",
         help="Use '%(prog)s (command) -h' to get further help. By Default, the 'run' command is run.",
@@ -179,9 +276,10 @@ def main(argv):
     job_add.add_argument("type", help="The job type. choices: %(choices)s", choices=("playlist", "favorites"))
     job_add.add_argument("resource", help="The job resource. [playlist -> playlist ID]")
     job_add.add_argument("-target", help="The name of the resulting playlist")
-    job_add.add_argument("-profile", help="The job codec profile", choices=choice_profile)
+    job_add.add_argument("-profile", help="The job codec profile", choices=choice_profile, metavar="PROFILE")
     job_add.add_argument("-quality", help="The job maximum quality", choices=choice_quality)
     job_add.add_argument("-export", help="Export the playlist file")
+    job_add.add_argument("-priority", type=int, help="Download before jobs with a lower priority [0]")
     job_add.add_argument("-disable", action="store_true", help="Disable the new job")
     job_add.add_argument("-noidcheck", action="store_true", help="Disable Playlist ID check")
     
@@ -198,9 +296,10 @@ def main(argv):
     job_mod.add_argument("-type", help="Change the job type", choices=("playlist",))
     job_mod.add_argument("-resource", help="Change the job resource")
     job_mod.add_argument("-target", help="Change the playlist name")
-    job_mod.add_argument("-profile", help="Change the codec profile", choices=choice_profile)
+    job_mod.add_argument("-profile", help="Change the codec profile", choices=choice_profile, metavar="PROFILE")
     job_mod.add_argument("-quality", help="Change the maximum quality", choices=choice_quality)
     job_mod.add_argument("-export", help="Change the export location")
+    job_mod.add_argument("-priority", type=int, help="Change the download priority")
     job_mod.add_argument("-noidcheck", action="store_true", help="Disable Playlist ID check")
     
     job_list = job_subparsers.add_parser("list", description="List jobs")
@@ -215,7 +314,55 @@ def main(argv):
     run_parser.add_argument("names", help="The job identifier(s)", nargs="*")
     run_parser.add_argument("-p", help="Only recreate the playlist file(s)", action="store_true")
     run_parser.add_argument("-d", help="Only check for new videos, don't download anything", action="store_true")
+    run_parser.add_argument("-plan", action="store_true",
+        help="Check for new videos and size up what would be downloaded, without downloading it")
+    run_parser.add_argument("-plan-json", dest="plan_json", metavar="FILE",
+        help="-plan, and write the plan to FILE as json ('-' for stdout)")
     run_parser.add_argument("-forceall", help="run disabled jobs, too", action="store_true")
+    run_parser.add_argument("-due", action="store_true",
+        help="Only run the jobs whose playlist is due for a check (see option sched_min/sched_max/sched_backoff)")
+    run_parser.add_argument("-jobs", type=int, metavar="N",
+        help="Run up to N jobs at the same time [option run_jobs, 4]")
+    run_parser.add_argument("-downloads", type=int, metavar="N",
+        help="Download up to N videos at the same time, shared by all jobs [option run_downloads, 2]")
+    run_parser.add_argument("-resume", action="store_true",
+        help="Only work off the download backlog (see 'queue'), don't run any job")
+    run_parser.add_argument("-order", choices=choice_order, metavar="ORDER",
+        help="Download order: index, newest, shortest or smallest [option queue_order, index]")
+    run_parser.add_argument("-select", choices=FORMAT_POLICIES, metavar="POLICY",
+        help="Format selection: quality, smallest or budget [option format_select, quality]")
+    run_parser.add_argument("-until", metavar="HH:MM",
+        help="Don't start jobs or downloads that can't be done by then (orders by smallest, by default)")
+    run_parser.add_argument("-adaptive", action="store_true",
+        help="With -until, download in worse formats when falling behind, rather than leaving videos out")
+    run_parser.add_argument("-limit", metavar="RATE",
+        help="Cap the download bandwidth, e.g. 2M (bytes/s) [option shape_rate, see yfnet.py]")
+    run_parser.add_argument("-metrics", metavar="FILE",
+        help="Append per-job timings and counters to FILE as json lines [option metrics_log]")
+    run_parser.add_argument("-textfile", metavar="FILE",
+        help="Write the metrics as a Prometheus textfile [option metrics_textfile]")
+    run_parser.add_argument("-trace", metavar="FILE",
+        help="Write per-video and per-page spans to FILE (Chrome trace_event json)")
+    
+    # queue subcommand
+    queue_parser = subparsers.add_parser("queue", description="Show and manage the download backlog")
+    queue_subparsers = queue_parser.add_subparsers(dest="mode", help="Queue modes", default="list")
+    
+    queue_list = queue_subparsers.add_parser("list", description="List the queued downloads")
+    queue_list.add_argument("-all", action="store_true", help="Include the finished downloads")
+    
+    queue_retry = queue_subparsers.add_parser("retry", description="Queue failed downloads again")
+    queue_retry.add_argument("ids", type=int, nargs="*", help="The downloads to retry (all failed ones if none)")
+    
+    queue_rm = queue_subparsers.add_parser("rm", description="Remove downloads from the queue")
+    queue_rm.add_argument("ids", type=int, nargs="+", help="The downloads to remove")
+    
+    queue_clear = queue_subparsers.add_parser("clear", description="Forget finished downloads")
+    queue_clear.add_argument("-failed", action="store_true", help="Forget the failed ones, too")
+    
+    queue_prio = queue_subparsers.add_parser("priority", description="Change the priority of downloads")
+    queue_prio.add_argument("priority", type=int, help="The new priority, higher goes first")
+    queue_prio.add_argument("ids", type=int, nargs="+", help="The downloads to change")
     
     # db subcommand
     db_parser = subparsers.add_parser("db", description="Manage the YouFeed Database")
@@ -229,7 +376,7 @@ def main(argv):
     # export subcommand
     export_parser = subparsers.add_parser("export", description="export videos")
     export_parser.add_argument("playlist_id", help="what to export")
-    export_parser.add_argument("-profile", choices=choice_profile, help="profile")
+    export_parser.add_argument("-profile", choices=choice_profile, metavar="PROFILE", help="profile")
     export_parser.add_argument("-quality", choices=choice_quality, help="quality")
     export_parser.add_argument("-startat", type=int, help="first element index", default=1)
     
@@ -239,42 +386,242 @@ def main(argv):
     export_folder.add_argument("location", help="the folder location")
     export_folder.add_argument("filename_template", help="how to name the video files: %n=index %t=title %e=extension %i=videoId %p=playlistTitle %x=playlistId %u=uploader", default="%n._%t.%e", nargs="?")
     
-    # do the parsing
-    args = parser.parse_args(argv[1:])
+    # serve subcommand
+    serve_parser = subparsers.add_parser("serve",
+        description="Keep running: run the jobs periodically and take commands from the other youfeed subcommands")
+    serve_parser.add_argument("control", nargs="?", choices=("status", "pause", "resume", "stop"),
+        help="Control a running daemon instead of starting one: %(choices)s")
+    serve_parser.add_argument("-interval", type=int, metavar="MINUTES",
+        help="Minutes between checks for due jobs [option serve_interval, 5]")
+    
+    # worker subcommand
+    worker_parser = subparsers.add_parser("worker",
+        description="Run the due jobs together with other workers on the same database, coordinated through leases")
+    worker_parser.add_argument("-once", action="store_true",
+        help="Exit when there are no due jobs left to claim")
+    worker_parser.add_argument("-interval", type=int, metavar="MINUTES",
+        help="Minutes between checks for due jobs [option serve_interval, 5]")
+    worker_parser.add_argument("-ttl", type=int, metavar="SECONDS",
+        help="Seconds until the leases of a worker that stopped responding expire [option worker_ttl, 60]")
+    worker_parser.add_argument("-downloads", type=int, metavar="N",
+        help="Download up to N videos at the same time [option run_downloads, 2]")
+    worker_parser.add_argument("-order", choices=choice_order, metavar="ORDER",
+        help="Download order: index, newest, shortest or smallest [option queue_order, index]")
+    worker_parser.add_argument("-metrics", metavar="FILE",
+        help="Append per-job timings and counters to FILE as json lines [option metrics_log]")
+    worker_parser.add_argument("-textfile", metavar="FILE",
+        help="Write the metrics as a Prometheus textfile [option metrics_textfile]")
+    worker_parser.set_defaults(p=False, d=False, plan=False)
+    
+    return parser
+
+
+def forward(args, argv):
+    """
+    pass the commandline on to a 'youfeed serve' on the same database
     
-    #---------------------------------------------
-    # database initialization
-    #---------------------------------------------
+    returns None if there is none, so the command has to run here
+    """
+    if args.command == "worker":
+        return None
+    path = yfserve.socket_path(args.database)
+    if not os.path.exists(path):
+        return None
+    if args.command == "serve":
+        if not args.control:
+            return None
+        message = {"control": args.control}
+    else:
+        message = {"argv": argv, "cwd": os.getcwd()}
+    try:
+        return yfserve.request(path, message)
+    except yfserve.ServerUnavailable:
+        return None
+
+
+def execute(args):
+    """ run the parsed commandline (with -profile) """
+    if args.profile_dir:
+        with yfmetrics.Profiler(args.profile_dir):
+            return dispatch(args)
+    return dispatch(args)
+
+
+def open_database(args, pooled=False):
+    """ open (or create) the database and pass it around with args """
     if not os.path.exists(args.database):
-        db = yfdb.DB.open(args.database)
+        db = yfdb.DB.open(args.database, pooled=pooled)
         db.setOptionValue("playlists_folder", playlists_folder)
         db.setOptionValue("videos_folder", videos_folder)
     else:
-        db = yfdb.DB.open(args.database)
+        db = yfdb.DB.open(args.database, pooled=pooled)
         
     # pass db around with args
     args.db     = db
     args.root   = os.path.dirname(os.path.abspath(args.database))
+
+
+def dispatch(args):
+    """ Open the database and run the subcommand """
+    # serve hands its own database to the commands it runs
+    if getattr(args, "db", None) is None:
+        open_database(args, pooled=args.command in ("serve", "run", "worker"))
+    db = args.db
+    
+    # -sqlstats watches every statement of the command
+    if args.sqlstats:
+        args.sqlstats = yfmetrics.SqlStats(args.sqlstats_limit).attach(db.engine)
+    # what talks to GData goes through the cache
+    if args.command in ("run", "worker"):
+        open_gdata_cache(args)
     
     #---------------------------------------------
     # Dispatcher
     #---------------------------------------------
-    if args.command_:
-        if args.command_ == "version":
-            print("YouFeed version: %s" % version)
-            print("libyo version:   %s" % libyo.version)
-            print("DB version:      %i" % yfdb.DB_VERSION)
-            return 0
-    elif args.command == "config":
-        return config_command(args)
-    elif args.command == "job":
-        return job_command(args)
-    elif args.command == "run":
-        return run_command(args)
-    elif args.command == "db":
-        return db_command(args)
-    elif args.command == "export":
-        return export_command(args)
+    try:
+        if args.command == "config":
+            return config_command(args)
+        elif args.command == "job":
+            return job_command(args)
+        elif args.command == "run":
+            return run_command(args)
+        elif args.command == "db":
+            return db_command(args)
+        elif args.command == "export":
+            return export_command(args)
+        elif args.command == "serve":
+            return serve_command(args)
+        elif args.command == "worker":
+            return worker_command(args)
+        elif args.command == "queue":
+            return queue_command(args)
+    finally:
+        if args.sqlstats:
+            args.sqlstats.detach(db.engine)
+            args.sqlstats.summary()
+
+
+def serve_command(args):
+    """
+    the serve subcommand
+    
+    keeps the database, the imports and the caches around between runs
+    """
+    if args.control:
+        print("[ERROR] There is no youfeed serve running on %s" % args.database)
+        return 1
+    
+    interval = args.interval or int(args.db.getOptionValue("serve_interval") or 5)
+    parser = make_parser(sys.argv[0])
+    
+    def execute_argv(argv):
+        cmd = parser.parse_args(argv)
+        if cmd.command == "serve":
+            print("[ERROR] Already serving")
+            return 1
+        cmd.db      = args.db
+        cmd.root    = args.root
+        cmd.database = args.database
+        return execute(cmd)
+    
+    daemon = yfserve.Daemon(yfserve.socket_path(args.database), execute_argv, interval * 60, ["run", "-due"])
+    
+    import signal
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    try:
+        return daemon.serve()
+    except KeyboardInterrupt:
+        return 0
+
+
+def worker_command(args):
+    """
+    the worker subcommand
+    
+    runs the due jobs it can claim a lease on, downloads only the videos it can
+    claim a lease on, until stopped (or, with -once, until nothing is left)
+    """
+    interval = args.interval or int(args.db.getOptionValue("serve_interval") or 5)
+    ttl = args.ttl or int(args.db.getOptionValue("worker_ttl") or 60)
+    downloads = args.downloads or int(args.db.getOptionValue("run_downloads") or 2)
+    
+    args.order = download_order(args)
+    format_policy(args)
+    args.upgrade = False
+    leases = yfworker.Leases(args.db, ttl).start()
+    args.shaper = yfnet.Shaper.from_options(args.db)
+    yfnet.configure(args.db)
+    stopping = threading.Event()
+    
+    import signal
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    print("[WORKER] %s, leases expire after %is" % (leases.owner, ttl))
+    try:
+        while not stopping.is_set():
+            # a pass ends when its downloads are done
+            queue = yfsched.DownloadQueue(downloads)
+            args.heads = head_queue(args)
+            try:
+                ran = run_leased(args, leases, yfworker.LeasedDownloads(queue, leases), stopping)
+            finally:
+                queue.close()
+                if args.heads is not None:
+                    args.heads.close()
+            if args.once and not ran:
+                break
+            if not ran:
+                stopping.wait(interval * 60)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        leases.stop()
+    return 0
+
+
+def run_leased(args, leases, downloads, stopping):
+    """
+    one pass of the worker: help with the download backlog and run the due
+    jobs we get the lease on; returns how many jobs and downloads it took
+    """
+    session = args.db.Session()
+    joblist = session.query(yfdb.Job).filter(
+        yfdb.Job.status.op("&")(yfdb.Job.ST_DISABLED) == 0).all()
+    # the jobs with the more important downloads first
+    names = [job.name for job in sorted(yfsched.due_jobs(session, joblist), key=lambda job: -job.priority)]
+    session.close()
+    
+    metrics = yfmetrics.RunMetrics()
+    metrics.attach(args.db.engine)
+    ran = 0
+    try:
+        ran += resume_downloads(args, metrics, downloads)
+        for name in names:
+            if stopping.is_set():
+                break
+            if not leases.claim("job", name):
+                continue
+            try:
+                # another worker may have run it since we looked
+                session = args.db.Session()
+                try:
+                    job = session.query(yfdb.Job).get(name)
+                    # or removed since
+                    due = yfsched.due_jobs(session, [job]) if job is not None else []
+                finally:
+                    session.close()
+                if due:
+                    print("[WORKER] Claimed job %s" % name)
+                    run_job_session(args, name, metrics, downloads)
+                    ran += 1
+            finally:
+                leases.release("job", name)
+    finally:
+        metrics.finish()
+        metrics.hosts = yfnet.breakers.stats()
+        record_rate(args, metrics)
+        if ran:
+            write_metrics(args, metrics)
+    return ran
 
 
 def config_command(args):
@@ -340,7 +687,7 @@ def export_command(args):
             
             replace = {"n": str(item.index),
                        "t": local.video.title,
-                       "e": fmtext[local.fmt],
+                       "e": ytprofiles.file_extensions[local.fmt],
                        "i": local.video_id,
                        "p": playlist.title,
                        "x": playlist.id,
@@ -356,7 +703,7 @@ def export_command(args):
             p = os.path.join(path, n)
             s = make_absolute(local.location, args.root)
             
-            progress = SimpleFileProgress("{position}/{total} {bar} {percent} {avgspeed} ETA: {eta}")
+            progress = progressfile.SimpleFileProgress("{position}/{total} {bar} {percent} {avgspeed} ETA: {eta}")
             
             stat = os.stat(s)
             
@@ -387,6 +734,7 @@ def job_command(args):
         user = session.query(yfdb.User).filter(yfdb.User.username == args.resource.lower()).first()
         
         if not user:
+            open_gdata_cache(args)
             userdoc = gdata("users/%s" % args.resource)
             userid = userdoc.find(tag("yt", "userId")).text
             user = session.query(yfdb.User).get(userid)
@@ -466,6 +814,14 @@ def job_command(args):
                 print("Quality: %i" % job.quality)
             if job.export is not None:
                 print("Export to: '%s'" % job.export)
+            if job.priority:
+                print("Priority: %i" % job.priority)
+            schedule = session.query(yfdb.PlaylistSchedule).get(job.playlist_id)
+            if schedule is not None and schedule.next_check is not None:
+                print("Next check: %s (every %im, last change %s)" % (
+                    time.strftime("%Y-%m-%d %H:%M", time.localtime(schedule.next_check)),
+                    schedule.interval // 60,
+                    time.strftime("%Y-%m-%d %H:%M", time.localtime(schedule.last_change))))
             
             # stringify the flags
             flags = list()
@@ -504,6 +860,61 @@ def job_command(args):
             job.quality = choice.qchoice.unify(args.quality)
         if args.export:
             job.export = args.export
+        if args.priority is not None:
+            job.priority = args.priority
+    
+    session.commit()
+
+
+def queue_command(args):
+    """ the queue command shows and manages the download backlog """
+    Download = yfdb.Download
+    session = args.db.Session()
+    
+    if args.mode == "list":
+        q = session.query(Download)
+        if not args.all:
+            q = q.filter(Download.state != Download.ST_DONE)
+        downloads = q.order_by(Download.priority.desc(), Download.id.asc()).all()
+        if not downloads:
+            print("No queued downloads.")
+        else:
+            print("%6s %-12s %4s %5s %10s %-16s %s" % ("id", "state", "prio", "tries", "bytes", "job", "video"))
+        for download in downloads:
+            print("%6i %-12s %4i %5i %10i %-16s %s %s" % (download.id, download.state, download.priority,
+                download.attempts, download.bytes_done, download.job, download.video_id,
+                download.video.title if download.video is not None else ""))
+            if download.state == Download.ST_FAILED and download.last_error:
+                print("%6s %s" % ("", download.last_error))
+        counts = dict()
+        for state, in session.query(Download.state):
+            counts[state] = counts.get(state, 0) + 1
+        if counts:
+            print("[QUEUE] " + ", ".join("%i %s" % (n, state) for state, n in sorted(counts.items())))
+    
+    elif args.mode == "retry":
+        q = session.query(Download).filter(Download.state == Download.ST_FAILED)
+        if args.ids:
+            q = q.filter(Download.id.in_(args.ids))
+        downloads = q.all()
+        for download in downloads:
+            yfsched.set_state(download, Download.ST_PENDING)
+        print("%i downloads queued again" % len(downloads))
+    
+    elif args.mode == "rm":
+        n = session.query(Download).filter(Download.id.in_(args.ids)).delete(synchronize_session=False)
+        print("%i downloads removed" % n)
+    
+    elif args.mode == "clear":
+        states = (Download.ST_DONE, Download.ST_FAILED) if args.failed else (Download.ST_DONE,)
+        n = session.query(Download).filter(Download.state.in_(states)).delete(synchronize_session=False)
+        print("%i downloads forgotten" % n)
+    
+    elif args.mode == "priority":
+        downloads = session.query(Download).filter(Download.id.in_(args.ids)).all()
+        for download in downloads:
+            download.priority = args.priority
+        print("%i downloads changed" % len(downloads))
     
     session.commit()
 
@@ -512,14 +923,18 @@ def run_command(args):
     """
     the run subcommand
     
-    collects jobs and calls run_job for each of them
+    collects jobs and runs them, up to -jobs at a time
     """
     session = args.db.Session()
     
     if args.names:
         joblist = list()
         for name in args.names:
-            joblist.append(session.query(yfdb.Job).get(name))
+            job = session.query(yfdb.Job).get(name)
+            if job is None:
+                print("[ERROR] No such job: %s" % name)
+                continue
+            joblist.append(job)
     
     else:
         if not args.forceall:
@@ -529,21 +944,302 @@ def run_command(args):
         else:
             joblist = session.query(yfdb.Job).all()
     
-    for job in joblist:
-        run_job(args, session, job)
+    if args.due:
+        due = yfsched.due_jobs(session, joblist)
+        print("[ RUN ] %i of %i jobs due" % (len(due), len(joblist)))
+        joblist = due
     
-    session.commit()
+    # every job gets its own session; -resume only works off the backlog
+    joblist.sort(key=lambda job: -job.priority)
+    names = [job.name for job in joblist] if not args.resume else []
+    session.close()
+    
+    deadline = None
+    if args.until:
+        try:
+            deadline = yfsched.parse_deadline(args.until)
+        except ValueError:
+            print("[ERROR] -until takes a time of day (HH:MM), not '%s'" % args.until)
+            return 2
+        print("[ RUN ] Until %s" % time.strftime("%Y-%m-%d %H:%M", time.localtime(deadline)))
+    elif args.adaptive:
+        print("[ WARN] -adaptive does nothing without -until")
+    args.order = download_order(args, "smallest" if deadline else "index")
+    format_policy(args)
+    if args.plan_json:
+        args.plan = True
+    args.planned = list()
+    
+    workers = args.jobs or int(args.db.getOptionValue("run_jobs") or 4)
+    download_workers = args.downloads or int(args.db.getOptionValue("run_downloads") or 2)
+    if args.profile_dir and workers > 1:
+        # the profiler follows a single thread
+        print("[ RUN ] -profile runs the jobs one at a time")
+        workers = 1
+    
+    metrics = yfmetrics.RunMetrics()
+    metrics.attach(args.db.engine)
+    if args.sqlstats:
+        metrics.sqlstats = args.sqlstats
+    tracer = yfmetrics.Tracer().start() if args.trace else None
+    args.shaper = yfnet.Shaper.from_options(args.db, args.limit)
+    yfnet.configure(args.db)
+    # the leases keep a worker from taking what we're downloading
+    leases = yfworker.Leases(args.db, int(args.db.getOptionValue("worker_ttl") or 60)).start()
+    queue = yfsched.DownloadQueue(download_workers if workers > 1 else 0, deadline=deadline, adaptive=args.adaptive)
+    args.heads = head_queue(args)
+    args.upgrade = False
+    failed = list()
+    try:
+        downloads = yfworker.LeasedDownloads(queue, leases)
+        if not args.p and not args.d and not args.plan:
+            # with the backlog cleared and no deadline, we have time for better formats
+            args.upgrade = not resume_downloads(args, metrics, downloads) and deadline is None
+        pending = deque(names)
+        if workers > 1:
+            lock = threading.Lock()
+            
+            def worker():
+                while True:
+                    with lock:
+                        if not pending or past(deadline):
+                            return
+                        name = pending.popleft()
+                    if run_job_session(args, name, metrics, downloads):
+                        failed.append(name)
+            
+            threads = [threading.Thread(target=worker, name="job-%i" % (i + 1))
+                       for i in range(min(workers, len(names)))]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join()
+        else:
+            while pending and not past(deadline):
+                name = pending.popleft()
+                if run_job_session(args, name, metrics, downloads):
+                    failed.append(name)
+        if pending:
+            print("[ RUN ] Past the deadline, %i jobs left for the next run" % len(pending))
+    finally:
+        queue.close()
+        if args.heads is not None:
+            args.heads.close()
+        leases.stop()
+        if args.shaper is not None:
+            args.shaper.summary()
+        yfnet.breakers.summary()
+        metrics.finish()
+        metrics.hosts = yfnet.breakers.stats()
+        record_rate(args, metrics)
+        if tracer is not None:
+            tracer.stop()
+            tracer.write(args.trace)
+        write_metrics(args, metrics)
+    
+    if args.plan:
+        run_plan(args, download_workers)
+    
+    if failed:
+        print("[ERROR] %i jobs failed: %s" % (len(failed), ", ".join(failed)))
+        return 1
+    return 0
+
+
+def download_order(args, default="index"):
+    """ -order, or the queue_order option """
+    order = args.order or args.db.getOptionValue("queue_order") or default
+    if order not in yfsched.ORDERS:
+        print("[ERROR] Unknown download order '%s', using %s" % (order, default))
+        order = default
+    return order
+
+
+def record_rate(args, metrics):
+    """ remember the bytes/s a single download got, for -plan """
+    received = metrics.totals().get("bytes_downloaded", 0)
+    seconds = sum(job.phases.get("download", 0.0) for job in metrics.jobs)
+    if not received or seconds < 1:
+        return
+    rate = received / seconds
+    previous = args.db.getOptionValue("download_rate")
+    if previous:
+        rate = (rate + float(previous)) / 2
+    args.db.setOptionValue("download_rate", str(int(rate)))
+
+
+# resolves and HEAD requests at the same time while planning
+PLAN_WORKERS = 8
+
+def run_plan(args, downloads):
+    """
+    resolve what -plan noted (and the backlog) concurrently and HEAD the
+    chosen formats for their size; prints the plan and writes -plan-json
+    """
+    session = args.db.Session()
+    try:
+        items = OrderedDict()
+        for download in yfsched.pending(session, args.order):
+            items[download.video_id] = (download.job, json.loads(download.formats))
+        for name, video_id, formats in args.planned:
+            items.setdefault(video_id, (name, formats))
+        # in one go rather than a query per item; in slices, for sqlite's limit on parameters
+        ids = list(items)
+        known = dict()
+        for i in range(0, len(ids), 500):
+            known.update((video.id, video) for video in
+                         session.query(yfdb.Video).filter(yfdb.Video.id.in_(ids[i:i + 500])))
+        videos = list()
+        for video_id, (name, formats) in items.items():
+            video = known.get(video_id)
+            if video is None:
+                print("[ WARN] Video %s of job %s is not in the database, leaving it out" % (video_id, name))
+                continue
+            videos.append((name, video_id, video.title, video.duration, formats))
+    finally:
+        session.close()
+    
+    print("[ PLAN ] Sizing up %i videos" % len(videos))
+    queue = yfsched.DownloadQueue(PLAN_WORKERS, maxsize=len(videos) or 1)
+    args.heads = head_queue(args)
+    try:
+        tasks = [(name, video_id, title, queue.put(name, video_id, plan_video, args, video_id, duration, formats))
+                 for name, video_id, title, duration, formats in videos]
+    finally:
+        queue.close()
+        if args.heads is not None:
+            args.heads.close()
+    
+    jobs = OrderedDict()
+    total = dict(videos=0, bytes=0, estimated=0, unavailable=0)
+    entries = list()
+    for name, video_id, title, task in tasks:
+        entry = task.wait() or dict(error="failed")
+        entry.update(job=name, video=video_id, title=title)
+        entries.append(entry)
+        for counts in (jobs.setdefault(name, dict(videos=0, bytes=0, estimated=0, unavailable=0)), total):
+            if "error" in entry:
+                counts["unavailable"] += 1
+                continue
+            counts["videos"] += 1
+            counts["bytes"] += entry["bytes"] or 0
+            counts["estimated"] += entry["estimated"]
+    
+    # at the rate earlier runs measured, on the download workers, within -limit
+    rate = args.db.getOptionValue("download_rate")
+    rate = float(rate) * max(1, min(downloads, total["videos"])) if rate else None
+    limit = args.shaper.schedule.rate() if args.shaper is not None else None
+    if limit and (rate is None or limit < rate):
+        rate = limit
+    seconds = total["bytes"] / rate if rate else None
+    
+    for name, counts in list(jobs.items()) + [("total", total)]:
+        print("[ PLAN ] %-20s %5i videos %10s (%i estimated, %i unavailable)" % (
+            name, counts["videos"], yfnet.format_size(counts["bytes"]), counts["estimated"], counts["unavailable"]))
+    if seconds is not None:
+        print("[ PLAN ] About %s at %s" % (format_duration(seconds), yfnet.format_rate(rate)))
+    else:
+        print("[ PLAN ] No download rate measured yet, can't tell how long that takes")
+    
+    if args.plan_json:
+        plan = dict(date=datetime.datetime.utcnow().isoformat(), order=args.order, jobs=jobs, total=total,
+                    rate=rate, seconds=seconds, videos=entries)
+        if args.plan_json == "-":
+            print(json.dumps(plan, indent=2))
+        else:
+            with open(args.plan_json, "w") as fp:
+                json.dump(plan, fp, indent=2)
+
+
+def plan_video(args, video_id, duration, formats):
+    """ the format we'd download and its size, from a HEAD request or estimated """
+    try:
+        url, fmt, size = select_format(args, video_id, duration, formats)
+    except ytexception.YouTubeResolveError as e:
+        return dict(error="could not resolve: %s" % e)
+    if url is fmt is None:
+        return dict(error="no allowed format")
+    if size is None:
+        size = head_size(url)
+    if size is not None:
+        return dict(fmt=fmt, bytes=size, estimated=False)
+    return dict(fmt=fmt, bytes=yfsched.estimate_size(duration, [fmt]), estimated=True)
+
+
+def head_size(url):
+    """ HEAD url; its Content-Length, None if it doesn't say (or fails) """
+    req = request.Request(url)
+    req.get_method = lambda: "HEAD"
+    try:
+        fp = request.urlopen(req, timeout=30)
+        try:
+            length = fp.info().get("Content-Length")
+        finally:
+            fp.close()
+    except (IOError, OSError):
+        return None
+    return int(length) if length else None
+
+
+def format_duration(seconds):
+    if seconds < 60:
+        return "%is" % (seconds + 1)
+    minutes = int(seconds + 59) // 60
+    return "%ih%02im" % divmod(minutes, 60) if minutes >= 60 else "%im" % minutes
+
+
+def past(deadline):
+    return deadline is not None and time.time() >= deadline
+
+
+def run_job_session(args, name, metrics, downloads=None):
+    """
+    run_job in a session of its own, as one job of the run metrics
+    
+    returns 1 if the job failed; the other jobs go on regardless
+    """
+    session = args.db.Session()
+    try:
+        job = session.query(yfdb.Job).get(name)
+        with metrics.job(job.name):
+            with yfmetrics.profiled("job-%s" % job.name):
+                with yfmetrics.span(job.name, "job"):
+                    run_job(args, session, job, downloads)
+        session.commit()
+    except Exception:
+        import traceback
+        print("[ERROR] Job %s failed:\n%s" % (name, "".join(traceback.format_exception(*sys.exc_info()))))
+        session.rollback()
+        return 1
+    finally:
+        session.close()
     return 0
 
 
-def run_job(args, session, job):
+def write_metrics(args, metrics):
+    """ write the run metrics to where the commandline or the config says """
+    log = args.metrics or args.db.getOptionValue("metrics_log")
+    if log:
+        metrics.write_log(make_absolute(log, args.root if not args.metrics else None))
+    textfile = args.textfile or args.db.getOptionValue("metrics_textfile")
+    if textfile:
+        metrics.write_textfile(make_absolute(textfile, args.root if not args.textfile else None))
+
+
+def run_job(args, session, job, downloads=None):
     """
     process a job
+    
+    downloads is the DownloadQueue shared with the other jobs, or None to
+    download right away
     """
     print("[ RUN ] Job: %s" % job.name)
     
     if job.status & yfdb.Job.ST_NOSYNC == 0:
-        playlist = run_sync(args, session, job)
+        with yfmetrics.phase("sync"):
+            playlist = run_sync(args, session, job)
+        yfmetrics.snapshot("%s-sync" % job.name)
     else:
         playlist = session.query(yfdb.Playlist).get(job.playlist_id)
         if not playlist:
@@ -551,8 +1247,11 @@ def run_job(args, session, job):
             return 1
     
     # do the job (haha)
-    vids = run_playlist(args, session, job, playlist)
-    run_mkplaylist(args, session, job, playlist, vids)
+    vids = run_playlist(args, session, job, playlist, downloads)
+    yfmetrics.snapshot("%s-scan" % job.name)
+    with yfmetrics.phase("playlist"):
+        run_mkplaylist(args, session, job, playlist, vids)
+    yfmetrics.snapshot("%s-xspf" % job.name)
     
     # runonce
     if job.status & yfdb.Job.ST_RUNONCE != 0:
@@ -567,7 +1266,8 @@ def run_sync(args, session, job):
     """
     if job.type == "playlist":
         # get the remote playlist
-        doc = gdata("playlists/" + job.playlist_id, {"max-results": "50"}).getroot()
+        with yfmetrics.span("fetch page", "sync", page=1):
+            doc = gdata("playlists/" + job.playlist_id, {"max-results": "50"}).getroot()
         
     # playlist metadata
     author = doc.find(tag("atom", "author"))
@@ -587,15 +1287,21 @@ def run_sync(args, session, job):
     print("[ RUN ] Playlist: '%s' by %s" % (playlist.title, playlist.user_name))
     
     # fetch the videos
+    page = 1
+    new_items = total_items = 0
     while True:
+        yfmetrics.count("pages")
+        page_start = time.time()
         for entry in doc.iterfind(tag("atom", "entry")):
             data     = entry.find(tag("media", "group"))
+            total_items += 1
             
             video_id = data.find(tag("yt", "videoid")).text
             video    = session.query(yfdb.Video).get(video_id)
             
             if video is None:
                 # create the video
+                yfmetrics.count("videos_new")
                 video = yfdb.Video(id=video_id)
                 session.add(video)
                 
@@ -607,6 +1313,8 @@ def run_sync(args, session, job):
                     author.name = author_.attrib[tag("yt", "display")]
                     author.username = author_.text
                 video.author = author
+            else:
+                yfmetrics.count("videos_known")
             
             #print(str(etree.tostring(data, pretty_print=True),"utf8"))
             
@@ -644,21 +1352,32 @@ def run_sync(args, session, job):
                 ix = entry.find(tag("yt", "position"))
                 index = int(ix.text) if ix is not None else None
                 args.db.addPlaylistVideo(job.playlist_id, video.id, index, session=session)
+                new_items += 1
+        
+        # don't keep the other jobs from writing while we fetch the next page
+        session.commit()
+        yfmetrics.add_span("page", page_start, time.time(), "sync", page=page)
         
         # get next set of videos ( if any )
         nextpage = doc.find("%s[@rel='next']" % tag("atom", "link"))
         if nextpage is not None:
-            doc = gdata_link(nextpage.attrib["href"]).getroot()
+            page += 1
+            with yfmetrics.span("fetch page", "sync", page=page):
+                doc = gdata_link(nextpage.attrib["href"]).getroot()
         else:
             break
     
+    # when to look again
+    yfsched.record_sync(session, job.playlist_id, new_items, total_items,
+                        yfsched.Policy.from_options(args.db))
+    
     # commit database
     session.commit()
     
     return playlist
 
 
-def run_playlist(args, session, job, playlist):
+def run_playlist(args, session, job, playlist, downloads=None):
     """ process videos in a playlist """
     items = session.query(yfdb.PlaylistItem).\
             filter(yfdb.PlaylistItem.playlist_id == playlist.id).\
@@ -685,28 +1404,48 @@ def run_playlist(args, session, job, playlist):
     
     lookup_table = make_job_qa(args, job)
     
-    localVids = list()
+    videos = [(item, session.query(yfdb.Video).get(item.video_id)) for item in items]
+    localVids = [None] * len(videos)
     
-    for item in items:
-        video = session.query(yfdb.Video).get(item.video_id)
+    # go through them in download order, the playlist stays in index order
+    order = getattr(args, "order", "index")
+    walk = list(enumerate(videos))
+    if order != "index":
+        walk.sort(key=lambda iv: yfsched.rank(order, iv[1][1], lookup_table))
+    
+    for i, (item, video) in walk:
+        with yfmetrics.span(video.id, "video", index=item.index):
+            localVids[i] = run_video(args, session, job, video, lookup_table, downloads)
         
-        localVids.append(run_video(args, session, job, video, lookup_table))
+        # run_video flagged the video, don't hold the write lock until the end
+        if session.dirty:
+            session.commit()
+    
+    # collect what the download workers got for us
+    for i, local in enumerate(localVids):
+        if isinstance(local, yfsched.Task):
+            local_id = local.wait()
+            localVids[i] = session.query(yfdb.LocalVideo).get(local_id) if local_id is not None else None
     
     return localVids
 
 
-def run_video(args, session, job, video, lookup_table):
+def run_video(args, session, job, video, lookup_table, downloads=None):
     """
     Check if we have a local video that works for the job
-    and download one if we don't
+    and download one if we don't (or queue it on downloads)
     """
     # check if we have something fitting
-    localvids = session.query(yfdb.LocalVideo).\
-            filter(yfdb.LocalVideo.video_id == video.id).\
-            filter(yfdb.LocalVideo.fmt.in_(lookup_table)).all()
+    with yfmetrics.phase("check"):
+        localvids = session.query(yfdb.LocalVideo).\
+                filter(yfdb.LocalVideo.video_id == video.id).\
+                filter(yfdb.LocalVideo.fmt.in_(lookup_table)).all()
     
     if localvids:
         localvids.sort(key=lambda v: lookup_table.index(v.fmt))
+        if localvids[0].status & yfdb.LocalVideo.ST_DOWNGRADED and args.upgrade and downloads is not None:
+            # the playlist gets whichever it ends up with
+            return queue_upgrade(args, session, job, video, lookup_table, localvids[0], downloads) or localvids[0]
         return localvids[0]
     
     # -p only checks videos that we already have
@@ -721,24 +1460,42 @@ def run_video(args, session, job, video, lookup_table):
     # -d doesn't download new videos
     if args.d: return
     
+    # -plan only notes what it would download
+    if args.plan:
+        args.planned.append((job.name, video.id, lookup_table))
+        return
+    
     # check if we can access the video
-    try:
-        fp = gdata("videos/%s" % video.id, raw=True)
-    except request.HTTPError as e:
-        if e.getcode() == 403:
-            print("[ERROR] Cannot open Video Page")
+    with yfmetrics.phase("access"):
+        try:
+            fp = gdata("videos/%s" % video.id, raw=True)
+        except request.HTTPError as e:
+            # try again next run
+            print("[ERROR] Cannot open Video Page: HTTP %i" % e.getcode())
             return
-    
-    with fp:
-        if fp.read(512) == "Private Video":
-            print("[ERROR] Video '%s' is Private!" % video.title)
-            video.status |= video.ST_PRIVATE
+        except request.URLError as e:
+            print("[ERROR] Cannot open Video Page: %s" % e.reason)
             return
+        
+        with fp:
+            if fp.read(512) == "Private Video":
+                print("[ERROR] Video '%s' is Private!" % video.title)
+                video.status |= video.ST_PRIVATE
+                return
+    
+    # queue it, the download workers take it from there
+    if downloads is not None:
+        download = yfsched.enqueue(session, job.name, video.id, lookup_table, job.priority)
+        return downloads.put(job.name, video.id, drain_download, args, yfmetrics.current(), download.id,
+                             priority=download.priority, rank=yfsched.rank(args.order, video, lookup_table),
+                             size=yfsched.estimate_size(video.duration, lookup_table),
+                             min_size=yfsched.estimate_size(video.duration, lookup_table[-1:]))
     
     # get the url
     try:
-        url, fmt = recursive_resolve(video.id, lookup_table)
-    except YouTubeResolveError:
+        with yfmetrics.phase("resolve"):
+            url, fmt, size = select_format(args, video.id, video.duration, lookup_table)
+    except ytexception.YouTubeResolveError:
         print("[VIDEO] Could not resolve video.")
         return
     if url is fmt is None:
@@ -746,46 +1503,295 @@ def run_video(args, session, job, video, lookup_table):
         video.status |= video.ST_NOFORMAT
         return
     
-    print("[VIDEO] Downloading Video as %s." % fmtdesc[fmt])
+    print("[VIDEO] Downloading Video as %s." % ytprofiles.descriptions[fmt])
     
     # download it
-    return run_download(args, session, video, url, fmt)
+    with yfmetrics.phase("download"):
+        return run_download(args, session, video, url, fmt, job.name)
 
 
-def run_download(args, session, video, url, fmt):
-    """ actually download a video """
+def drain_download(args, metrics, download_id):
+    """
+    work off a queued download on a download worker, in a session of its own
+    
+    resolves the video and downloads it, recording each step in the
+    downloads table; returns the LocalVideo id
+    """
+    Download = yfdb.Download
+    session = args.db.Session()
+    try:
+        with yfmetrics.bound(metrics):
+            download = session.query(Download).get(download_id)
+            if download is None or download.state not in (Download.ST_PENDING,) + Download.ACTIVE:
+                # removed or finished with 'youfeed queue' meanwhile
+                return None
+            video = download.video
+            formats = json.loads(download.formats)
+            
+            # another worker may have got it since it was queued
+            with yfmetrics.phase("check"):
+                localvideo = session.query(yfdb.LocalVideo).\
+                        filter(yfdb.LocalVideo.video_id == video.id).\
+                        filter(yfdb.LocalVideo.fmt.in_(formats)).first()
+            if localvideo is not None:
+                yfsched.set_state(download, Download.ST_DONE)
+                session.commit()
+                return localvideo.id
+            
+            # an upgrade that fails leaves the job with the file it has
+            fallback = session.query(yfdb.LocalVideo.id).\
+                    filter(yfdb.LocalVideo.video_id == video.id).\
+                    filter(yfdb.LocalVideo.status.op("&")(yfdb.LocalVideo.ST_DOWNGRADED) != 0).\
+                    filter(~yfdb.LocalVideo.fmt.in_(formats)).limit(1).scalar()
+            
+            download.attempts += 1
+            yfsched.set_state(download, Download.ST_RESOLVING)
+            session.commit()
+            
+            # the queue may want a smaller file to make the deadline
+            task = yfsched.current_task()
+            allowed = yfsched.step_down(formats, task.factor if task is not None else 1.0)
+            
+            # get the url
+            try:
+                with yfmetrics.phase("resolve"):
+                    url, fmt, size = select_format(args, video.id, video.duration, allowed)
+            except ytexception.YouTubeResolveError as e:
+                print("[VIDEO] Could not resolve video '%s'." % video.title)
+                yfsched.set_state(download, Download.ST_FAILED, "Could not resolve: %s" % e)
+                session.commit()
+                return fallback
+            if url is fmt is None:
+                print("[VIDEO] Video '%s' does not have a format that is allowed by your profile/quality settings" % video.title)
+                video.status |= video.ST_NOFORMAT
+                yfsched.set_state(download, Download.ST_FAILED, "No allowed format")
+                session.commit()
+                return fallback
+            
+            print("[VIDEO] Downloading '%s' as %s." % (video.title, ytprofiles.descriptions[fmt]))
+            if allowed[0] != formats[0]:
+                print("[QUEUE] Stepped down from %s to make the deadline" % ytprofiles.descriptions[formats[0]])
+            with yfmetrics.phase("download"):
+                localvideo = run_download(args, session, video, url, fmt, download.job, download)
+            if localvideo is None:
+                return fallback
+            if allowed[0] != formats[0]:
+                # a later run may get the better one
+                localvideo.status |= yfdb.LocalVideo.ST_DOWNGRADED
+                yfmetrics.count("downgrades")
+                task.got_size = yfsched.estimate_size(video.duration, [fmt])
+            else:
+                replace_downgraded(args, session, video, formats)
+            session.commit()
+            return localvideo.id
+    finally:
+        session.close()
+
+
+def queue_upgrade(args, session, job, video, lookup_table, local, downloads):
+    """ queue a better format of a video that was downgraded, after everything else """
+    better = lookup_table[:lookup_table.index(local.fmt)]
+    if not better:
+        return None
+    download = yfsched.enqueue(session, job.name, video.id, better, job.priority - 1)
+    print("[QUEUE] Upgrading '%s' from %s" % (video.title, ytprofiles.descriptions[local.fmt]))
+    return downloads.put(job.name, video.id, drain_download, args, yfmetrics.current(), download.id,
+                         priority=download.priority, size=yfsched.estimate_size(video.duration, better))
+
+
+def replace_downgraded(args, session, video, formats):
+    """ forget (and delete) the downgraded files of a video that a better one was downloaded for """
+    for local in session.query(yfdb.LocalVideo).filter(yfdb.LocalVideo.video_id == video.id):
+        if local.status & yfdb.LocalVideo.ST_DOWNGRADED and local.fmt not in formats:
+            path = make_absolute(local.location, args.root)
+            if os.path.exists(path):
+                os.remove(path)
+            session.delete(local)
+            yfmetrics.count("upgrades")
+
+
+def resume_downloads(args, metrics, downloads):
+    """
+    hand the download backlog to the workers, before any job has been synced
+    
+    returns how many were taken
+    """
+    session = args.db.Session()
+    try:
+        recovered = yfsched.recover(session)
+        backlog = list()
+        for download in yfsched.pending(session, args.order):
+            formats = json.loads(download.formats)
+            backlog.append((download.job, download.video_id, download.id, dict(
+                priority=download.priority, rank=yfsched.rank(args.order, download.video, formats),
+                size=yfsched.estimate_size(download.video.duration, formats),
+                min_size=yfsched.estimate_size(download.video.duration, formats[-1:]))))
+        session.commit()
+    finally:
+        session.close()
+    if not backlog:
+        return 0
+    print("[QUEUE] Resuming %i queued downloads (%i were interrupted)" % (len(backlog), recovered))
+    job = metrics.add_job("backlog")
+    # downloads that another worker has are skipped
+    return sum(1 for name, video_id, download_id, kw in backlog
+               if downloads.put(name, video_id, drain_download, args, job, download_id, **kw) is not None)
+
+
+def run_download(args, session, video, url, fmt, job=None, queued=None):
+    """
+    actually download a video (through args.shaper, if bandwidth is limited)
+    
+    queued is its row in the downloads table, if it was queued: the file
+    name, the errors and the progress go there, and a file left by an
+    interrupted run is resumed
+    """
     make_dirs_to(args, "videos_folder")
     
-    folder      = args.db.getOptionValue("videos_folder")
-    basename    = gen_videofn(video, fmt)
-    filename    = ".".join((basename, fmtext[fmt]))
-    path        = os.path.join(folder, filename)
+    if queued is not None and queued.location and queued.fmt == fmt:
+        path    = queued.location
+    else:
+        folder      = args.db.getOptionValue("videos_folder")
+        basename    = gen_videofn(video, fmt)
+        filename    = ".".join((basename, ytprofiles.file_extensions[fmt]))
+        path        = os.path.join(folder, filename)
     fullpath    = make_absolute(path, args.root)
     
-    progress    = SimpleFileProgress("{position}/{total} {bar} {percent} {speed} ETA: {eta}")
+    if queued is not None:
+        queued.fmt        = fmt
+        queued.location   = path
+        yfsched.set_state(queued, yfdb.Download.ST_TRANSFERRING)
+        session.commit()
+    
+    progress    = make_progress("{position}/{total} {bar} {percent} {speed} ETA: {eta}")
+    host        = parse.urlparse(url).hostname or ""
+    shaper      = getattr(args, "shaper", None)
+    if shaper is not None:
+        progress.transfer = shaper.transfer(job, host)
+    policy      = yfnet.policy
     retry       = 0
-    while retry < 5:
-        try:
-            downloadFile(url, fullpath, progress, 2, bytecount)
-        except Exception:
-            import traceback
-            print("[ERROR] " + "".join(traceback.format_exception_only(*sys.exc_info()[:2])))
-            retry += 1
-        else:
-            break
-    else:
-        print("[ERROR] Cannot Download. Continuing")
-        return
+    done        = False
+    paused      = False
+    try:
+        while not done:
+            try:
+                yfnet.breakers.wait(host, policy.cap)
+                progress.attempt()
+                download.download(url, fullpath, progress, 2, bytecount)
+            except Exception as e:
+                if not isinstance(e, yfnet.HostPaused):
+                    progress.trace(video.id, retry)
+                import traceback
+                error = "".join(traceback.format_exception_only(*sys.exc_info()[:2])).strip()
+                print("[ERROR] " + error)
+                kind, asked = yfnet.classify(e)
+                yfmetrics.count("errors_" + kind)
+                if queued is not None:
+                    queued.last_error = error
+                    # no position yet if it failed before the download set up
+                    if getattr(progress, "position", None) is not None:
+                        queued.bytes_done = progress.position
+                    session.commit()
+                if isinstance(e, yfnet.HostPaused):
+                    paused = True
+                    break
+                if kind == yfnet.FATAL:
+                    yfnet.breakers.success(host)
+                    break
+                yfnet.breakers.failure(host)
+                if retry >= policy.retries:
+                    break
+                # back off, so an outage or a throttling server isn't hammered
+                delay = policy.delay(retry, asked)
+                yfmetrics.count("retries")
+                yfmetrics.count("retry_wait_seconds", delay)
+                time.sleep(delay)
+                retry += 1
+            else:
+                progress.trace(video.id, retry)
+                yfnet.breakers.success(host)
+                done = True
+        if paused:
+            # not the video's fault, leave it for a later run or another worker
+            print("[QUEUE] %s is paused, leaving '%s' queued" % (host, video.title))
+            yfmetrics.count("downloads_deferred")
+            if queued is not None:
+                yfsched.set_state(queued, yfdb.Download.ST_PENDING)
+                session.commit()
+            return
+        if not done:
+            print("[ERROR] Cannot Download. Continuing")
+            yfmetrics.count("downloads_failed")
+            if queued is not None:
+                yfsched.set_state(queued, yfdb.Download.ST_FAILED)
+                session.commit()
+            return
+    finally:
+        if progress.transfer is not None:
+            progress.transfer.close()
+    
+    yfmetrics.count("downloads")
+    yfmetrics.count("bytes_downloaded", os.path.getsize(fullpath))
     
     # Save DB
     localvideo = yfdb.LocalVideo(video_id=video.id, fmt=fmt, location=path,
                                  created=datetime.datetime.utcnow().isoformat())
     session.add(localvideo)
-    session.commit()
+    if queued is not None:
+        queued.bytes_done = os.path.getsize(fullpath)
+        yfsched.set_state(queued, yfdb.Download.ST_DONE)
+    with yfmetrics.span("db commit", "download", video=video.id):
+        session.commit()
     
     return localvideo
 
 
+_progress_class = None
+
+def make_progress(format):
+    """
+    create a download progress display
+    
+    it also notes when the request was answered and when the first data
+    arrived, so the download can show up as connect/first byte/transfer in -trace,
+    and hands the bytes received to its yfnet transfer, which may hold it back
+    """
+    global _progress_class
+    if _progress_class is None:
+        class DownloadProgress(progressfile.SimpleFileProgress):
+            transfer = None
+            
+            def attempt(self):
+                self.t_request = time.time()
+                self.t_response = self.t_data = None
+            
+            def start(self):
+                self.t_response = time.time()
+                return super(DownloadProgress, self).start()
+            
+            def __setattr__(self, name, value):
+                # setup() sets the position we resume at, only count what comes after start()
+                if name == "position" and getattr(self, "t_response", None) is not None:
+                    if self.t_data is None:
+                        object.__setattr__(self, "t_data", time.time())
+                    if self.transfer is not None and value > self.position:
+                        self.transfer.consume(value - self.position)
+                super(DownloadProgress, self).__setattr__(name, value)
+            
+            def trace(self, video_id, attempt):
+                now = time.time()
+                response = self.t_response or now
+                data = self.t_data or now
+                yfmetrics.add_span("connect", self.t_request, response, "download", video=video_id, attempt=attempt)
+                if self.t_response is not None:
+                    yfmetrics.add_span("first byte", response, data, "download", video=video_id, attempt=attempt)
+                if self.t_data is not None:
+                    yfmetrics.add_span("transfer", data, now, "download", video=video_id, attempt=attempt,
+                                       bytes=getattr(self, "position", None))
+        _progress_class = DownloadProgress
+    return _progress_class(format)
+
+
 def run_mkplaylist(args, session, job, playlist_, vids):
     """ creates the local playlist """
     make_dirs_to(args, "playlists_folder")
@@ -859,7 +1865,7 @@ def make_job_qa(args, job):
         if profile_name is None:
             profile_name = default_profile
     
-    profile = profiles[profile_name]
+    profile = ytprofiles.profiles[profile_name]
     
     # get the job quality
     if job.quality is not None:
@@ -874,11 +1880,30 @@ def make_job_qa(args, job):
     # generate the lookup table
     if quality not in profile[0]:
         print("[ WARN] The Exact Quality (%i) is not avaiable in this Profile: \"%s\"" % (quality, profile_name))
-    return [v for k, v in profile[0].items() if k <= quality]
+    return [v for k, v in sorted(profile[0].items(), reverse=True) if k <= quality]
+
+
+# resolved urlmaps, by video id: {video_id: (time, urlmap)}
+#   the urls youtube hands out expire after a few hours,
+#   so only keep them for a while
+resolve_cache = dict()
+resolve_cache_ttl = 1800
+
+
+def resolve_urlmap(video_id):
+    """ {fmt: url} of video_id """
+    cached = resolve_cache.get(video_id)
+    if cached is not None and cached[0] + resolve_cache_ttl > time.time():
+        yfmetrics.count("resolve_cache_hits")
+        return cached[1]
+    yfmetrics.count("resolve_cache_misses")
+    umap = resolve.resolve3(video_id).urlmap
+    resolve_cache[video_id] = (time.time(), umap)
+    return umap
 
 
 def recursive_resolve(video_id, lookup_table):
-    umap = resolve3(video_id).urlmap
+    umap = resolve_urlmap(video_id)
     for i in lookup_table:
         if i in umap:
             return umap[i], i
@@ -886,6 +1911,82 @@ def recursive_resolve(video_id, lookup_table):
         return None, None
 
 
+# how select_format picks among the formats a video has
+FORMAT_POLICIES = ("quality", "smallest", "budget")
+
+def select_format(args, video_id, duration, lookup_table):
+    """
+    the url and format to download a video in, and its size if we asked
+    
+    quality takes the best format the video has. smallest asks for the size
+    of the allowed formats at the best resolution the video has and takes
+    the smallest file; budget asks for all of them and takes the best one
+    within args.budget bytes per second of video (or the smallest, if none
+    is). Formats that don't answer are passed over. The HEAD requests go
+    through args.heads (see head_queue).
+    """
+    if args.select == "quality":
+        url, fmt = recursive_resolve(video_id, lookup_table)
+        return url, fmt, None
+    
+    umap = resolve_urlmap(video_id)
+    candidates = [fmt for fmt in lookup_table if fmt in umap]
+    if not candidates:
+        return None, None, None
+    asked = candidates
+    if args.select == "smallest":
+        resolutions = format_resolutions()
+        best = resolutions.get(candidates[0])
+        asked = [fmt for fmt in candidates if resolutions.get(fmt) == best]
+    tasks = [(fmt, args.heads.put(video_id, (video_id, fmt), head_size, umap[fmt])) for fmt in asked]
+    yfmetrics.count("format_heads", len(asked))
+    sizes = [(fmt, size) for fmt, size in ((fmt, task.wait()) for fmt, task in tasks) if size]
+    if not sizes:
+        return umap[candidates[0]], candidates[0], None
+    
+    # best first, so ties go to the better format
+    fmt, size = min(sizes, key=lambda fs: fs[1])
+    if args.select == "budget":
+        if not duration:
+            fmt, size = sizes[0]
+        else:
+            for f, s in sizes:
+                if s <= args.budget * duration:
+                    fmt, size = f, s
+                    break
+    if fmt != candidates[0]:
+        yfmetrics.count("format_downgrades")
+    return umap[fmt], fmt, size
+
+
+def format_resolutions():
+    """ {fmt: resolution} by the quality levels of the profiles """
+    resolutions = dict()
+    for profile in ytprofiles.profiles.values():
+        for quality, fmt in profile[0].items():
+            resolutions[fmt] = quality
+    return resolutions
+
+
+def head_queue(args):
+    """ The threads select_format sends its HEAD requests on, None if it doesn't """
+    if args.select == "quality":
+        return None
+    return yfsched.DownloadQueue(PLAN_WORKERS, maxsize=64)
+
+
+def format_policy(args):
+    """ -select or the format_select option, and the format_budget option """
+    args.select = getattr(args, "select", None) or args.db.getOptionValue("format_select") or "quality"
+    if args.select not in FORMAT_POLICIES:
+        print("[ERROR] Unknown format selection '%s', using quality" % args.select)
+        args.select = "quality"
+    args.budget = yfnet.parse_rate(args.db.getOptionValue("format_budget") or "")
+    if args.select == "budget" and not args.budget:
+        print("[ERROR] Format selection 'budget' needs the format_budget option (bytes/s), using smallest")
+        args.select = "smallest"
+
+
 #------------------------------------------------------------
 # Helpers
 #------------------------------------------------------------
@@ -902,9 +2003,10 @@ xmlns = {
 
 
 def gdata(module, params=dict(), ssl=True, raw=False):
-    url = parse.urlunparse(("https" if ssl else "http",
-                            "gdata.youtube.com",
-                            "feeds/api/" + module,
+    base = parse.urlparse(gdata_url)
+    url = parse.urlunparse((base.scheme if ssl else "http",
+                            base.netloc,
+                            base.path + module,
                             "",
                             parse.urlencode(params),
                             ""))
@@ -912,14 +2014,40 @@ def gdata(module, params=dict(), ssl=True, raw=False):
     return gdata_link(url, raw)
 
 
+def open_gdata_cache(args):
+    """ Put the cache in <database>.cache under gdata_link, as -cache and the cache_* options say """
+    global gdata_cache
+    gdata_cache = yfcache.Cache.from_options(args.db, args.database + ".cache", args.cache)
+
+
 def gdata_link(url, raw=False):
+    """
+    GET a GData url through gdata_cache, retrying transient errors
+    (yfnet.call); the error document of an HTTP error that didn't go away is
+    returned with an <httpcode> element, unless raw
+    """
     req = request.Request(url)
     req.add_header("GData-Version", "2")
+    req.add_header("Accept-Encoding", yfnet.ACCEPT_ENCODING)
+    host = parse.urlparse(url).hostname or ""
+    
+    def fetch(extra=()):
+        for key, value in extra:
+            req.add_header(key, value)
+        # decoded while the parser (or the cache) reads it
+        return yfnet.open_decoded(auth.urlopen, req)
+    if gdata_cache is not None:
+        headers = req.header_items()
+        opener = lambda: gdata_cache.open(url, headers, fetch)
+    else:
+        opener = fetch
     
     if not raw:
-        try:
-            with urlopen(req) as fp:
+        def fetch_tree():
+            with opener() as fp:
                 return etree.parse(fp)
+        try:
+            return yfnet.call(fetch_tree, host, url, yfnet.API_FATAL)
         except request.HTTPError as e:
             tree = etree.parse(e.fp)
             el = etree.SubElement(tree.getroot(), "httpcode")
@@ -927,7 +2055,7 @@ def gdata_link(url, raw=False):
             e.fp.close()
             return tree
     else:
-        return urlopen(req)
+        return yfnet.call(opener, host, url, yfnet.API_FATAL)
 
 
 def tag(xmlns_, tagname):